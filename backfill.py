@@ -0,0 +1,154 @@
+import argparse
+from datetime import datetime, timedelta, timezone
+
+from c4c import c4c_config
+from c4c.c4c_client import C4CClient
+from db.db_crud import *
+from logging_config import setup_logging
+from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL
+
+logger = setup_logging(__name__)
+
+# entities that can be backfilled, in the order they are written:
+# employees before leads, so that lead owners who are employees are not resolved as business partners
+backfill_entities = ("contact", "account", "emp", "lead")
+# shard boundaries are multiples of shard days since then
+backfill_epoch = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def format_c4c_date_time(date_time):
+    return date_time.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_c4c_date_time(date_time_string):
+    return datetime.strptime(date_time_string, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+def get_shards(date_from, date_to=None, shard_days=c4c_config.backfill_shard_days):
+    '''
+    Split an EntityLastChangedOn range into shards of shard_days. Boundaries are aligned to backfill_epoch,
+    so that the same shards come out again when an interrupted backfill is resumed with a later date_from
+    :param date_from: start of the range
+    :param date_to: end of the range, excluded, now if not given
+    :param shard_days: days per shard
+    :return: list of tuples of start and end of each shard, end excluded
+    '''
+    shard = timedelta(days=shard_days)
+    # C4C date times are given in whole seconds
+    date_to = date_to or datetime.now(timezone.utc).replace(microsecond=0)
+    shards = []
+    start = date_from
+    boundary = backfill_epoch + ((date_from - backfill_epoch) // shard + 1) * shard
+    while boundary < date_to:
+        shards.append((start, boundary))
+        start = boundary
+        boundary += shard
+    if start < date_to:
+        shards.append((start, date_to))
+    return shards
+
+
+def get_covered_until(completed_shards, shard_from):
+    '''
+    Get how far completed shards cover a range without a gap, from its start
+    :param completed_shards: dict of DateFrom: DateTo of completed shards, see get_completed_shards
+    :param shard_from: start of the range
+    :return: end of the covered part of the range, shard_from if none of it is covered
+    '''
+    covered_until = shard_from
+    for completed_from, completed_to in sorted(completed_shards.items()):
+        if completed_from <= covered_until < completed_to:
+            covered_until = completed_to
+    return covered_until
+
+
+def upsert_backfill_page(session_, retriever, requests_session, entity, page):
+    '''
+    Upsert one page of a backfill shard along with what the loaders upsert with it, and advance the watermark
+    :param session_: SQL session
+    :param retriever: C4CClient
+    :param requests_session: request session for the marketing permissions and business partners of leads
+    :param entity: entity of the shard
+    :param page: entries of the page
+    :return: None
+    '''
+    if entity == "contact":
+        upsert_contact(session_=session_, data=page)
+    if entity == "account":
+        upsert_account(session_=session_, data=page)
+    if entity == "emp":
+        upsert_emp(session_=session_, data=page, type="Employee")
+    if entity == "lead":
+        upsert_lead(session_=session_, data=page, inbound=True)
+        mark_ps = retriever.get_data(session_=requests_session, type="mp", leads_to_get_mps=page)
+        upsert_mark_p(session_=session_, data=mark_ps)
+        bps = retriever.get_data(session_=requests_session, type="bp", leads_to_get_bps=page,
+                                 existing_emps=get_data_for_eloqua_import(session_=session_, type="emp"))
+        upsert_emp(session_=session_, data=bps, type="Business Partner")
+    advance_watermark(session_=session_, entity=entity, data=page)
+
+
+def backfill(retriever, entities, date_to=None, shard_days=c4c_config.backfill_shard_days,
+             max_workers=c4c_config.fetch_workers):
+    '''
+    Backfill entities from C4C in EntityLastChangedOn shards that are fetched concurrently.
+    Each shard is written in its own transaction along with its checkpoint,
+    so an interrupted backfill resumes from the first shard that was not completed
+    :param retriever: C4CClient
+    :param entities: dict of entity: start of its backfill in C4C date time format, e.g. 2020-01-01T00:00:00Z
+    :param date_to: end of the backfill in C4C date time format, excluded, None to backfill up to the start of the run
+    :param shard_days: days per shard
+    :param max_workers: number of shards fetched at a time
+    :return: dict of entity: number of entries ingested
+    '''
+    with start_psql_session() as session:
+        completed_shards = {entity: get_completed_shards(session_=session, entity=entity) for entity in entities}
+    # the end of the last shard is recorded, so that a later run only fetches what changed after it
+    date_to = parse_c4c_date_time(date_to) if date_to else datetime.now(timezone.utc).replace(microsecond=0)
+    queries = dict()
+    for entity in backfill_entities:
+        if entity not in entities:
+            continue
+        shards = get_shards(date_from=parse_c4c_date_time(entities[entity]), date_to=date_to, shard_days=shard_days)
+        # shards covered by completed shards are skipped, a partly covered shard is only fetched after its covered part
+        shards_to_fetch = []
+        for shard_from, shard_to in shards:
+            covered_until = get_covered_until(completed_shards=completed_shards[entity], shard_from=shard_from)
+            if covered_until < shard_to:
+                shards_to_fetch.append((covered_until, shard_to))
+        logger.debug("Backfill {0} in {1} shards, {2} of them completed before".format(
+            entity, len(shards), len(shards) - len(shards_to_fetch)))
+        for shard_from, shard_to in shards_to_fetch:
+            queries[(entity, shard_from, shard_to)] = {"type": entity, "date_from": format_c4c_date_time(shard_from),
+                                                       "date_to": format_c4c_date_time(shard_to)}
+    counts = {entity: 0 for entity in entities}
+    # shards are written in the order of queries, while the next ones are fetched
+    with retriever.start_requests_session() as requests_session, \
+            retriever.fetch_data_pages(queries=queries, max_workers=max_workers) as pages:
+        for entity, shard_from, shard_to in queries:
+            entry_count = 0
+            with start_psql_session() as session:
+                for page in pages[(entity, shard_from, shard_to)]:
+                    upsert_backfill_page(session_=session, retriever=retriever, requests_session=requests_session,
+                                         entity=entity, page=page)
+                    entry_count += len(page)
+                complete_shard(session_=session, entity=entity, date_from=shard_from, date_to=shard_to,
+                               entry_count=entry_count)
+            counts[entity] += entry_count
+    logger.debug("Backfill complete with {0}".format(counts))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entities", nargs="+", choices=backfill_entities, default=list(backfill_entities),
+                        help="entities to backfill, default all")
+    parser.add_argument("--date_from", default="2020-01-01T00:00:00Z", help="start of the backfill, default 2020-01-01T00:00:00Z")
+    parser.add_argument("--date_to", default=None, help="end of the backfill, excluded, default now")
+    parser.add_argument("--shard_days", type=int, default=c4c_config.backfill_shard_days)
+    parser.add_argument("--workers", type=int, default=c4c_config.fetch_workers, help="number of shards fetched at a time")
+    args = parser.parse_args()
+
+    retriever = C4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL)
+    backfill(retriever=retriever, entities={entity: args.date_from for entity in args.entities}, date_to=args.date_to,
+             shard_days=args.shard_days, max_workers=args.workers)
@@ -0,0 +1,812 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+from c4c import c4c_config
+from c4c.c4c_batch import get_boundary, split_headers, split_multipart
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+# service root of the C4C OData API, C4C_BASE_URL is http://host:port + c4c_root
+c4c_root = "/sap/c4c/odata/v1/c4codataapi/"
+# Eloqua REST API, ELQ_BASE_URL is http://host:port
+eloqua_root = re.compile(r"^/api/rest/\d+\.\d+/(.*)$", re.IGNORECASE)
+# C4C returns at most 1000 entries per page and a __next link for the rest
+server_page_size = 1000
+# name of the option list that db_loader_lead updates
+emp_option_list_name = "Ruukki Employees from C4C REST API"
+
+# fields that C4C assigns itself, sent as null by clients that do not know them yet
+server_assigned_fields = ("ContactUUID", "OwnerPartyUUID", "OwnerUUID")
+
+# navigation properties, as (collection, property): collection of the children
+navigations = {("MarketingPermissionCollection", "ChannelPermission"): "MarketingPermissionChannelPermissionCollection",
+               ("EmployeeCollection", "EmployeeOrganisationalUnitAssignment"): "EmployeeOrganisationalUnitAssignmentCollection"}
+
+filter_clause = re.compile(r"^(\w+) (eq|ne|ge|gt|le|lt) (?:(guid|datetimeoffset|datetime)?'(.*)'|(-?\d+))$")
+
+
+def new_guid():
+    return str(uuid.uuid4()).upper()
+
+
+def new_object_id():
+    return uuid.uuid4().hex.upper()
+
+
+def to_ms(date_time):
+    return int(date_time.timestamp() * 1000)
+
+
+def format_c4c_date_time_offset(ms):
+    return "/Date({0})/".format(ms)
+
+
+def parse_iso_date_time(value):
+    '''
+    Parse a date time of a $filter, e.g. 2020-07-06T00:00:00Z or 2020-07-06T00:00:00.000+02:00
+    :return: milliseconds since epoch
+    '''
+    date_time = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date_time.tzinfo is None:
+        date_time = date_time.replace(tzinfo=timezone.utc)
+    return to_ms(date_time)
+
+
+def parse_filter(filter_string):
+    '''
+    Parse a $filter of clauses joined by "or", each of clauses joined by "and", as the clients send them
+    :param filter_string: $filter query param
+    :return: list of lists of (field, operator, value), or None if no filter
+    '''
+    if not filter_string:
+        return None
+    result = []
+    for or_part in re.split(r"\s+or\s+", filter_string.strip()):
+        and_clauses = []
+        for clause in re.split(r"\s+and\s+", or_part.strip().strip("()")):
+            match = filter_clause.match(clause.strip().strip("()"))
+            if not match:
+                raise ValueError("Unsupported $filter clause: {0}".format(clause))
+            field, operator, literal_type, literal, number = match.groups()
+            if literal_type in ("datetimeoffset", "datetime"):
+                value = parse_iso_date_time(literal)
+            elif literal_type == "guid":
+                value = literal.upper()
+            elif number is not None:
+                value = int(number)
+            else:
+                value = literal
+            and_clauses.append((field, operator, value))
+        result.append(and_clauses)
+    return result
+
+
+class FakeC4C:
+    '''
+    In-memory C4C OData v2 service with the subset of the API used by C4CClient:
+    collections with $select, $filter, $orderby, $expand, $top, $skip, $inlinecount and __next paging,
+    /$count, entities by key and their navigation properties, Post, Patch, Delete, $batch and CSRF tokens
+    '''
+    def __init__(self, size, seed=0, page_size=server_page_size, csrf_token_ttl=None):
+        self.page_size = page_size
+        self.csrf_token_ttl = csrf_token_ttl
+        # token: monotonic time it was issued
+        self.csrf_tokens = dict()
+        # collection: {ObjectID: entity}, fields starting with _ are internal
+        self.collections = dict()
+        # (collection, parent ObjectID): [child ObjectIDs]
+        self.children = dict()
+        # fields every entity of a collection has, merged in when an entity is sent
+        self.defaults = dict()
+        # bumped on every write, to drop query results and indexes
+        self.version = 0
+        self.query_cache = dict()
+        self.indexes = dict()
+        self.next_lead_id = 1
+        # entries served per collection, and operations per method and collection inside $batch requests
+        self.entries = dict()
+        self.batch_operations = dict()
+        self.generate(size=size, seed=seed)
+
+    # dataset
+    def add(self, collection, entity, changed_on=None, parent=None):
+        object_id = entity.get("ObjectID", None) or new_object_id()
+        entity["ObjectID"] = object_id
+        if changed_on is not None:
+            entity["_changed_on"] = changed_on
+        if parent:
+            entity["ParentObjectID"] = parent
+            self.children.setdefault((collection, parent), []).append(object_id)
+        self.collections.setdefault(collection, dict())[object_id] = entity
+        self.version += 1
+        return entity
+
+    def generate(self, size, seed=0):
+        '''
+        Generate a dataset sized by the number of leads: as many contacts and target group members,
+        half as many accounts and marketing permissions, a hundredth as many target groups and employees
+        '''
+        rng = random.Random(seed)
+        now = datetime.now(timezone.utc)
+        start = to_ms(now - timedelta(days=60))
+        end = to_ms(now)
+
+        def changed_on():
+            return rng.randint(start, end)
+
+        for collection, fields in (("LeadCollection", c4c_config.lead_c4c_fields),
+                                   ("ContactCollection", c4c_config.contact_c4c_fields),
+                                   ("CorporateAccountCollection", c4c_config.account_c4c_fields)):
+            self.defaults[collection] = {field: self.default_value(field) for field in fields.split(",")
+                                         if field != "EntityLastChangedOn"}
+        self.defaults["MarketingPermissionCollection"] = {"BusinessPartner_ID": None}
+
+        emp_count = max(10, size // 100)
+        emp_uuids = []
+        for i in range(emp_count):
+            emp = self.add("EmployeeCollection", {"UUID": new_guid(), "FirstName": "First{0}".format(i),
+                                                  "LastName": "Last{0}".format(i), "Email": "emp{0}@example.com".format(i),
+                                                  "CountryCode": rng.choice(("FI", "SE", "EE", "PL")),
+                                                  "BusinessPartnerID": str(8000000 + i)}, changed_on=changed_on())
+            self.add("EmployeeOrganisationalUnitAssignmentCollection",
+                     {"OrgUnitID": "ORG{0}".format(i % 20)}, parent=emp["ObjectID"])
+            self.add("BusinessPartnerCollection", {"BusinessPartnerUUID": emp["UUID"], "Name": "First{0} Last{0}".format(i),
+                                                   "ThingType": "COD_EMPLOYEE_TT"})
+            emp_uuids.append(emp["UUID"])
+        # lead owners that are partner contacts, resolved through BusinessPartnerCollection
+        partner_uuids = []
+        for i in range(emp_count):
+            bus_p = self.add("BusinessPartnerCollection", {"BusinessPartnerUUID": new_guid(), "Name": "Partner {0}".format(i),
+                                                           "ThingType": "COD_PARTNERCONTACT_TT"})
+            partner_uuids.append(bus_p["BusinessPartnerUUID"])
+
+        for i in range(size // 2):
+            self.add("CorporateAccountCollection", {"AccountID": str(1000000 + i), "Name": "Account {0}".format(i)},
+                     changed_on=changed_on())
+        for i in range(size):
+            self.add("ContactCollection", {"ContactID": str(2000000 + i), "ContactUUID": new_guid(),
+                                           "AccountID": str(1000000 + i // 2), "Email": "contact{0}@example.com".format(i)},
+                     changed_on=changed_on())
+
+        tg_count = max(1, size // 100)
+        for i in range(tg_count):
+            self.add("TargetGroupCollection", {"ID": str(3000000 + i), "Description": "Target Group {0}".format(i)},
+                     changed_on=changed_on())
+        for i in range(size):
+            self.add("TargetGroupMemberCollection", {"ContactID": str(2000000 + i), "TargetGroupID": str(3000000 + i % tg_count)})
+
+        for i in range(size):
+            lead = self.add("LeadCollection", {"ID": str(self.next_lead_id), "ContactUUID": new_guid(),
+                                               "OwnerPartyUUID": rng.choice(emp_uuids + partner_uuids),
+                                               "Name": "Lead {0}".format(i), "ContactEMail": "lead{0}@example.com".format(i)},
+                            changed_on=changed_on())
+            self.next_lead_id += 1
+            # every other lead has a marketing permission, every other of those a Z03 consent
+            if i % 2 == 0:
+                mark_p = self.add("MarketingPermissionCollection", {"BusinessPartnerUUID": lead["ContactUUID"],
+                                                                    "BusinessPartner_ID": str(4000000 + i)},
+                                  changed_on=changed_on())
+                if i % 4 == 0:
+                    self.add("MarketingPermissionChannelPermissionCollection", {"Channel": "Z03", "Consent": rng.choice("123")},
+                             parent=mark_p["ObjectID"])
+        logger.debug("Fake C4C dataset of {0}".format({collection: len(entities)
+                                                        for collection, entities in self.collections.items()}))
+
+    def default_value(self, field):
+        if field.endswith("UUID"):
+            return None
+        if "Date" in field:
+            return format_c4c_date_time_offset(to_ms(datetime(2020, 7, 6, tzinfo=timezone.utc)))
+        if "Time" in field or field.endswith("apptime_KUT"):
+            return "PT10H00M00S"
+        return "{0} value".format(field)[:40]
+
+    # serialization
+    def entity_uri(self, host_url, collection, object_id):
+        return "{0}{1}{2}('{3}')".format(host_url, c4c_root, collection, object_id)
+
+    def to_json(self, host_url, collection, entity, select=None, expand=()):
+        '''
+        Convert an entity to OData v2 JSON, with __metadata, selected fields and expanded or deferred navigation properties
+        :param select: dict of selected field: selected fields of its navigation property, None for all
+        :param expand: navigation properties to expand
+        '''
+        uri = self.entity_uri(host_url=host_url, collection=collection, object_id=entity["ObjectID"])
+        result = {"__metadata": {"uri": uri, "type": "c4codata.{0}".format(collection.replace("Collection", ""))}}
+        fields = dict(self.defaults.get(collection, dict()))
+        fields.update((key, value) for key, value in entity.items() if not key.startswith("_"))
+        if "_changed_on" in entity:
+            fields["EntityLastChangedOn"] = format_c4c_date_time_offset(entity["_changed_on"])
+        for key, value in fields.items():
+            if select is None or key in select:
+                result[key] = value
+        for (parent_collection, navigation), child_collection in navigations.items():
+            if parent_collection != collection or (select is not None and navigation not in select):
+                continue
+            if navigation in expand:
+                child_select = select.get(navigation, None) if select is not None else None
+                result[navigation] = {"results": [
+                    self.to_json(host_url=host_url, collection=child_collection,
+                                 entity=self.collections[child_collection][child_id], select=child_select)
+                    for child_id in self.children.get((child_collection, entity["ObjectID"]), [])]}
+            else:
+                result[navigation] = {"__deferred": {"uri": uri + "/" + navigation}}
+        return result
+
+    def parse_select(self, select_string):
+        if not select_string:
+            return None
+        select = dict()
+        for field in select_string.split(","):
+            field, _, child_field = field.strip().partition("/")
+            select.setdefault(field, None)
+            if child_field:
+                select[field] = select[field] or dict()
+                select[field][child_field] = None
+        return select
+
+    # queries
+    def field_value(self, entity, field):
+        if field == "EntityLastChangedOn":
+            return entity.get("_changed_on", None)
+        value = entity.get(field, None)
+        # GUIDs are compared regardless of case
+        return value.upper() if isinstance(value, str) and field.endswith("UUID") else value
+
+    def matches(self, entity, clauses):
+        for field, operator, value in clauses:
+            entity_value = self.field_value(entity=entity, field=field)
+            if operator == "eq":
+                matched = entity_value == value
+            elif operator == "ne":
+                matched = entity_value != value
+            elif entity_value is None:
+                matched = False
+            else:
+                matched = {"ge": entity_value >= value, "gt": entity_value > value,
+                           "le": entity_value <= value, "lt": entity_value < value}[operator]
+            if not matched:
+                return False
+        return True
+
+    def get_index(self, collection, field):
+        # entities by field value, for the "or" chains of eq that the clients send for multi-key lookups
+        index = self.indexes.get((collection, field, self.version), None)
+        if index is None:
+            index = dict()
+            for object_id, entity in self.collections.get(collection, dict()).items():
+                index.setdefault(self.field_value(entity=entity, field=field), []).append(object_id)
+            self.indexes = {key: value for key, value in self.indexes.items() if key[2] == self.version}
+            self.indexes[(collection, field, self.version)] = index
+        return index
+
+    def query(self, collection, filter_string=None, orderby=None):
+        '''
+        :return: ObjectIDs of the entities of a collection matching a $filter, in $orderby order
+        '''
+        cache_key = (collection, filter_string, orderby, self.version)
+        if cache_key in self.query_cache:
+            return self.query_cache[cache_key]
+        entities = self.collections.get(collection, dict())
+        filters = parse_filter(filter_string)
+        if filters is None:
+            object_ids = list(entities.keys())
+        elif all(len(clauses) == 1 and clauses[0][1] == "eq" for clauses in filters) and \
+                len(set(clauses[0][0] for clauses in filters)) == 1:
+            index = self.get_index(collection=collection, field=filters[0][0][0])
+            object_ids = list(dict.fromkeys(object_id for clauses in filters
+                                            for object_id in index.get(clauses[0][2], [])))
+        else:
+            object_ids = [object_id for object_id, entity in entities.items()
+                          if any(self.matches(entity=entity, clauses=clauses) for clauses in filters)]
+        if orderby:
+            field, _, direction = orderby.strip().partition(" ")
+            object_ids.sort(key=lambda object_id: (self.field_value(entity=entities[object_id], field=field) is None,
+                                                   self.field_value(entity=entities[object_id], field=field) or 0),
+                            reverse=direction.strip().lower() == "desc")
+        self.query_cache = {key: value for key, value in self.query_cache.items() if key[3] == self.version}
+        self.query_cache[cache_key] = object_ids
+        return object_ids
+
+    def get_collection(self, host_url, collection, query):
+        object_ids = self.query(collection=collection, filter_string=query.get("$filter", None),
+                                orderby=query.get("$orderby", None))
+        skip = int(query.get("$skiptoken", None) or query.get("$skip", None) or 0)
+        top = int(query["$top"]) if "$top" in query else None
+        page_size = min(top, self.page_size) if top is not None else self.page_size
+        select = self.parse_select(query.get("$select", None))
+        expand = [navigation.strip() for navigation in query.get("$expand", "").split(",") if navigation.strip()]
+        entities = self.collections.get(collection, dict())
+        page = object_ids[skip:skip + page_size]
+        self.entries[collection] = self.entries.get(collection, 0) + len(page)
+        d = {"results": [self.to_json(host_url=host_url, collection=collection, entity=entities[object_id],
+                                      select=select, expand=expand) for object_id in page]}
+        if query.get("$inlinecount", None) == "allpages":
+            d["__count"] = str(len(object_ids))
+        # server-driven paging when less was returned than asked for
+        end = skip + len(page)
+        if end < len(object_ids) and (top is None or top > page_size):
+            next_query = {key: value for key, value in query.items() if key not in ("$skip", "$skiptoken", "$inlinecount")}
+            if top is not None:
+                next_query["$top"] = str(top - page_size)
+            next_query["$skiptoken"] = str(end)
+            d["__next"] = "{0}{1}{2}?{3}".format(host_url, c4c_root, collection, urlencode(next_query, quote_via=quote))
+        return d
+
+    # csrf
+    def issue_csrf_token(self):
+        token = uuid.uuid4().hex
+        self.csrf_tokens[token] = time.monotonic()
+        return token
+
+    def is_csrf_token_valid(self, token):
+        issued_at = self.csrf_tokens.get(token, None)
+        if issued_at is None:
+            return False
+        if self.csrf_token_ttl is not None and time.monotonic() - issued_at > self.csrf_token_ttl:
+            self.csrf_tokens.pop(token, None)
+            return False
+        return True
+
+    # requests
+    def json_response(self, status_code, data, headers=None):
+        return status_code, {"Content-Type": "application/json", **(headers or dict())}, json.dumps(data).encode()
+
+    def error_response(self, status_code, message):
+        return self.json_response(status_code=status_code,
+                                  data={"error": {"code": str(status_code), "message": {"lang": "en", "value": message}}})
+
+    def handle(self, method, path, query, headers, body, host_url, check_csrf=True):
+        '''
+        Answer one request to the service root
+        :param path: path relative to the service root, e.g. LeadCollection('ObjectID')/ChannelPermission
+        :param query: query params as dict
+        :param headers: request headers with lowercase names
+        :return: tuple of status code, response headers and body
+        '''
+        response_headers = dict()
+        if headers.get("x-csrf-token", "").lower() == "fetch":
+            response_headers["x-csrf-token"] = self.issue_csrf_token()
+        if method in ("POST", "PATCH", "PUT", "MERGE", "DELETE") and check_csrf and \
+                not self.is_csrf_token_valid(headers.get("x-csrf-token", "")):
+            return 403, {"x-csrf-token": "Required", "Content-Type": "text/plain"}, b"CSRF token validation failed"
+        if not path:
+            status_code, service_headers, service_body = self.json_response(
+                status_code=200, data={"d": {"EntitySets": sorted(self.collections.keys())}})
+            return status_code, {**service_headers, **response_headers}, service_body
+        if path == "$batch" and method == "POST":
+            return self.handle_batch(headers=headers, body=body, host_url=host_url)
+
+        match = re.match(r"^(\w+)(?:\('([^']*)'\))?(?:/(\$count|\w+))?$", path)
+        if not match or match.group(1) not in self.collections and not match.group(1).endswith("Collection"):
+            return self.error_response(status_code=404, message="Resource not found for segment {0}".format(path))
+        collection, object_id, segment = match.groups()
+        entities = self.collections.setdefault(collection, dict())
+        prefer_representation = "return=representation" in headers.get("prefer", "")
+
+        if object_id is None:
+            if segment == "$count" and method == "GET":
+                count = len(self.query(collection=collection, filter_string=query.get("$filter", None)))
+                return 200, {"Content-Type": "text/plain"}, str(count).encode()
+            if segment:
+                return self.error_response(status_code=404, message="Resource not found for segment {0}".format(path))
+            if method == "GET":
+                return self.json_response(status_code=200,
+                                          data={"d": self.get_collection(host_url=host_url, collection=collection, query=query)})
+            if method == "POST":
+                return self.create(host_url=host_url, collection=collection, body=body)
+            return self.error_response(status_code=405, message="Method {0} not allowed".format(method))
+
+        entity = entities.get(object_id, None)
+        if entity is None:
+            return self.error_response(status_code=404, message="Resource not found for key {0}".format(object_id))
+        if segment:
+            child_collection = navigations.get((collection, segment), None)
+            if child_collection is None:
+                return self.error_response(status_code=404, message="Resource not found for segment {0}".format(segment))
+            if method == "GET":
+                select = self.parse_select(query.get("$select", None))
+                children = self.collections.get(child_collection, dict())
+                return self.json_response(status_code=200, data={"d": {"results": [
+                    self.to_json(host_url=host_url, collection=child_collection, entity=children[child_id], select=select)
+                    for child_id in self.children.get((child_collection, object_id), [])]}})
+            if method == "POST":
+                return self.create(host_url=host_url, collection=child_collection, body=body, parent=object_id)
+            return self.error_response(status_code=405, message="Method {0} not allowed".format(method))
+
+        if method == "GET":
+            return self.json_response(status_code=200, data={"d": {"results": self.to_json(
+                host_url=host_url, collection=collection, entity=entity, select=self.parse_select(query.get("$select", None)))}})
+        if method in ("PATCH", "MERGE", "PUT"):
+            try:
+                changes = json.loads(body.decode("utf-8") or "{}")
+            except ValueError:
+                return self.error_response(status_code=400, message="Invalid JSON body")
+            # a null server-assigned field does not clear it
+            entity.update((key, value) for key, value in changes.items()
+                          if key not in ("ObjectID", "__metadata") and not (key in server_assigned_fields and value is None))
+            entity["_changed_on"] = to_ms(datetime.now(timezone.utc))
+            self.version += 1
+            if prefer_representation:
+                return self.json_response(status_code=200, data={"d": {"results": self.to_json(
+                    host_url=host_url, collection=collection, entity=entity)}})
+            return 204, dict(), b""
+        if method == "DELETE":
+            entities.pop(object_id)
+            self.version += 1
+            return 204, dict(), b""
+        return self.error_response(status_code=405, message="Method {0} not allowed".format(method))
+
+    def create(self, host_url, collection, body, parent=None):
+        try:
+            entity = json.loads(body.decode("utf-8") or "{}")
+        except ValueError:
+            return self.error_response(status_code=400, message="Invalid JSON body")
+        entity.pop("__metadata", None)
+        entity.pop("ObjectID", None)
+        if collection == "MarketingPermissionCollection":
+            if self.query(collection=collection,
+                          filter_string="BusinessPartnerUUID eq guid'{0}'".format(entity.get("BusinessPartnerUUID", ""))):
+                return self.error_response(status_code=400, message="Marketing permission already exists")
+        if collection == "LeadCollection":
+            entity["ID"] = str(self.next_lead_id)
+            self.next_lead_id += 1
+            if not entity.get("ContactUUID", None):
+                entity["ContactUUID"] = new_guid()
+            entity.setdefault("OwnerPartyUUID", None)
+        parent = parent or entity.pop("ParentObjectID", None)
+        entity = self.add(collection=collection, entity=entity, parent=parent,
+                          changed_on=to_ms(datetime.now(timezone.utc)))
+        uri = self.entity_uri(host_url=host_url, collection=collection, object_id=entity["ObjectID"])
+        return self.json_response(status_code=201, data={"d": {"results": self.to_json(
+            host_url=host_url, collection=collection, entity=entity)}}, headers={"Location": uri})
+
+    def handle_batch(self, headers, body, host_url):
+        '''
+        Answer a $batch request, changesets are answered as changesets with the Content-ID of their operations
+        '''
+        boundary = get_boundary(headers.get("content-type", ""))
+        if not boundary:
+            return self.error_response(status_code=400, message="Missing $batch boundary")
+        response_boundary = "batchresponse_{0}".format(uuid.uuid4())
+        output = []
+        for part in split_multipart(content=body, boundary=boundary):
+            _, part_headers, part_body = split_headers(part)
+            part_content_type = part_headers.get("Content-Type", "")
+            if part_content_type.lower().startswith("multipart/mixed"):
+                changeset_boundary = "changesetresponse_{0}".format(uuid.uuid4())
+                changeset = [self.handle_batch_operation(operation=operation, host_url=host_url)
+                             for operation in split_multipart(content=part_body, boundary=get_boundary(part_content_type))]
+                output.append("--{0}\r\nContent-Type: multipart/mixed; boundary={1}\r\n\r\n".format(
+                    response_boundary, changeset_boundary).encode())
+                for operation in changeset:
+                    output.append("--{0}\r\n".format(changeset_boundary).encode() + operation + b"\r\n")
+                output.append("--{0}--\r\n".format(changeset_boundary).encode())
+            else:
+                output.append("--{0}\r\n".format(response_boundary).encode() +
+                              self.handle_batch_operation(operation=part, host_url=host_url) + b"\r\n")
+        output.append("--{0}--\r\n".format(response_boundary).encode())
+        return 202, {"Content-Type": "multipart/mixed; boundary={0}".format(response_boundary)}, b"".join(output)
+
+    def handle_batch_operation(self, operation, host_url):
+        _, operation_headers, message = split_headers(operation)
+        lines, headers, body = split_headers(message)
+        request_line = lines[0].split(" ") if lines else []
+        if len(request_line) < 2:
+            status_code, response_headers, response_body = self.error_response(status_code=400, message="Invalid operation")
+        else:
+            if "Content-Length" in headers:
+                body = body[:int(headers["Content-Length"])]
+            url = urlsplit(request_line[1])
+            path = url.path[len(c4c_root):] if url.path.startswith(c4c_root) else url.path.lstrip("/")
+            query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+            key = "{0} {1}".format(request_line[0].upper(), re.sub(r"\('[^']*'\)", "", path.split("/")[0]))
+            self.batch_operations[key] = self.batch_operations.get(key, 0) + 1
+            # the $batch request itself carries the CSRF token
+            status_code, response_headers, response_body = self.handle(
+                method=request_line[0].upper(), path=path, query=query,
+                headers={key.lower(): value for key, value in headers.items()}, body=body, host_url=host_url,
+                check_csrf=False)
+        head = "Content-Type: application/http\r\nContent-Transfer-Encoding: binary\r\n"
+        if operation_headers.get("Content-ID", None):
+            head += "Content-ID: {0}\r\n".format(operation_headers["Content-ID"])
+        head += "\r\nHTTP/1.1 {0} {1}\r\n".format(status_code, HTTPStatus(status_code).phrase)
+        head += "".join("{0}: {1}\r\n".format(key, value) for key, value in response_headers.items())
+        head += "Content-Length: {0}\r\n\r\n".format(len(response_body))
+        return head.encode() + response_body
+
+
+class FakeEloqua:
+    '''
+    In-memory Eloqua REST API with the contact list and option list assets used by ElqClient
+    '''
+    def __init__(self, size, seed=0):
+        self.next_id = 1
+        self.contact_lists = dict()
+        self.option_lists = dict()
+        rng = random.Random(seed)
+        # some target groups exist in Eloqua already, so that both import and export of ids are exercised
+        for i in range(max(1, size // 100)):
+            if rng.random() < 0.5:
+                self.add(assets=self.contact_lists, asset={"name": "Target Group {0}".format(i), "folderId": "3693"})
+        self.add(assets=self.option_lists, asset={"name": emp_option_list_name, "elements": []})
+
+    def add(self, assets, asset):
+        asset["id"] = str(self.next_id)
+        self.next_id += 1
+        assets[asset["id"]] = asset
+        return asset
+
+    def search(self, assets, query):
+        # search=name="value", only exact names are supported
+        search = query.get("search", "")
+        name = search.partition("=")[2].strip("\"") if search.startswith("name=") else None
+        elements = [asset for asset in assets.values() if name is None or asset["name"] == name]
+        return {"elements": elements, "page": 1, "pageSize": 1000, "total": len(elements)}
+
+    def json_response(self, status_code, data):
+        return status_code, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+    def handle(self, method, path, query, body):
+        '''
+        Answer one request to the REST API
+        :param path: path after /api/REST/<version>/, e.g. assets/contact/list/1
+        :return: tuple of status code, response headers and body
+        '''
+        path = path.strip("/")
+        try:
+            data = json.loads(body.decode("utf-8")) if body else dict()
+        except ValueError:
+            return self.json_response(status_code=400, data=[{"type": "ValidationError", "value": "Invalid JSON body"}])
+        for plural, singular, assets in (("assets/contact/lists", "assets/contact/list", self.contact_lists),
+                                         ("assets/optionLists", "assets/optionList", self.option_lists)):
+            if path == plural and method == "GET":
+                return self.json_response(status_code=200, data=self.search(assets=assets, query=query))
+            if path == singular and method == "POST":
+                existing = next((asset for asset in assets.values() if asset["name"] == data.get("name", None)), None)
+                if existing:
+                    # the conflicting name comes last, as Eloqua sends it
+                    return self.json_response(status_code=409, data=[{
+                        "type": "ObjectValidationError", "property": "name",
+                        "requirement": {"type": "UniquenessRequirement", "conflictingId": existing["id"]},
+                        "value": existing["name"]}])
+                return self.json_response(status_code=201, data=self.add(assets=assets, asset=data))
+            if path.startswith(singular + "/"):
+                asset_id = path[len(singular) + 1:]
+                if asset_id not in assets:
+                    return self.json_response(status_code=404, data=[{"type": "ObjectNotFound", "value": asset_id}])
+                if method == "GET":
+                    return self.json_response(status_code=200, data=assets[asset_id])
+                if method == "PUT":
+                    data["id"] = asset_id
+                    assets[asset_id] = data
+                    return self.json_response(status_code=200, data=data)
+                if method == "DELETE":
+                    assets.pop(asset_id)
+                    return 200, dict(), b""
+        return self.json_response(status_code=404, data=[{"type": "NotFound", "value": path}])
+
+
+class FakeServer(ThreadingHTTPServer):
+    '''
+    HTTP server of FakeC4C and FakeEloqua, with injected latency, errors, throttling and a concurrency limit.
+    Requests per entity are counted and served as JSON at /_fake/stats, see get_stats
+    '''
+    daemon_threads = True
+
+    def __init__(self, server_address, size=1000, seed=0, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500,
+                 throttle_rate=0.0, retry_after=1, max_concurrency=None, page_size=server_page_size, csrf_token_ttl=None):
+        super().__init__(server_address, FakeRequestHandler)
+        self.c4c = FakeC4C(size=size, seed=seed, page_size=page_size, csrf_token_ttl=csrf_token_ttl)
+        self.eloqua = FakeEloqua(size=size, seed=seed)
+        # seconds
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.max_concurrency = max_concurrency
+        self.rng = random.Random(seed)
+        # serializes access to the datasets, latency is spent outside of it
+        self.data_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.reset_stats()
+
+    @property
+    def c4c_base_url(self):
+        return "http://{0}:{1}{2}".format(self.server_address[0], self.server_address[1], c4c_root)
+
+    @property
+    def eloqua_base_url(self):
+        return "http://{0}:{1}".format(self.server_address[0], self.server_address[1])
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"requests": dict(), "injected_errors": 0, "throttled": 0, "max_in_flight": 0}
+        with self.data_lock:
+            self.c4c.entries.clear()
+            self.c4c.batch_operations.clear()
+
+    def get_stats(self):
+        '''
+        :return: dict of requests per entity, entries served per collection, $batch operations,
+        injected errors, throttled requests and the most requests in flight at a time
+        '''
+        with self.stats_lock, self.data_lock:
+            return {**json.loads(json.dumps(self.stats)), "entries": dict(self.c4c.entries),
+                    "batch_operations": dict(self.c4c.batch_operations)}
+
+    def count(self, key, stat="requests"):
+        with self.stats_lock:
+            if stat == "requests":
+                self.stats["requests"][key] = self.stats["requests"].get(key, 0) + 1
+            else:
+                self.stats[stat] += 1
+
+    def enter(self):
+        '''
+        Count a request in flight, and pick an injected failure for it
+        :return: tuple of status code and headers of the failure, or None to answer the request
+        '''
+        with self.stats_lock:
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.in_flight)
+            over_limit = self.max_concurrency is not None and self.in_flight > self.max_concurrency
+            draw = self.rng.random()
+        if over_limit or draw < self.throttle_rate:
+            self.count(key=None, stat="throttled")
+            return 429, {"Retry-After": str(self.retry_after)}
+        if draw < self.throttle_rate + self.error_rate:
+            self.count(key=None, stat="injected_errors")
+            return self.error_status, dict()
+        return None
+
+    def leave(self):
+        with self.stats_lock:
+            self.in_flight -= 1
+
+    def wait(self):
+        delay = self.latency + (self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, as the clients reuse connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("Fake server: " + format % args)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_PATCH(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def do_MERGE(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def send(self, status_code, headers, body):
+        self.send_response(status_code)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", None) or 0))
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        host_url = "http://{0}".format(self.headers.get("Host", None) or "{0}:{1}".format(*self.server.server_address))
+
+        if url.path == "/_fake/stats":
+            return self.send(200, {"Content-Type": "application/json"}, json.dumps(self.server.get_stats()).encode())
+        if url.path == "/_fake/reset":
+            self.server.reset_stats()
+            return self.send(204, dict(), b"")
+
+        eloqua_match = eloqua_root.match(url.path)
+        if url.path.startswith(c4c_root):
+            path = url.path[len(c4c_root):]
+            key = "C4C {0} {1}".format(self.command, re.sub(r"\('[^']*'\)", "", path.split("/")[0]) or "/")
+            if path.endswith("/$count"):
+                key += "/$count"
+        elif eloqua_match:
+            key = "Eloqua {0} {1}".format(self.command, re.sub(r"/\d+$", "", eloqua_match.group(1).strip("/")))
+        else:
+            return self.send(404, {"Content-Type": "text/plain"}, b"Not found")
+        self.server.count(key=key)
+
+        failure = self.server.enter()
+        try:
+            self.server.wait()
+            if failure:
+                status_code, headers_ = failure
+                return self.send(status_code, {"Content-Type": "text/plain", **headers_},
+                                 HTTPStatus(status_code).phrase.encode())
+            with self.server.data_lock:
+                if eloqua_match:
+                    status_code, response_headers, response_body = self.server.eloqua.handle(
+                        method=self.command, path=eloqua_match.group(1), query=query, body=body)
+                else:
+                    try:
+                        status_code, response_headers, response_body = self.server.c4c.handle(
+                            method="GET" if self.command == "HEAD" else self.command, path=path, query=query,
+                            headers=headers, body=body, host_url=host_url)
+                    except ValueError as e:
+                        status_code, response_headers, response_body = self.server.c4c.error_response(
+                            status_code=400, message=str(e))
+            self.send(status_code, response_headers, response_body)
+        finally:
+            self.server.leave()
+
+
+def start_fake_server(host="127.0.0.1", port=0, **kwargs):
+    '''
+    Start a FakeServer in a background thread
+    :param port: 0 to pick a free port
+    :param kwargs: options of FakeServer
+    :return: FakeServer, stop it with shutdown()
+    '''
+    server = FakeServer(server_address=(host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.debug("Fake server listening with C4C_BASE_URL={0} and ELQ_BASE_URL={1}".format(server.c4c_base_url,
+                                                                                          server.eloqua_base_url))
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the C4C OData and Eloqua REST APIs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--size", type=int, default=1000, help="number of leads, other entities are sized from it")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds the latency varies by, up or down")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="share of requests answered with error_status")
+    parser.add_argument("--error_status", type=int, default=500)
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry_after", type=int, default=1, help="Retry-After of throttled responses in seconds")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="requests in flight beyond it get 429")
+    parser.add_argument("--page_size", type=int, default=server_page_size)
+    parser.add_argument("--csrf_token_ttl", type=float, default=None, help="seconds until a CSRF token is rejected")
+    args = parser.parse_args()
+    fake_server = FakeServer(server_address=(args.host, args.port), size=args.size, seed=args.seed,
+                             latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                             error_status=args.error_status, throttle_rate=args.throttle_rate,
+                             retry_after=args.retry_after, max_concurrency=args.max_concurrency,
+                             page_size=args.page_size, csrf_token_ttl=args.csrf_token_ttl)
+    logger.debug("Fake server listening with C4C_BASE_URL={0} and ELQ_BASE_URL={1}".format(fake_server.c4c_base_url,
+                                                                                          fake_server.eloqua_base_url))
+    try:
+        fake_server.serve_forever()
+    except KeyboardInterrupt:
+        fake_server.server_close()
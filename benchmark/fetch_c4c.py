@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+
+from c4c import c4c_config
+from c4c.c4c_client import C4CClient
+from logging_config import setup_logging
+from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL, C4C_MAX_IN_FLIGHT
+
+logger = setup_logging(__name__)
+
+
+def fetch_pages(types, date_from, page_size=c4c_config.page_size):
+    '''
+    Fetch C4C collections page by page with C4CClient, as db_loader does, without writing them to DB
+    :param types: data types of the collections
+    :param date_from: get data changed after given date
+    :param page_size: number of entries to ask for per request
+    :return: dict of type: number of entries fetched
+    '''
+    client = C4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL)
+    counts = dict()
+    with client.start_requests_session() as session:
+        for type in types:
+            counts[type] = 0
+            for page in client.get_data_pages(session_=session, type=type, date_from=date_from, page_size=page_size):
+                counts[type] += len(page)
+    return counts
+
+
+async def fetch_pages_async(types, date_from, page_size=c4c_config.page_size):
+    '''
+    Fetch C4C collections page by page with AsyncC4CClient, see fetch_pages
+    '''
+    from c4c.c4c_async_client import AsyncC4CClient
+
+    client = AsyncC4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL,
+                            max_in_flight=C4C_MAX_IN_FLIGHT)
+    counts = dict()
+    async with client.start_requests_session() as session:
+        for type in types:
+            counts[type] = 0
+            async for page in client.get_data_pages(session_=session, type=type, date_from=date_from,
+                                                    page_size=page_size):
+                counts[type] += len(page)
+    return counts
+
+
+if __name__ == "__main__":
+    # measures the C4C client alone, e.g. the peak memory of reading collections, with neither DB nor Eloqua
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--types", nargs="+", default=["contact", "account", "lead", "tg", "tgm"])
+    parser.add_argument("--date_from", default="2000-01-01T00:00:00Z")
+    parser.add_argument("--page_size", type=int, default=c4c_config.page_size)
+    args = parser.parse_args()
+    if C4C_MAX_IN_FLIGHT > 1:
+        fetched_counts = asyncio.run(fetch_pages_async(types=args.types, date_from=args.date_from,
+                                                       page_size=args.page_size))
+    else:
+        fetched_counts = fetch_pages(types=args.types, date_from=args.date_from, page_size=args.page_size)
+    logger.debug("Fetched {0} entries from C4C".format(fetched_counts))
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import platform
+import runpy
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from environs import Env
+
+from benchmark.fake_server import start_fake_server
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (stage, module run as __main__, args), in the order they run for each dataset
+stages = [("reset_tables", "db.tables_init", []),
+          # the C4C client alone, without DB and Eloqua
+          ("fetch_c4c", "benchmark.fetch_c4c", []),
+          ("db_loader_first_run", "db_loader", ["--first_run", "1"]),
+          ("db_loader_lead_first_run", "db_loader_lead", ["--first_run", "1"]),
+          ("db_loader", "db_loader", []),
+          ("db_loader_lead", "db_loader_lead", []),
+          ("seed_pending_leads", None, []),
+          ("import_c4c", "import_c4c", [])]
+
+
+def run_stage(module, argv, stage_output):
+    '''
+    Run a pipeline script as __main__ in this process, counting the SQL statements it issues,
+    and write the counts and the peak RSS of the process to stage_output as JSON
+    :param module: module of the script, None to seed pending leads
+    :param argv: args of the script
+    :param stage_output: path of the JSON file
+    :return: None
+    '''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    counts = {"statements": 0, "executemany_statements": 0, "executemany_rows": 0}
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        counts["statements"] += 1
+        if executemany:
+            counts["executemany_statements"] += 1
+            counts["executemany_rows"] += len(parameters)
+
+    try:
+        if module:
+            sys.argv = [module] + argv
+            runpy.run_module(module, run_name="__main__", alter_sys=True)
+        else:
+            seed_pending_leads(share=float(argv[0]) if argv else 0.1)
+    finally:
+        with open(stage_output, "w") as f:
+            json.dump({"sql": counts, "peak_rss_mb": get_peak_rss_mb()}, f)
+
+
+def get_peak_rss_mb():
+    '''
+    Peak RSS of this process, from VmHWM in /proc on Linux.
+    ru_maxrss of the stage process is not used, as Linux also counts in it the memory of the harness process
+    it was forked from, which holds the data of the fake server
+    :return: peak RSS in MB, None if not available
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def seed_pending_leads(share):
+    '''
+    Make a share of the leads loaded from C4C pending updates, and add as many pending new leads,
+    so that import_c4c has leads to Patch and to Post
+    :param share: share of the leads in DB
+    :return: None
+    '''
+    from sqlalchemy import func
+
+    from db.db_crud import start_psql_session
+    from db.tables_init import Lead
+
+    with start_psql_session() as session:
+        lead_count = session.query(func.count(Lead.TableID)).scalar()
+        count = int(lead_count * share)
+        table_ids = [row[0] for row in session.query(Lead.TableID)
+                     .filter(Lead.C_SAP_Lead_ID1 != None, Lead.URI != None, Lead.ContactUUID != None)
+                     .order_by(Lead.TableID).limit(count).all()]
+        session.query(Lead).filter(Lead.TableID.in_(table_ids)).update(
+            {Lead.C_SFDC___Lead_Record_Type_ID1: "Z103", Lead.C_Company: "Benchmark Company", Lead.C_Country: "FI",
+             Lead.C_EmailAddress: func.coalesce(Lead.C_EmailAddress, "benchmark@example.com"),
+             Lead.C4C_Task_Name: "update_leads", Lead.C4C_Status: "pending"}, synchronize_session=False)
+        session.bulk_insert_mappings(Lead, [{"C_SFDC___Lead_Record_Type_ID1": "Z103",
+                                             "C_SFDC___Lead_Name1": "Benchmark Lead {0}".format(i),
+                                             "C_Company": "Benchmark Company {0}".format(i),
+                                             "C_Country": "FI",
+                                             "C_EmailAddress": "benchmark{0}@example.com".format(i),
+                                             "C_EML_GROUP_Professional1": "1" if i % 2 else "0",
+                                             "C4C_Task_Name": "create_leads",
+                                             "C4C_Status": "pending"} for i in range(count)])
+    logger.debug("Seeded {0} pending updated leads and {1} pending new leads".format(len(table_ids), count))
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_dataset(size, args, run_dir):
+    '''
+    Run all stages against a fake server with a dataset of size leads
+    :return: list of results of the stages
+    '''
+    server = start_fake_server(size=size, seed=args.seed, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                               retry_after=args.retry_after, max_concurrency=args.max_concurrency)
+    env = dict(os.environ)
+    env.update({"C4C_BASE_URL": server.c4c_base_url, "C4C_USER": "benchmark", "C4C_PASSWORD": "benchmark",
+                "ELQ_BASE_URL": server.eloqua_base_url, "ELQ_USER": "benchmark", "ELQ_PASSWORD": "benchmark",
+                "C4C_MAX_IN_FLIGHT": str(args.max_in_flight)})
+    results = []
+    try:
+        for stage, module, stage_args in stages:
+            if args.stages and stage not in args.stages:
+                continue
+            if module is None:
+                stage_args = [str(args.pending_share)]
+            stage_output = os.path.join(run_dir, "{0}_{1}.json".format(size, stage))
+            command = [sys.executable, "-m", "benchmark.run_benchmark", "--run_stage", module or "",
+                       "--stage_output", stage_output, "--"] + stage_args
+            server.reset_stats()
+            logger.debug("Run stage {0} with {1} leads".format(stage, size))
+            with open(os.path.join(run_dir, "{0}_{1}.log".format(size, stage)), "w") as log_file:
+                started_at = time.perf_counter()
+                process = subprocess.Popen(command, cwd=repo_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+                # wait4 gives the resource usage of this child alone
+                _, status, rusage = os.wait4(process.pid, 0)
+                wall_time = time.perf_counter() - started_at
+            process.returncode = os.waitstatus_to_exitcode(status)
+            stage_result = dict()
+            if os.path.exists(stage_output):
+                with open(stage_output) as f:
+                    stage_result = json.load(f)
+            sql = stage_result.get("sql", dict())
+            stats = server.get_stats()
+            entries = sum(stats["entries"].values())
+            writes = sum(count for key, count in stats["requests"].items()
+                         if key.split(" ")[1] in ("POST", "PATCH", "PUT", "DELETE") and "$batch" not in key)
+            writes += sum(stats["batch_operations"].values())
+            result = {"stage": stage,
+                      "exit_code": process.returncode,
+                      "wall_time_s": round(wall_time, 3),
+                      # ru_maxrss is in KB on Linux, and includes the harness process, see get_peak_rss_mb
+                      "peak_rss_mb": stage_result.get("peak_rss_mb", None) or round(rusage.ru_maxrss / 1024, 1),
+                      "requests": stats["requests"],
+                      "requests_total": sum(stats["requests"].values()),
+                      "batch_operations": stats["batch_operations"],
+                      "entries_read": stats["entries"],
+                      "sql": sql,
+                      "throughput": {"entries_read_per_s": round(entries / wall_time, 1) if wall_time else None,
+                                     "writes_per_s": round(writes / wall_time, 1) if wall_time else None,
+                                     "requests_per_s": round(sum(stats["requests"].values()) / wall_time, 1)
+                                     if wall_time else None},
+                      "throttled": stats["throttled"],
+                      "injected_errors": stats["injected_errors"],
+                      "max_in_flight": stats["max_in_flight"]}
+            results.append(result)
+            logger.debug("Stage {0} with {1} leads took {2}s with {3} requests and {4} SQL statements".format(
+                stage, size, result["wall_time_s"], result["requests_total"], sql.get("statements", None)))
+            if process.returncode != 0:
+                logger.debug("Stage {0} failed with exit code {1}, see its log in {2}".format(stage, process.returncode,
+                                                                                              run_dir))
+                break
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def compare(results, baseline):
+    '''
+    Log wall time, peak RSS, requests and SQL statements of each stage against a baseline result file
+    :return: None
+    '''
+    baseline_stages = {(dataset["size"], stage["stage"]): stage
+                       for dataset in baseline["datasets"] for stage in dataset["stages"]}
+    for dataset in results["datasets"]:
+        for stage in dataset["stages"]:
+            before = baseline_stages.get((dataset["size"], stage["stage"]), None)
+            if not before:
+                continue
+            logger.debug("{0} leads, {1}: wall time {2}s -> {3}s, peak RSS {4}MB -> {5}MB, requests {6} -> {7}, "
+                         "SQL statements {8} -> {9}".format(
+                dataset["size"], stage["stage"], before["wall_time_s"], stage["wall_time_s"], before["peak_rss_mb"],
+                stage["peak_rss_mb"], before["requests_total"], stage["requests_total"],
+                before["sql"].get("statements", None), stage["sql"].get("statements", None)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark db_loader, db_loader_lead and import_c4c end to end "
+                                                 "against the local Postgres of DB_* settings and a fake C4C and Eloqua server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="numbers of leads")
+    parser.add_argument("--stages", nargs="+", default=None, help="stages to run, default all: " +
+                                                                  ", ".join(stage[0] for stage in stages))
+    parser.add_argument("--pending_share", type=float, default=0.1,
+                        help="share of the leads to Patch, and as many new leads to Post, with import_c4c")
+    parser.add_argument("--max_in_flight", type=int, default=1, help="C4C_MAX_IN_FLIGHT of import_c4c")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response of the fake server")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--throttle_rate", type=float, default=0.0)
+    parser.add_argument("--retry_after", type=int, default=1)
+    parser.add_argument("--max_concurrency", type=int, default=None)
+    parser.add_argument("--output_dir", default=os.path.join(repo_dir, "benchmark", "results"))
+    parser.add_argument("--compare", default=None, help="result file of an earlier run to compare with")
+    parser.add_argument("--allow_remote_db", action="store_true", help="run even if DB_HOST_NAME is not local")
+    # used by the harness to run one stage in a child process
+    parser.add_argument("--run_stage", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--stage_output", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("stage_args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage_output:
+        run_stage(module=args.run_stage or None, argv=args.stage_args, stage_output=args.stage_output)
+        sys.exit(0)
+
+    # tables are dropped and created again for every dataset
+    env = Env()
+    env.read_env()
+    db_host = env("DB_HOST_NAME", "")
+    if db_host.split(":")[0] not in ("localhost", "127.0.0.1", "") and not args.allow_remote_db:
+        sys.exit("DB_HOST_NAME {0} is not local, its tables would be dropped, "
+                 "pass --allow_remote_db to run anyway".format(db_host))
+
+    started_at = datetime.utcnow()
+    run_dir = os.path.join(args.output_dir, started_at.strftime("%Y%m%dT%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+    # the pipelines log to logs/ as configured in logging.json
+    os.makedirs(os.path.join(repo_dir, "logs"), exist_ok=True)
+    results = {"started_at_utc": started_at.isoformat(),
+               "git_commit": get_git_commit(),
+               "python": platform.python_version(),
+               "options": {key: value for key, value in vars(args).items()
+                           if key not in ("run_stage", "stage_output", "stage_args")},
+               "datasets": []}
+    for size in args.sizes:
+        results["datasets"].append({"size": size, "stages": run_dataset(size=size, args=args, run_dir=run_dir)})
+        # keep what was measured so far if a later dataset fails
+        with open(os.path.join(run_dir, "results.json"), "w") as f:
+            json.dump(results, f, indent=2)
+    logger.debug("Benchmark results saved to {0}".format(os.path.join(run_dir, "results.json")))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results=results, baseline=json.load(f))
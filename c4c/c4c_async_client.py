@@ -0,0 +1,273 @@
+import asyncio
+import base64
+import json
+from collections import defaultdict
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+
+import aiohttp
+from requests.structures import CaseInsensitiveDict
+from yarl import URL
+
+try:
+    import ijson
+except ImportError:
+    # fall back to decoding whole responses
+    ijson = None
+
+from c4c import c4c_config
+from c4c.c4c_batch import BatchPartResponse
+from c4c.c4c_client import C4CClient, retry_status_codes
+from c4c.c4c_rate_limiter import AdaptiveLimiter
+import http_session
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+
+class AsyncResponse(BatchPartResponse):
+    '''
+    Response read in full from aiohttp, with the same attributes as requests.Response that are used by C4CClient
+    '''
+
+
+class AsyncC4CClient(C4CClient):
+    '''
+    C4CClient on asyncio and aiohttp, with the same public methods as coroutines.
+    Independent leads are posted concurrently, with requests in flight bounded by an AdaptiveLimiter
+    that starts at max_in_flight and adapts to C4C throttling,
+    while the requests of one lead (create, owner, permission check, permission, Z03) keep their order.
+    Only how requests are sent differs: the methods of C4CClient made with steps run on the coroutines of run_steps.
+    '''
+    def __init__(self, username, password, base_url, max_in_flight=c4c_config.max_in_flight):
+        super().__init__(username=username, password=password, base_url=base_url)
+        self.max_in_flight = max_in_flight
+        # sent with every request of the session
+        self.authorization = "Basic " + base64.b64encode("{0}:{1}".format(username, password).encode("latin1")).decode()
+        self.limiter = AdaptiveLimiter(limit=max_in_flight)
+        self.limiter_condition = None
+        self.csrf_token_lock = None
+        self.contact_locks = None
+        # event loop of start_blocking_session
+        self.loop = None
+
+    # manage aiohttp session
+    @asynccontextmanager
+    async def start_requests_session(self):
+        session = aiohttp.ClientSession(headers={"Authorization": self.authorization},
+                                        connector=aiohttp.TCPConnector(limit=self.max_in_flight),
+                                        timeout=aiohttp.ClientTimeout(connect=http_session.connect_timeout,
+                                                                      sock_read=http_session.read_timeout))
+        self.csrf_token = None
+        self.csrf_token_lock = asyncio.Lock()
+        self.limiter_condition = asyncio.Condition()
+        # by ContactUUID in upper case, see run_steps
+        self.contact_locks = defaultdict(asyncio.Lock)
+        self.lookup_cache = dict()
+        try:
+            yield session
+        finally:
+            await session.close()
+
+    async def acquire_slot(self):
+        # wait until the limiter allows one more request in flight, and Retry-After has passed
+        async with self.limiter_condition:
+            await self.limiter_condition.wait_for(self.limiter.can_send)
+            send_number = self.limiter.on_send()
+        wait_time = self.limiter.wait_time()
+        if wait_time:
+            await asyncio.sleep(wait_time)
+        return send_number
+
+    async def release_slot(self, status_code, retry_after=None, send_number=None):
+        async with self.limiter_condition:
+            self.limiter.on_response(status_code=status_code, retry_after=retry_after, send_number=send_number)
+            self.limiter_condition.notify_all()
+
+    async def send_limited(self, session_, method, url, params=None, headers=None, data=None, retries=http_session.max_retries,
+                      read_content=None):
+        '''
+        Send a request through the rate limiter and read its whole body.
+        Throttled requests are sent again, as they were not processed, after Retry-After if given.
+        Idempotent requests are also retried with backoff on connection errors and on the other retry status codes of http_session
+        :param read_content: coroutine function that reads the body of a 200 aiohttp response as it streams in,
+            e.g. read_results, the body is read as bytes if not given
+        :return: AsyncResponse, with the content returned by read_content for a 200 response if given
+        '''
+        # aiohttp only takes str query values
+        params = {key: str(value) for key, value in params.items()} if params else None
+        if method not in http_session.retry_methods:
+            retries = 0
+        retry_number = 0
+        throttle_retry_number = 0
+        while True:
+            send_number = await self.acquire_slot()
+            try:
+                async with session_.request(method=method, url=url, params=params, headers=headers, data=data) as response:
+                    if read_content is not None and response.status == 200:
+                        content = await read_content(response)
+                    else:
+                        content = await response.read()
+                    response = AsyncResponse(status_code=response.status, headers=CaseInsensitiveDict(response.headers),
+                                             content=content)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                await self.release_slot(status_code=None, send_number=send_number)
+                if retry_number >= retries:
+                    raise
+                logger.debug("Error with {0} {1}: {2}".format(method, url, repr(e)))
+            else:
+                await self.release_slot(status_code=response.status_code,
+                                        retry_after=response.headers.get("Retry-After", None), send_number=send_number)
+                if self.limiter.is_throttled(response.status_code) and throttle_retry_number < c4c_config.max_throttle_retries:
+                    throttle_retry_number += 1
+                    logger.debug("C4C throttled {0} {1} with status code {2}, send again for the {3} time".format(
+                        method, url, response.status_code, throttle_retry_number))
+                    if not response.headers.get("Retry-After", None):
+                        await asyncio.sleep(http_session.get_backoff_time(retry_number=throttle_retry_number))
+                    continue
+                if response.status_code not in retry_status_codes or retry_number >= retries:
+                    return response
+            retry_number += 1
+            logger.debug("Retry {0} {1} for the {2} time".format(method, url, retry_number))
+            await asyncio.sleep(http_session.get_backoff_time(retry_number=retry_number))
+
+    async def get_token(self, session_, expired_token=None):
+        # leads in flight wait for one fetch instead of each fetching a token
+        async with self.csrf_token_lock:
+            if not self.csrf_token or self.csrf_token == expired_token:
+                if not self.use_shared_token(session_=session_, expired_token=expired_token):
+                    self.csrf_token = await self.get_csrf_token(session_=session_)
+                    self.keep_shared_token(session_=session_)
+            return self.csrf_token
+
+    def get_cookies(self, session_):
+        return {cookie.key: cookie.value for cookie in session_.cookie_jar}
+
+    def set_cookies(self, session_, cookies):
+        session_.cookie_jar.update_cookies(cookies, response_url=URL(self.base_url))
+
+    async def read_results(self, response, meta):
+        '''
+        Read the entries of a C4C collection response page by page, parsed as the body streams in if ijson is installed,
+        else from the whole body, see C4CClient.read_results
+        :param response: aiohttp response
+        :param meta: dict to fill with __count and __next of the response
+        :return: list of entries
+        '''
+        # a response read again after a connection error starts over
+        meta.clear()
+        if ijson is None:
+            return self.read_results_body(body=json.loads(await response.read()), meta=meta)
+        entries = []
+        async for key, value in ijson.kvitems_async(response.content, "d", use_float=True):
+            entries += self.read_results_item(key=key, value=value, meta=meta)
+        return entries
+
+    async def get_pages(self, session_, uri, params, page_size=c4c_config.page_size, type=None):
+        '''
+        Get results of a C4C collection page by page, with the paging of C4CClient.get_page_requests.
+        Responses are streamed into their entries, see read_results
+        :return: async generator of lists of entries, one list per response
+        '''
+        page_requests = self.get_page_requests(uri=uri, params=params, page_size=page_size, type=type)
+        url, params, seen_keys = next(page_requests)
+        while True:
+            meta = dict()
+            response = await self.send_limited(session_=session_, method="GET", url=url, params=params,
+                                               read_content=lambda response: self.read_results(response=response, meta=meta))
+            if response.status_code != 200:
+                # fail like a connection error, rather than taking the rest of the collection as empty
+                raise aiohttp.ClientPayloadError("Error status code {0} for Get {1} with text: {2}".format(
+                    response.status_code, url, response.text))
+            page_count = len(response.content)
+            # entries received by the previous page already are left out, see C4CClient.get_page_requests
+            results = [entry for entry in response.content
+                       if self.read_keyset_entry(entry=entry, meta=meta, seen_keys=seen_keys)]
+            if results:
+                yield results
+            try:
+                url, params, seen_keys = page_requests.send((page_count, meta))
+            except StopIteration:
+                return
+
+    async def get_data_pages(self, session_, type, date_from=None, page_size=c4c_config.page_size, date_to=None):
+        uri, params = self.get_collection_query(type=type, date_from=date_from, date_to=date_to)
+        async for page in self.get_pages(session_=session_, uri=uri, params=params, page_size=page_size, type=type):
+            if type == "emp":
+                await self.add_departments(session_=session_, data=page)
+            yield self.validate_data(type=type, data=page)
+
+    async def collect_pages(self, session_, method, params):
+        return [entry async for page in getattr(self, method)(session_=session_, **params) for entry in page]
+
+    async def post_lead_data(self, session_, data, batch_size=None):
+        '''
+        Post new leads and Patch existing leads to C4C, then create or update their marketing permissions,
+        with as many requests in flight as the rate limiter allows
+        :param session_: aiohttp session
+        :param data: leads formatted by pre_process_data_for_post
+        :param batch_size: number of leads to send per $batch request, send leads one by one if not given
+        :return: data with updated ID, URI, ContactUUID, OwnerPartyUUID and C4C_Status
+        '''
+        counts, tableid_to_inspect_more = self.new_post_lead_log()
+        # bounds the chunks started at a time, requests in flight are bounded by the rate limiter
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def post_lead_chunk(chunk):
+            async with in_flight:
+                try:
+                    await self.post_lead_chunk(session_=session_, leads=chunk, batch_size=batch_size,
+                                               counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+                # leads that cannot reach C4C keep the status they had got so far, "pending" if they were not sent,
+                # so that the other leads of the batch are still returned
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    table_ids = [lead["entry"].get("TableID", None) for lead in chunk]
+                    logger.debug("Error with leads with TableID {0}: {1}".format(table_ids, repr(e)))
+                    tableid_to_inspect_more["connection_error"] += table_ids
+
+        await asyncio.gather(*(post_lead_chunk(chunk) for chunk in self.get_lead_chunks(data=data, batch_size=batch_size)))
+        self.log_post_lead_data(counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+        return data
+
+    async def run_steps(self, session_, steps):
+        '''
+        Same as C4CClient.run_steps, awaiting the coroutines of the client.
+        Leads of one contact share its Marketing Permission, so from the check of the Marketing Permission on,
+        a lead holds its contact until it is done, and two leads of a contact do not both create one
+        '''
+        result = None
+        async with AsyncExitStack() as contact_lock:
+            while True:
+                try:
+                    method, params = steps.send(result)
+                except StopIteration as stop:
+                    return stop.value
+                if method == "check_if_mark_p_existed":
+                    await contact_lock.enter_async_context(self.contact_locks[str(params["contact_uuid"]).upper()])
+                result = await getattr(self, method)(session_=session_, **params)
+
+    @contextmanager
+    def start_blocking_session(self):
+        '''
+        Open an aiohttp session on an event loop of its own, for blocking code to post the leads of many batches
+        with run_post_lead_data, over the same connections, CSRF token and rate limiter
+        :return: aiohttp session
+        '''
+        self.loop = asyncio.new_event_loop()
+        session_context = self.start_requests_session()
+        session = self.loop.run_until_complete(session_context.__aenter__())
+        try:
+            yield session
+        finally:
+            self.loop.run_until_complete(session_context.__aexit__(None, None, None))
+            self.loop.close()
+            self.loop = None
+
+    def run_post_lead_data(self, session_, data, batch_size=None):
+        '''
+        Blocking entry point: post leads concurrently
+        :param session_: aiohttp session of start_blocking_session
+        :param data: leads formatted by pre_process_data_for_post
+        :param batch_size: number of leads to send per $batch request, send leads one by one if not given
+        :return: data with updated ID, URI, ContactUUID, OwnerPartyUUID and C4C_Status
+        '''
+        return self.loop.run_until_complete(self.post_lead_data(session_=session_, data=data, batch_size=batch_size))
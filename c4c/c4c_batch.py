@@ -0,0 +1,85 @@
+import json
+import re
+
+from requests.structures import CaseInsensitiveDict
+
+
+class BatchPartResponse:
+    '''
+    Response of one operation inside an OData $batch response,
+    with the same attributes as requests.Response that are used on single responses
+    '''
+    def __init__(self, status_code, headers, content, content_id=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.content_id = content_id
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+def get_boundary(content_type):
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary":
+            return value.strip("\"")
+    return None
+
+
+def split_headers(part):
+    '''
+    Split a MIME part or an HTTP message into its headers and body
+    :param part: bytes of the part
+    :return: tuple of header lines, headers as CaseInsensitiveDict and body as bytes
+    '''
+    separator = re.search(rb"\r?\n\r?\n", part)
+    head, body = (part[:separator.start()], part[separator.end():]) if separator else (part, b"")
+    headers = CaseInsensitiveDict()
+    lines = head.decode("latin-1").splitlines()
+    for line in lines:
+        if ":" in line:
+            key, _, value = line.partition(":")
+            headers[key.strip()] = value.strip()
+    return lines, headers, body
+
+
+def split_multipart(content, boundary):
+    delimiter = b"--" + boundary.encode()
+    parts = []
+    # skip the preamble before the first delimiter
+    for part in content.split(delimiter)[1:]:
+        # close delimiter
+        if part.startswith(b"--"):
+            break
+        parts.append(re.sub(rb"^\r?\n", b"", re.sub(rb"\r?\n$", b"", part, count=1), count=1))
+    return parts
+
+
+def parse_batch_response(content, content_type):
+    '''
+    Parse an OData $batch response into the responses of its operations, changesets are flattened
+    :param content: bytes of the $batch response body
+    :param content_type: Content-Type header of the $batch response
+    :return: list of BatchPartResponse in the order of the response
+    '''
+    result = []
+    boundary = get_boundary(content_type)
+    if not boundary:
+        return result
+    for part in split_multipart(content=content, boundary=boundary):
+        _, part_headers, part_body = split_headers(part)
+        part_content_type = part_headers.get("Content-Type", "")
+        if part_content_type.lower().startswith("multipart/mixed"):
+            result += parse_batch_response(content=part_body, content_type=part_content_type)
+            continue
+        lines, headers, body = split_headers(part_body)
+        status = re.match(r"HTTP/\d\.\d (\d{3})", lines[0]) if lines else None
+        if status:
+            result.append(BatchPartResponse(status_code=int(status.group(1)), headers=headers, content=body,
+                                            content_id=part_headers.get("Content-ID", None)))
+    return result
@@ -1,16 +1,49 @@
+import functools
+import hashlib
 import json
+import queue
 import re
-import xml.etree.ElementTree as ET
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from datetime import datetime, timezone
 
-from requests import Session
 from requests.structures import CaseInsensitiveDict
 
+try:
+    import ijson
+except ImportError:
+    # fall back to decoding whole responses
+    ijson = None
+
 from c4c import c4c_config
+from c4c.c4c_batch import parse_batch_response
+from c4c.c4c_rate_limiter import AdaptiveLimiter
+import http_session
 from logging_config import setup_logging
 
 logger = setup_logging(__name__)
 
+# throttled responses are sent again by send_limited, through the rate limiter, instead of by the session
+retry_status_codes = tuple(code for code in http_session.retry_status_codes
+                           if code not in c4c_config.throttle_status_codes)
+
+
+def steps(method):
+    '''
+    Make a generator method of the client, that yields the requests it needs as tuples of the name of a method
+    of the client and its params other than session_, into a method that takes session_ and sends them with run_steps.
+    The decisions of the method are so shared by the clients, which differ only in how requests are sent
+    :param method: generator method
+    :return: method returning what the generator returns, or a coroutine of it for AsyncC4CClient
+    '''
+    @functools.wraps(method)
+    def run(self, session_, **params):
+        return self.run_steps(session_=session_, steps=method(self, **params))
+    return run
+
 
 class C4CClient:
     def __init__(self, username, password, base_url):
@@ -27,12 +60,27 @@ class C4CClient:
         self.mark_p_uri = base_url + c4c_config.mark_p_c4c_uri
         self.emp_uri = base_url + c4c_config.emp_c4c_uri
         self.bus_p_uri = base_url + c4c_config.bus_p_uri
+        # expected total of each data type, reported by C4C along with the first page
+        self.expected_counts = dict()
+        # CSRF token of the current requests session, fetched on the first write
+        self.csrf_token = None
+        # CSRF token and session cookies shared with the other clients of the run, see share_token
+        self.shared_token = None
+        # results of lookups in the current requests session, keyed by (entity, key)
+        self.lookup_cache = dict()
+        # adapts to C4C throttling, kept across sessions of the client
+        self.limiter = AdaptiveLimiter()
+        # signalled when a request leaves the limiter, for the threads waiting for a slot
+        self.limiter_condition = threading.Condition()
 
     # manage requests session
     @contextmanager
     def start_requests_session(self):
-        session = Session()
-        session.auth = (self.username, self.password)
+        session = self.create_session()
+        # a CSRF token is only valid for the session that fetched it
+        self.csrf_token = None
+        # lookups are only reused within one run
+        self.lookup_cache = dict()
         try:
             yield session
         except Exception:
@@ -40,34 +88,165 @@ class C4CClient:
         finally:
             session.close()
 
-    def get_csrf_token(self, session_):
+    def create_session(self):
+        return http_session.create_session(auth=(self.username, self.password), status_codes=retry_status_codes)
+
+    @steps
+    def get_csrf_token(self):
         headers = CaseInsensitiveDict({"x-csrf-token": "fetch"})
-        response_headers = session_.get(url=self.base_url, headers=headers).headers
+        response_headers = (yield "send_limited", dict(method="GET", url=self.base_url, headers=headers)).headers
         if "x-csrf-token" in response_headers:
             return response_headers["x-csrf-token"]
         else:
             return None
 
-    def get_data_count(self, session_, type):
-        if type == "account":
-            return session_.get(url=self.account_uri + "/$count").json()
-        if type == "contact":
-            return session_.get(url=self.contact_uri + "/$count").json()
-        if type == "lead":
-            return session_.get(url=self.lead_uri + "/$count").json()
-        if type == "mp":
-            return session_.get(url=self.m_permission_uri + "/$count").json()
-        if type == "tg":
-            return session_.get(url=self.target_gr_uri + "/$count").json()
-        if type == "tgm":
-            return session_.get(url=self.target_gr_m_uri + "/$count").json()
-        if type == "mp":
-            return session_.get(url=self.mark_p_uri + "/$count").json()
-        if type == "emp":
-            return session_.get(url=self.emp_uri + "/$count").json()
-        if type == "bp":
-            return session_.get(url=self.bus_p_uri + "/$count").json()
-        return None
+    def get_token(self, session_, expired_token=None):
+        '''
+        Get the CSRF token of the session, fetched once and reused by all writes
+        :param session_: request session
+        :param expired_token: token rejected by C4C, a new one is fetched if it is still the cached one
+        :return: CSRF token or None
+        '''
+        if not self.csrf_token or self.csrf_token == expired_token:
+            if not self.use_shared_token(session_=session_, expired_token=expired_token):
+                self.csrf_token = self.get_csrf_token(session_=session_)
+                self.keep_shared_token(session_=session_)
+        return self.csrf_token
+
+    def share_token(self, client):
+        '''
+        Share the CSRF token with another client of the same user, so that the token fetched by the first write
+        of either client is used by both, along with the session cookies C4C binds it to
+        :param client: C4CClient or AsyncC4CClient
+        '''
+        self.shared_token = client.shared_token = self.shared_token or client.shared_token or dict()
+
+    def use_shared_token(self, session_, expired_token=None):
+        '''
+        Use the CSRF token fetched by another client, if it is neither the token of the session nor the expired one
+        :return: True if the shared token is used
+        '''
+        token = (self.shared_token or dict()).get("csrf_token", None)
+        if not token or token in (self.csrf_token, expired_token):
+            return False
+        self.set_cookies(session_=session_, cookies=self.shared_token["cookies"])
+        self.csrf_token = token
+        return True
+
+    def keep_shared_token(self, session_):
+        if self.shared_token is not None and self.csrf_token:
+            self.shared_token.update(csrf_token=self.csrf_token, cookies=self.get_cookies(session_=session_))
+
+    def get_cookies(self, session_):
+        return session_.cookies.get_dict()
+
+    def set_cookies(self, session_, cookies):
+        session_.cookies.update(cookies)
+
+    def is_csrf_token_rejected(self, response):
+        return response.status_code == 403 and response.headers.get("x-csrf-token", "").lower() == "required"
+
+    @steps
+    def write(self, method, url, headers=None, data=None):
+        '''
+        Send a modifying request with the CSRF token of the session,
+        if C4C rejects the token, fetch a new one and send the request once again
+        :param method: POST, PATCH, PUT or DELETE
+        :param url: URL
+        :param headers: headers other than x-csrf-token
+        :param data: body
+        :return: response
+        '''
+        headers = CaseInsensitiveDict(headers or {})
+        token = yield "get_token", dict()
+        headers["x-csrf-token"] = token or ""
+        response = yield "send_limited", dict(method=method, url=url, headers=headers, data=data)
+        if self.is_csrf_token_rejected(response=response):
+            logger.debug("CSRF token rejected for {0} {1}, fetch a new token and try again".format(method, url))
+            headers["x-csrf-token"] = (yield "get_token", dict(expired_token=token)) or ""
+            response = yield "send_limited", dict(method=method, url=url, headers=headers, data=data)
+        return response
+
+    def acquire_slot(self):
+        # wait until the limiter allows one more request in flight, and Retry-After has passed
+        with self.limiter_condition:
+            self.limiter_condition.wait_for(self.limiter.can_send)
+            send_number = self.limiter.on_send()
+        wait_time = self.limiter.wait_time()
+        if wait_time:
+            time.sleep(wait_time)
+        return send_number
+
+    def release_slot(self, status_code, retry_after=None, send_number=None):
+        with self.limiter_condition:
+            self.limiter.on_response(status_code=status_code, retry_after=retry_after, send_number=send_number)
+            self.limiter_condition.notify_all()
+
+    def send_limited(self, session_, method, url, params=None, headers=None, data=None, stream=False):
+        '''
+        Send a request through the rate limiter, waiting until the limiter allows one more request in flight
+        and Retry-After of earlier throttled responses has passed, and send it again if C4C throttles it,
+        as a throttled request was not processed.
+        Reads and writes of all threads of the client go through it, so that the limiter sees all the load sent to C4C
+        :return: response
+        '''
+        retry_number = 0
+        while True:
+            send_number = self.acquire_slot()
+            try:
+                response = session_.request(method=method, url=url, params=params, headers=headers, data=data,
+                                            stream=stream)
+            except Exception:
+                self.release_slot(status_code=None, send_number=send_number)
+                raise
+            self.release_slot(status_code=response.status_code, retry_after=response.headers.get("Retry-After", None),
+                              send_number=send_number)
+            if not self.limiter.is_throttled(response.status_code) or retry_number >= c4c_config.max_throttle_retries:
+                return response
+            retry_number += 1
+            logger.debug("C4C throttled {0} {1} with status code {2}, send again for the {3} time".format(
+                method, url, response.status_code, retry_number))
+            # release the connection of a streamed response
+            response.close()
+            if not response.headers.get("Retry-After", None):
+                time.sleep(http_session.get_backoff_time(retry_number=retry_number))
+
+    def get_cached(self, entity, key):
+        '''
+        Get the result of a lookup made earlier in the current requests session
+        :param entity: looked up entity, e.g. mp, bp
+        :param key: key of the lookup, GUIDs in upper case
+        :return: tuple of whether the lookup was made, and its result
+        '''
+        return (entity, key) in self.lookup_cache, self.lookup_cache.get((entity, key), None)
+
+    def set_cached(self, entity, key, value):
+        self.lookup_cache[(entity, key)] = value
+
+    def get_uncached(self, entity, keys):
+        '''
+        Get keys not looked up yet in the current requests session
+        :param entity: looked up entity, e.g. mp, bp
+        :param keys: GUIDs
+        :return: list of GUIDs to look up
+        '''
+        return [key for key in keys if not self.get_cached(entity=entity, key=key.upper())[0]]
+
+    def set_not_found(self, entity, keys):
+        '''
+        Mark keys of a finished lookup as looked up without result, unless a result was cached for them,
+        so that keys of a lookup that failed are looked up again
+        :param entity: looked up entity, e.g. mp, bp
+        :param keys: GUIDs
+        :return: None
+        '''
+        for key in keys:
+            if not self.get_cached(entity=entity, key=key.upper())[0]:
+                self.set_cached(entity=entity, key=key.upper(), value=None)
+
+    def invalidate_cached(self, entity, key):
+        # after a write to the looked up entity, so that the next lookup gets it from C4C again
+        self.lookup_cache.pop((entity, key), None)
 
     def validate_data(self, type, data):
         if type == "contact":
@@ -81,7 +260,7 @@ class C4CClient:
                               "00163E34-9FE3-1ED7-B7FE-B6EBE5DA4C9B"]
             # duplicate UUID for Timo Virtanen, Egle Tooming, Claes Axelsson
             return [entry for entry in data if entry.get("UUID", None) not in duplicate_name]
-        return None
+        return data
 
     def format_c4c_date_time(self, date_time_string):
         if date_time_string:
@@ -104,93 +283,449 @@ class C4CClient:
             return date_time_string
         return None
 
-    def get_data(self, session_, type, count=None, date_from=None, leads_to_get_mps=None, leads_to_get_bps=None, existing_emps=None):
-        # common params
-        params = {"$format": "json",
-                  "$top": count,
-                  # filter for data changed after given date
-                  "$filter": "EntityLastChangedOn ge datetimeoffset'{0}'".format(date_from)}
-        if type == "contact":
-            params["$select"] = c4c_config.contact_c4c_fields
-            # validate valid contacts with emails
-            return self.validate_data(type=type,
-                                      data=session_.get(url=self.contact_uri, params=params).json().get("d", None).get("results", None))
-        if type == "account":
-            params["$select"] = c4c_config.account_c4c_fields
-            return session_.get(url=self.account_uri, params=params).json().get("d", None).get("results", None)
-        if type == "lead":
-            params["$select"] = c4c_config.lead_c4c_fields
-            # validate valid leads with emails
-            return self.validate_data(type=type,
-                                      data=session_.get(url=self.lead_uri, params=params).json().get("d", None).get("results", None))
-        if type == "tg":
-            params["$select"] = c4c_config.target_gr_c4c_fields
-            # validate valid target groups with names
-            return self.validate_data(type=type,
-                                      data=session_.get(url=self.target_gr_uri, params=params).json().get("d", None).get("results", None))
-        if type == "tgm":
-            tgm_params = {
-                "$format": "json",
-                "$top": count,
-                "$select": c4c_config.target_gr_m_c4c_fields
-            }
-            return session_.get(url=self.target_gr_m_uri, params=tgm_params).json().get("d", None).get("results", None)
+    @steps
+    def get_data(self, type, date_from=None, leads_to_get_mps=None, leads_to_get_bps=None, existing_emps=None,
+                 date_to=None):
+        # collections are fetched page by page, the expected total comes along with the first page
+        if type in ("contact", "account", "lead", "tg", "tgm", "emp"):
+            return (yield "collect_pages", dict(method="get_data_pages",
+                                                params=dict(type=type, date_from=date_from, date_to=date_to)))
         if type == "mp":
-            output = [{"BusinessPartnerUUID": lead["ContactUUID"]} for lead in leads_to_get_mps if lead.get("ContactUUID", None)]
-            if output:
-                for entry in output:
-                    z03_uri = self.check_if_mark_p_existed(session_=session_, contact_uuid=entry["BusinessPartnerUUID"])
-                    # if Marketing Permission not existed
-                    if not z03_uri and isinstance(z03_uri, bool):
-                        entry["BusinessPartner_ID"] = None
-                        entry["GeneralConsent"] = None
-                    # if Z03 Channel Permisison existed
-                    elif z03_uri and isinstance(z03_uri, str):
-                        params = {"$format": "json",
-                                  "$filter": "BusinessPartnerUUID eq guid'{0}'".format(entry["BusinessPartnerUUID"])}
-                        entry["BusinessPartner_ID"] = session_.get(url=self.mark_p_uri, params=params).json().get("d", None).get("results", None)[0].get("BusinessPartner_ID")
-                        entry["GeneralConsent"] = session_.get(url=z03_uri, params={"$format": "json"}).json().get("d", None).get("results", None).get("Consent", None)
-                    # if Z03 Channel Permisison not existed, but Marketing Permission existed
-                    else:
-                        params = {"$format": "json",
-                                  "$filter": "BusinessPartnerUUID eq guid'{0}'".format(entry["BusinessPartnerUUID"])}
-                        entry["BusinessPartner_ID"] = session_.get(url=self.mark_p_uri, params=params).json().get("d", None).get("results", None)[0].get("BusinessPartner_ID")
-                        entry["GeneralConsent"] = None
-                return output
+            contact_uuids = [lead["ContactUUID"] for lead in leads_to_get_mps if lead.get("ContactUUID", None)]
+            if contact_uuids:
+                # Marketing Permissions of all leads, with their BusinessPartner_ID and Z03 consent,
+                # come in a few chunked requests
+                mark_ps = yield "get_mark_ps", dict(contact_uuids=contact_uuids)
+                return self.format_lead_mark_ps(contact_uuids=contact_uuids, mark_ps=mark_ps)
             return None
-        if type == "emp":
-            params["$select"] = c4c_config.emp_c4c_fields
-            response = session_.get(url=self.emp_uri, params=params).json().get("d", None).get("results", None)
-            for entry in response:
-                org_params = {"$format": "json",
-                              "$select": c4c_config.org_unit_c4c_fields}
-                org = session_.get(
-                    url=entry.get("EmployeeOrganisationalUnitAssignment", None).get("__deferred", None).get("uri", None),
-                    params=org_params).json().get("d", None).get("results", None)
-                for chan_type in org:
-                    entry["Department"] = chan_type.get("OrgUnitID", None)
-                entry.pop("EmployeeOrganisationalUnitAssignment", None)
-            return self.validate_data(type="emp", data=response)
         if type == "bp":
-            existing_emp_uuids = [entry[1] for entry in existing_emps]
-            existing_emp_names = [entry[0] for entry in existing_emps]
-            output = [{"UUID": lead["OwnerPartyUUID"]} for lead in leads_to_get_bps if lead.get("OwnerPartyUUID", None) and
-                      lead.get("OwnerPartyUUID", None) not in existing_emp_uuids]
-            output = list(map(dict, set(tuple(sorted(entry.items())) for entry in output)))
-            if output:
-                params.pop("$top", None)
-                params["$select"] = c4c_config.bus_p_fields
-                for entry in output:
-                    params["$filter"] = "BusinessPartnerUUID eq guid'{0}'".format(entry["UUID"])
-                    response = session_.get(url=self.bus_p_uri, params=params).json().get("d", None).get("results", None)[0]
-                    if response.get("ThingType", None) == "COD_PARTNERCONTACT_TT" and \
-                            response.get("Name", None) and \
-                            response.get("Name", None) not in existing_emp_names:
-                        entry["Name"] = response.get("Name", None)
-                    else:
-                        output.remove(entry)
-                return output
+            owner_uuids, existing_emp_names = self.get_owner_uuids_to_resolve(leads_to_get_bps=leads_to_get_bps,
+                                                                              existing_emps=existing_emps)
+            if owner_uuids:
+                # owners looked up earlier in the run are not requested again
+                uuids_to_get = self.get_uncached(entity="bp", keys=owner_uuids)
+                if uuids_to_get:
+                    yield "look_up_in_chunks", dict(uri=self.bus_p_uri, params=self.get_bus_ps_params(),
+                                                    key_field="BusinessPartnerUUID", keys=uuids_to_get, type="bp",
+                                                    entity="bp", cache_entry=self.cache_bus_p)
+                return self.format_cached_bus_ps(owner_uuids=owner_uuids, existing_emp_names=existing_emp_names)
+            return None
+
+    def collect_pages(self, session_, method, params):
+        '''
+        Get all entries of a method of the client that gets them page by page, e.g. get_data_pages or get_pages
+        :param session_: request session
+        :param method: name of the method
+        :param params: its params other than session_
+        :return: list of entries
+        '''
+        return [entry for page in getattr(self, method)(session_=session_, **params) for entry in page]
+
+    def format_lead_mark_ps(self, contact_uuids, mark_ps):
+        '''
+        :param contact_uuids: ContactUUIDs of leads
+        :param mark_ps: dict of ContactUUID and its Marketing Permission, see get_mark_ps
+        :return: list of dicts of BusinessPartnerUUID, BusinessPartner_ID and GeneralConsent, one per lead
+        '''
+        output = []
+        for contact_uuid in contact_uuids:
+            mark_p = mark_ps.get(contact_uuid, None)
+            output.append({"BusinessPartnerUUID": contact_uuid,
+                           "BusinessPartner_ID": mark_p["BusinessPartner_ID"] if mark_p else None,
+                           "GeneralConsent": mark_p["Z03Consent"] if mark_p else None})
+        return output
+
+    def get_owner_uuids_to_resolve(self, leads_to_get_bps, existing_emps):
+        '''
+        Get distinct lead owners that are not known employees yet
+        :param leads_to_get_bps: leads
+        :param existing_emps: (Name, EmployeeID) of employees in DB
+        :return: tuple of OwnerPartyUUIDs to resolve, and set of existing employee names
+        '''
+        # sets for constant time membership checks
+        existing_emp_uuids = set(entry[1] for entry in existing_emps)
+        existing_emp_names = set(entry[0] for entry in existing_emps)
+        owner_uuids = list(dict.fromkeys(lead["OwnerPartyUUID"] for lead in leads_to_get_bps
+                                         if lead.get("OwnerPartyUUID", None) and
+                                         lead.get("OwnerPartyUUID", None) not in existing_emp_uuids))
+        return owner_uuids, existing_emp_names
+
+    def get_bus_ps_params(self):
+        return {"$format": "json",
+                "$select": c4c_config.bus_p_fields}
+
+    def cache_bus_p(self, bus_p):
+        # C4C may return GUIDs in another case than given
+        self.set_cached(entity="bp", key=str(bus_p.get("BusinessPartnerUUID", None)).upper(), value=bus_p)
+
+    def format_cached_bus_ps(self, owner_uuids, existing_emp_names):
+        # business partners of owners were all looked up earlier in the run, those not found are cached without result
+        bus_ps = [self.get_cached(entity="bp", key=uuid_.upper())[1] for uuid_ in owner_uuids]
+        return self.format_bus_ps(bus_ps=[bus_p for bus_p in bus_ps if bus_p], owner_uuids=owner_uuids,
+                                  existing_emp_names=existing_emp_names)
+
+    def format_bus_ps(self, bus_ps, owner_uuids, existing_emp_names):
+        '''
+        Keep business partners that are partner contacts with a name not known as an employee yet
+        :param bus_ps: business partners as returned by C4C
+        :param owner_uuids: OwnerPartyUUIDs they were resolved for
+        :param existing_emp_names: names of employees in DB
+        :return: list of dicts of UUID and Name
+        '''
+        # C4C may return GUIDs in another case than given
+        owner_uuids_by_upper = {uuid_.upper(): uuid_ for uuid_ in owner_uuids}
+        output = []
+        for response in bus_ps:
+            owner_uuid = owner_uuids_by_upper.get(str(response.get("BusinessPartnerUUID", None)).upper(), None)
+            if owner_uuid and \
+                    response.get("ThingType", None) == "COD_PARTNERCONTACT_TT" and \
+                    response.get("Name", None) and \
+                    response.get("Name", None) not in existing_emp_names:
+                output.append({"UUID": owner_uuid, "Name": response.get("Name", None)})
+                # resolve each owner once
+                owner_uuids_by_upper.pop(owner_uuid.upper())
+        return output
+
+    @steps
+    def add_departments(self, data):
+        '''
+        Set Department of each employee from its organisational unit assignment,
+        expanded inline by get_data_pages, or followed with a request if C4C left it deferred
+        :param data: employees as returned by C4C
+        :return: None
+        '''
+        for entry in data:
+            org, deferred_uri = self.read_org_units(entry=entry)
+            if deferred_uri:
+                org = (yield "send_limited", dict(method="GET", url=deferred_uri,
+                                                  params=self.get_org_unit_params())).json().get("d", None).get("results", None)
+            self.set_department(entry=entry, org=org)
+
+    def read_org_units(self, entry):
+        '''
+        :param entry: employee as returned by C4C
+        :return: tuple of its organisational unit assignments, and the URI to get them from if C4C left them deferred
+        '''
+        org = entry.get("EmployeeOrganisationalUnitAssignment", None) or []
+        if isinstance(org, dict):
+            if "__deferred" in org:
+                return [], org.get("__deferred", None).get("uri", None)
+            # expanded navigation property is wrapped in "results" in OData v2 JSON
+            return org.get("results", None) or [], None
+        return org, None
+
+    def get_org_unit_params(self):
+        return {"$format": "json",
+                "$select": c4c_config.org_unit_c4c_fields}
+
+    def set_department(self, entry, org):
+        for chan_type in org or []:
+            entry["Department"] = chan_type.get("OrgUnitID", None)
+        entry.pop("EmployeeOrganisationalUnitAssignment", None)
+
+    def read_results(self, response, meta):
+        '''
+        Read the entries of a C4C collection response page by page,
+        parsed from the response stream if ijson is installed, so that the raw body is not kept along with the page,
+        else from the whole body
+        :param response: response of a request sent with stream=True
+        :param meta: dict to fill with __count and __next of the response once the entries are read
+        :return: generator of entries
+        '''
+        if ijson is None:
+            for entry in self.read_results_body(body=response.json(), meta=meta):
+                yield entry
+            return
+        # decode gzip and deflate bodies
+        response.raw.decode_content = True
+        # the items of d are built by the ijson backend, so the results list of the page is built whole
+        # before its entries are yielded, building entry by entry in Python took twice as long for the same peak memory
+        for key, value in ijson.kvitems(response.raw, "d", use_float=True):
+            for entry in self.read_results_item(key=key, value=value, meta=meta):
+                yield entry
+
+    def read_results_body(self, body, meta):
+        '''
+        Read the entries of a whole decoded C4C collection response
+        :param body: decoded JSON body
+        :param meta: dict to fill with __count and __next of the response
+        :return: list of entries
+        '''
+        entries = []
+        for key, value in (body.get("d", None) or dict()).items():
+            entries += self.read_results_item(key=key, value=value, meta=meta)
+        return entries
+
+    def read_results_item(self, key, value, meta):
+        '''
+        Read one item of d of a C4C collection response, shared by the clients
+        :param key: key of the item
+        :param value: value of the item
+        :param meta: dict to fill with __count and __next of the response
+        :return: list of entries if the item is the results, else an empty list
+        '''
+        if key in ("__count", "__next"):
+            meta[key] = value
+        return (value or []) if key == "results" else []
+
+    def get_entries(self, session_, uri, params, page_size=c4c_config.page_size, type=None):
+        '''
+        Get entries of a C4C collection, following __next links if the server returns them,
+        else paging with $top and $skip, or by keyset for a collection ordered by EntityLastChangedOn, see get_page_requests.
+        Each response is parsed page by page from its stream, see read_results,
+        so that its raw body is not kept in memory along with its parsed entries. The total is asked for with $inlinecount on the first page
+        instead of a separate $count request, and kept in expected_counts
+        :param session_: request session
+        :param uri: collection URI
+        :param params: query params without $top and $skip
+        :param page_size: number of entries to ask for per request
+        :param type: data type to report the expected total under
+        :return: generator of entries
+        '''
+        page_requests = self.get_page_requests(uri=uri, params=params, page_size=page_size, type=type)
+        url, params, seen_keys = next(page_requests)
+        while True:
+            response = self.send_limited(session_=session_, method="GET", url=url, params=params, stream=True)
+            meta = dict()
+            page_count = 0
+            try:
+                for entry in self.read_results(response=response, meta=meta):
+                    page_count += 1
+                    if self.read_keyset_entry(entry=entry, meta=meta, seen_keys=seen_keys):
+                        yield entry
+            finally:
+                response.close()
+            try:
+                url, params, seen_keys = page_requests.send((page_count, meta))
+            except StopIteration:
+                return
+
+    def read_keyset_entry(self, entry, meta, seen_keys):
+        '''
+        Keep the EntityLastChangedOn of the last entry of a page, and the URIs of the entries that share it,
+        for get_page_requests to start the next page from, shared by the clients
+        :param entry: entry of the page
+        :param meta: dict of the page to fill with last_changed_on, last_keys and skipped
+        :param seen_keys: URIs of entries received by the previous page at the EntityLastChangedOn the page starts from
+        :return: False if the entry was received by the previous page already, else True
+        '''
+        changed_on = entry.get("EntityLastChangedOn", None)
+        if changed_on is None:
+            return True
+        key = (entry.get("__metadata", None) or dict()).get("uri", None)
+        if changed_on != meta.get("last_changed_on", None):
+            meta["last_changed_on"] = changed_on
+            meta["last_keys"] = set()
+        meta["last_keys"].add(key)
+        if key in seen_keys:
+            meta["skipped"] = meta.get("skipped", 0) + 1
+            return False
+        return True
+
+    def format_keyset_value(self, changed_on):
+        '''
+        :param changed_on: Edm.DateTimeOffset in OData JSON format, e.g. /Date(1600000000000)/
+        :return: the date time in $filter format with milliseconds, e.g. 2020-09-13T12:26:40.000Z, None if not parsable
+        '''
+        match = re.match(r"/Date\((-?\d+)(?:[+-]\d{4})?\)/", changed_on or "")
+        if not match:
             return None
+        date_time = datetime.fromtimestamp(int(match.group(1)) / 1000, tz=timezone.utc)
+        return date_time.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+    def get_page_requests(self, uri, params, page_size=c4c_config.page_size, type=None):
+        '''
+        Paging of get_entries, independent of how requests are sent, so that it is shared by the clients.
+        A collection ordered by EntityLastChangedOn is paged by keyset: each page starts from the EntityLastChangedOn
+        the previous one ended with, without the entries already received at it. Entries changed while the collection
+        is paged move to its end, with $skip they would shift unseen entries back into the pages already received.
+        $skip is still used within a page's worth of entries that all share one EntityLastChangedOn
+        :param uri: collection URI
+        :param params: query params without $top and $skip
+        :param page_size: number of entries to ask for per request
+        :param type: data type to report the expected total under
+        :return: generator of tuples of URL, query params and URIs of entries already received of each page, to be sent back
+        a tuple of the number of entries of the page and a dict of its __count and __next, and of what read_keyset_entry keeps
+        '''
+        params = dict(params)
+        params["$top"] = page_size
+        params["$skip"] = 0
+        params["$inlinecount"] = "allpages"
+        keyset = params.get("$orderby", None) == "EntityLastChangedOn"
+        base_filter = params.get("$filter", None)
+        next_uri = None
+        received_count = 0
+        # entries received for the current $skip, over the __next links C4C may split it into
+        window_count = 0
+        # EntityLastChangedOn the current page starts from, and URIs of the entries received at it
+        keyset_from = None
+        seen_keys = frozenset()
+        window_last_changed_on = None
+        window_last_keys = set()
+        while True:
+            if next_uri:
+                page_count, meta = yield next_uri, None if "$format" in next_uri else {"$format": "json"}, seen_keys
+            else:
+                page_count, meta = yield uri, dict(params), seen_keys
+            received_count += page_count - meta.get("skipped", 0)
+            window_count += page_count
+            if meta.get("last_changed_on", None) is not None:
+                if meta["last_changed_on"] != window_last_changed_on:
+                    window_last_changed_on = meta["last_changed_on"]
+                    window_last_keys = set()
+                window_last_keys |= meta["last_keys"]
+            if "$inlinecount" in params:
+                params.pop("$inlinecount")
+                expected_count = int(meta.get("__count", 0) or 0)
+                self.expected_counts[type or uri] = expected_count
+                logger.debug("Expect {0} entries of type '{1}' from C4C".format(expected_count, type or uri))
+            # server-driven paging, the next link already carries the query options
+            if meta.get("__next", None):
+                next_uri = meta.get("__next")
+                continue
+            if window_count < page_size:
+                break
+            next_uri = None
+            window_count = 0
+            keyset_value = self.format_keyset_value(changed_on=window_last_changed_on) if keyset else None
+            if keyset_value is None:
+                params["$skip"] += page_size
+                continue
+            if window_last_changed_on == keyset_from:
+                # the whole page shares the EntityLastChangedOn it started from
+                params["$skip"] += page_size
+                seen_keys = seen_keys | window_last_keys
+            else:
+                keyset_from = window_last_changed_on
+                params["$skip"] = 0
+                seen_keys = frozenset(window_last_keys)
+                clause = "EntityLastChangedOn ge datetimeoffset'{0}'".format(keyset_value)
+                params["$filter"] = "{0} and {1}".format(base_filter, clause) if base_filter else clause
+            window_last_changed_on = None
+            window_last_keys = set()
+        logger.debug("Received {0} of {1} expected entries of type '{2}' from C4C".format(
+            received_count, self.expected_counts.get(type or uri, None), type or uri))
+
+    def get_pages(self, session_, uri, params, page_size=c4c_config.page_size, type=None):
+        '''
+        Get results of a C4C collection page by page, see get_entries
+        :return: generator of lists of entries, one list of at most page_size entries per page
+        '''
+        page = []
+        for entry in self.get_entries(session_=session_, uri=uri, params=params, page_size=page_size, type=type):
+            page.append(entry)
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def get_collection_query(self, type, date_from=None, date_to=None):
+        '''
+        Get URI and query params of a C4C collection
+        :param type: data type matching C4C collection, one of contact, account, lead, tg, tgm, emp
+        :param date_from: get data changed after given date
+        :param date_to: get data changed before given date, excluded, e.g. for a shard of a backfill
+        :return: tuple of collection URI and query params
+        '''
+        collections = {"contact": (self.contact_uri, c4c_config.contact_c4c_fields),
+                       "account": (self.account_uri, c4c_config.account_c4c_fields),
+                       "lead": (self.lead_uri, c4c_config.lead_c4c_fields),
+                       "tg": (self.target_gr_uri, c4c_config.target_gr_c4c_fields),
+                       "tgm": (self.target_gr_m_uri, c4c_config.target_gr_m_c4c_fields),
+                       "emp": (self.emp_uri, c4c_config.emp_c4c_fields)}
+        uri, fields = collections[type]
+        params = {"$format": "json",
+                  "$select": fields}
+        # target group member has no date filter
+        if type != "tgm":
+            params["$filter"] = "EntityLastChangedOn ge datetimeoffset'{0}'".format(date_from)
+            if date_to:
+                params["$filter"] += " and EntityLastChangedOn lt datetimeoffset'{0}'".format(date_to)
+            # keep page boundaries stable while paging
+            params["$orderby"] = "EntityLastChangedOn"
+        if type == "emp":
+            params["$expand"] = c4c_config.emp_c4c_expand
+        return uri, params
+
+    def get_data_pages(self, session_, type, date_from=None, page_size=c4c_config.page_size, date_to=None):
+        '''
+        Get data page by page instead of in one response, so that only one page is kept in memory at a time
+        :param session_: request session
+        :param type: data type matching C4C collection, one of contact, account, lead, tg, tgm, emp
+        :param date_from: get data changed after given date
+        :param date_to: get data changed before given date, excluded
+        :param page_size: number of entries per page
+        :return: generator of validated lists of entries, one list per page
+        '''
+        uri, params = self.get_collection_query(type=type, date_from=date_from, date_to=date_to)
+        for page in self.get_pages(session_=session_, uri=uri, params=params, page_size=page_size, type=type):
+            if type == "emp":
+                self.add_departments(session_=session_, data=page)
+            yield self.validate_data(type=type, data=page)
+
+    @contextmanager
+    def fetch_data_pages(self, queries, max_workers=c4c_config.fetch_workers, queue_pages=c4c_config.fetch_queue_pages):
+        '''
+        Fetch several collections at the same time, each with get_data_pages in a worker thread
+        with its own requests session and connection pool.
+        Pages are handed over through a queue of at most queue_pages pages per collection,
+        so the caller can write them in its own order while the others keep coming.
+        Pages must be consumed in the order of queries, so that a collection whose worker has not started yet
+        does not wait for a worker that is blocked on a full queue
+        :param queries: dict of name: dict of get_data_pages params, i.e. type, date_from and date_to
+        :param max_workers: number of collections fetched at a time
+        :param queue_pages: number of pages fetched ahead of the caller per collection
+        :return: dict of name: generator of pages, errors of a worker are raised from its generator
+        '''
+        stop = threading.Event()
+        done = object()
+        queues = {name: queue.Queue(maxsize=queue_pages) for name in queries}
+
+        def put(name, item):
+            # give up once the caller has left, so that the worker does not block forever on a full queue
+            while not stop.is_set():
+                try:
+                    queues[name].put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch(name, query):
+            # the caller left before the worker started
+            if stop.is_set():
+                return
+            session = self.create_session()
+            try:
+                for page in self.get_data_pages(session_=session, **query):
+                    if not put(name=name, item=page):
+                        return
+                put(name=name, item=done)
+            except Exception as e:
+                logger.debug("Error while fetching '{0}' from C4C: {1}".format(name, repr(e)))
+                put(name=name, item=e)
+            finally:
+                session.close()
+
+        def get_pages(name):
+            while True:
+                item = queues[name].get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="c4c_fetch") as executor:
+            for name, query in queries.items():
+                executor.submit(fetch, name, query)
+            try:
+                yield {name: get_pages(name=name) for name in queries}
+            finally:
+                stop.set()
+                # collections not started yet are not fetched at all
+                executor.shutdown(wait=True, cancel_futures=True)
 
     def pre_process_data_for_post(self, data):
         result = []
@@ -291,6 +826,9 @@ class C4CClient:
                                     "B2B_MP_Consent": entry[63] if entry[63] else None,
                                     "B2C_MP_Consent": entry[64] if entry[64] else None,
                                     "ZCustomerSurveyStatus_KUT": entry[65] if entry[65] else None,
+                                    "C4C_Payload_Hash": entry[66] if entry[66] else None,
+                                    "C4C_Consent_Hash": entry[67] if entry[67] else None,
+                                    "C4C_Last_Payload": entry[68] if entry[68] else None,
                                 }
                             )
                         except Exception as e:
@@ -299,8 +837,314 @@ class C4CClient:
                         logger.debug("Error while formatting lead with C_Country '{0}'".format(entry[11]))
         return result
 
-    def post_lead_data(self, session_, token, data):
-        patch_count, patch_failed_count, post_count, post_failed_count = 0, 0, 0, 0
+    def prepare_lead_for_post(self, entry):
+        '''
+        Reformat a lead into the body to Post or Patch to C4C
+        :param entry: lead formatted by pre_process_data_for_post
+        :return: dict of the lead, its method, URI, JSON body and consent, or None if there is nothing to send
+        '''
+        # preprocess data
+        entry_reformatted = entry.copy()
+        entry_reformatted.pop("TableID", None)
+        entry_reformatted.pop("ID", None)
+        # entry_reformatted.pop("ContactUUID", None)
+        entry_reformatted.pop("URI", None)
+        entry_reformatted.pop("C4C_Task_Name", None)
+        entry_reformatted.pop("C4C_Status", None)
+        entry_reformatted.pop("C4C_Payload_Hash", None)
+        entry_reformatted.pop("C4C_Consent_Hash", None)
+        entry_reformatted.pop("C4C_Last_Payload", None)
+        # reassign to correct b2b or b2c fields
+        entry_reformatted.pop("B2B_MP_Consent", None)
+        entry_reformatted.pop("B2C_MP_Consent", None)
+        entry_reformatted.pop("Email", None)
+        # check if uri existed to patch
+        entry_id = entry.get("ID") or None
+        entry_uri = entry.get("URI", None) or None
+        entry_task = entry.get("C4C_Task_Name", None) or None
+        entry_contact_uuid = entry.get("ContactUUID", None) or None
+        entry_email = entry.get("Email", None)
+        entry_company = entry.get("Company", None)
+        entry_address = entry.get("AccountPostalAddressElementsStreetName", None)
+        entry_consent = None
+
+        # catch the exceptional case that a lead that is sent got mixed up with an existing email address
+        # thus only Lead ID got emptied, but ContactUUID or URI is not emptied yet
+        if not entry_id:
+            if entry_uri or entry_contact_uuid:
+                entry_uri = None
+                entry_contact_uuid = None
+        # get consent: b2b or b2c
+        if "Z103" in entry.get("GroupCode", None) or "Z108" in entry.get("GroupCode", None):
+            entry_consent = entry.get("B2B_MP_Consent", None) or None
+            entry_reformatted["ContactEMail"] = entry_email
+        if "Z101" in entry.get("GroupCode", None):
+            entry_consent = entry.get("B2C_MP_Consent", None) or None
+            entry_reformatted["ZConsumerEMail_KUT"] = entry_email
+        # split company name that is longer than 40 characters
+        # into Company and CompanySecondName (is not written to DB)
+        if entry_company:
+            if len(entry_company) > 40:
+                entry_reformatted["Company"] = entry_company[:40]
+                entry_reformatted["CompanySecondName"] = entry_company[40:]
+                # continue splitting further if CompanySecondName is longer than 40 characters
+                entry_company_second = entry_reformatted["CompanySecondName"]
+                if len(entry_company_second) > 40:
+                    entry_reformatted["CompanySecondName"] = entry_company_second[:40]
+                    entry_reformatted["CompanyThirdName"] = entry_company_second[40:]
+        # split address that is longer than 40 characters
+        # into AccountPostalAddressElementsStreetName and AccountPostalAddressElementsStreetSufix (is not written to DB)
+        if entry_address:
+            if len(entry_address) > 40:
+                entry_reformatted["AccountPostalAddressElementsStreetName"] = entry_address[:40]
+                entry_reformatted["AccountPostalAddressElementsStreetSufix"] = entry_address[40:]
+                # continue splitting further if AccountPostalAddressElementsStreetSufix is longer than 40 characters
+                entry_address_second = entry_reformatted["AccountPostalAddressElementsStreetSufix"]
+                if len(entry_address_second) > 40:
+                    entry_reformatted["AccountPostalAddressElementsStreetSufix"] = entry_address_second[:40]
+                    entry_reformatted["AccountPostalAddressElementsAdditionalStreetSuffixName"] = entry_address_second[40:]
+
+        # a lead is not seen as changed because C4C assigned its contact or owner since its last push
+        payload_fields = {key: value for key, value in entry_reformatted.items()
+                          if key not in c4c_config.lead_server_assigned_fields}
+        payload = json.dumps(payload_fields, ensure_ascii=False, sort_keys=True)
+        lead = {"entry": entry,
+                # format data as json
+                "body": json.dumps(entry_reformatted, ensure_ascii=False).encode(),
+                "consent": entry_consent,
+                "contact_uuid": entry_contact_uuid,
+                "payload": payload,
+                "payload_hash": self.hash_payload(payload=payload),
+                "consent_hash": self.hash_payload(payload=str(entry_consent)),
+                "payload_changed": True,
+                "consent_changed": True}
+        if entry_id and entry_uri and entry_contact_uuid and entry_task == "update_leads":
+            # 200 with the updated lead if C4C honours the return preference, else 204
+            lead["method"], lead["uri"], lead["expected_status_codes"] = "PATCH", entry_uri, (200, 204)
+            # compare with the last successful push of the lead
+            lead["payload_changed"] = lead["payload_hash"] != entry.get("C4C_Payload_Hash", None)
+            lead["consent_changed"] = lead["consent_hash"] != entry.get("C4C_Consent_Hash", None)
+            last_payload = json.loads(entry["C4C_Last_Payload"]) if entry.get("C4C_Last_Payload", None) else None
+            if lead["payload_changed"] and last_payload is not None:
+                # only Patch fields that differ from the last push, and clear those of the last push that are gone,
+                # e.g. CompanySecondName of a shortened Company or the email field of the other GroupCode
+                changed_fields = {key: value for key, value in payload_fields.items()
+                                  if key not in last_payload or last_payload[key] != value}
+                changed_fields.update((key, None) for key in last_payload if key not in payload_fields)
+                if changed_fields:
+                    lead["body"] = json.dumps(changed_fields, ensure_ascii=False).encode()
+                else:
+                    # same as the last push, only its hash differed
+                    lead["payload_changed"] = False
+            return lead
+        if not entry_id and not entry_uri and not entry_contact_uuid and entry_task == "create_leads":
+            lead["method"], lead["uri"], lead["expected_status_codes"] = "POST", self.lead_uri, (201,)
+            return lead
+        return None
+
+    def hash_payload(self, payload):
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def record_pushed_lead(self, lead, tableid_to_inspect_more):
+        '''
+        Keep the hashes and payload of a successfully pushed lead to compare with its next push,
+        the consent hash is only kept if its Channel Permission was pushed without problem
+        :param lead: lead prepared by prepare_lead_for_post
+        :param tableid_to_inspect_more: problems of the run, see new_post_lead_log
+        :return: None
+        '''
+        entry = lead["entry"]
+        entry["C4C_Payload_Hash"] = lead["payload_hash"]
+        entry["C4C_Last_Payload"] = lead["payload"]
+        if not any(entry.get("TableID", None) in table_ids for table_ids in tableid_to_inspect_more.values()):
+            entry["C4C_Consent_Hash"] = lead["consent_hash"]
+
+    @steps
+    def send_lead(self, lead):
+        '''
+        Post or Patch one lead to C4C
+        :param lead: lead prepared by prepare_lead_for_post
+        :return: response
+        '''
+        headers = CaseInsensitiveDict({"Content-Type": "application/json", **c4c_config.representation_headers})
+        self.invalidate_cached(entity="entity", key=lead["uri"])
+        return (yield "write", dict(method=lead["method"], url=lead["uri"], headers=headers, data=lead["body"]))
+
+    @steps
+    def send_lead_batch(self, leads):
+        '''
+        Post or Patch leads to C4C in one OData $batch request, each lead in its own changeset
+        so that a failing lead does not roll back the others
+        :param leads: leads prepared by prepare_lead_for_post
+        :return: list of responses in the same order as leads, None for a lead known not to be applied by C4C,
+            to be sent alone. A lead without a part of its own in the response gets the response of the $batch request
+            and is marked with outcome_unknown, as it is not known whether C4C applied it
+        '''
+        batch_boundary = "batch_{0}".format(uuid.uuid4())
+        body = []
+        for i, lead in enumerate(leads):
+            self.invalidate_cached(entity="entity", key=lead["uri"])
+            changeset_boundary = "changeset_{0}".format(uuid.uuid4())
+            # URI relative to the service root
+            uri = lead["uri"][len(self.base_url):] if lead["uri"].startswith(self.base_url) else lead["uri"]
+            body.append("--{0}\r\n"
+                        "Content-Type: multipart/mixed; boundary={1}\r\n"
+                        "\r\n"
+                        "--{1}\r\n"
+                        "Content-Type: application/http\r\n"
+                        "Content-Transfer-Encoding: binary\r\n"
+                        "Content-ID: {2}\r\n"
+                        "\r\n"
+                        "{3} {4} HTTP/1.1\r\n"
+                        "Content-Type: application/json\r\n"
+                        "{6}"
+                        "Content-Length: {5}\r\n"
+                        "\r\n".format(batch_boundary, changeset_boundary, i, lead["method"], uri, len(lead["body"]),
+                                      "".join("{0}: {1}\r\n".format(key, value)
+                                              for key, value in c4c_config.representation_headers.items())).encode())
+            body.append(lead["body"])
+            body.append("\r\n--{0}--\r\n".format(changeset_boundary).encode())
+        body.append("--{0}--\r\n".format(batch_boundary).encode())
+        headers = CaseInsensitiveDict({"Content-Type": "multipart/mixed; boundary={0}".format(batch_boundary)})
+        response = yield "write", dict(method="POST", url=self.base_url + "$batch", headers=headers, data=b"".join(body))
+        parts = parse_batch_response(content=response.content, content_type=response.headers.get("Content-Type", ""))
+        if response.status_code != 202:
+            logger.debug("Error with Post $batch of {0} leads to C4C".format(len(leads)))
+            logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
+            # the $batch request was rejected as a whole, before any changeset was processed
+            if not parts and response.status_code < 500:
+                return [None] * len(leads)
+        result = [response] * len(leads)
+        # map parts back to leads by Content-ID if C4C echoes it, else by order
+        for i, part in enumerate(parts):
+            index = int(part.content_id) if part.content_id and part.content_id.isdigit() else i
+            if index < len(leads):
+                # the changeset of a failed part is rolled back
+                result[index] = part if part.status_code in leads[index]["expected_status_codes"] else None
+        for lead, lead_response in zip(leads, result):
+            lead["outcome_unknown"] = lead_response is response
+        return result
+
+    def post_lead_data(self, session_, data, batch_size=None):
+        '''
+        Post new leads and Patch existing leads to C4C, then create or update their marketing permissions
+        :param session_: request session
+        :param data: leads formatted by pre_process_data_for_post
+        :param batch_size: number of leads to send per $batch request, send leads one by one if not given
+        :return: data with updated ID, URI, ContactUUID, OwnerPartyUUID and C4C_Status
+        '''
+        counts, tableid_to_inspect_more = self.new_post_lead_log()
+        for chunk in self.get_lead_chunks(data=data, batch_size=batch_size):
+            self.post_lead_chunk(session_=session_, leads=chunk, batch_size=batch_size,
+                                 counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+        self.log_post_lead_data(counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+        return data
+
+    def get_lead_chunks(self, data, batch_size=None):
+        '''
+        :param data: leads formatted by pre_process_data_for_post
+        :param batch_size: number of leads to send per $batch request, one lead per chunk if not given
+        :return: list of lists of leads prepared by prepare_lead_for_post, one list per post_lead_chunk
+        '''
+        leads = [lead for lead in (self.prepare_lead_for_post(entry=entry) for entry in data) if lead]
+        chunk_size = batch_size or 1
+        return [leads[i:i + chunk_size] for i in range(0, len(leads), chunk_size)]
+
+    @steps
+    def post_lead_chunk(self, leads, counts, tableid_to_inspect_more, batch_size=None):
+        '''
+        Send a chunk of leads, in one $batch request if batch_size is given, and follow each of them up, see post_lead_data
+        :param leads: leads prepared by prepare_lead_for_post
+        :param counts: counts to update, see new_post_lead_log
+        :param tableid_to_inspect_more: problems to update, see new_post_lead_log
+        :param batch_size: send the chunk in one $batch request if given, else one lead per request
+        :return: None
+        '''
+        # leads unchanged since their last push are not sent again
+        leads_to_send = [lead for lead in leads if lead["payload_changed"]]
+        if batch_size and leads_to_send:
+            responses = iter((yield "send_lead_batch", dict(leads=leads_to_send)))
+        else:
+            responses = iter([None] * len(leads_to_send))
+        for lead in leads:
+            if not lead["payload_changed"]:
+                logger.debug("Lead with TableID {0} unchanged since last push, skip Patch".format(lead["entry"].get("TableID", None)))
+                counts["patch_skipped"] += 1
+                yield "follow_up_lead", dict(lead=lead, response=None,
+                                             counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+                continue
+            response = next(responses)
+            # send single request if not sent in batch or failed in batch
+            if response is None:
+                if batch_size:
+                    logger.debug("Lead with TableID {0} failed in $batch, retry it alone".format(lead["entry"].get("TableID", None)))
+                response = yield "send_lead", dict(lead=lead)
+            yield "follow_up_lead", dict(lead=lead, response=response,
+                                         counts=counts, tableid_to_inspect_more=tableid_to_inspect_more)
+
+    @steps
+    def resolve_unknown_leads(self, data):
+        '''
+        Look up leads whose Post was in a failed $batch, or created them without telling where,
+        by the Name, Company and email they were Posted with.
+        A found lead gets its ID, URI and ContactUUID, and is Patched by the next run to also push its consent,
+        a lead that is not found is Posted again by the next run
+        :param data: leads formatted by pre_process_data_for_post
+        :return: data with updated ID, URI, ContactUUID, OwnerPartyUUID, C4C_Task_Name and C4C_Status
+        '''
+        for entry in data:
+            if entry.get("C4C_Status", None) != "unknown":
+                continue
+            lead = self.prepare_lead_for_post(entry=entry)
+            if not lead:
+                continue
+            found_lead = yield "look_up_lead", dict(lead=lead)
+            if found_lead is None:
+                continue
+            if found_lead:
+                logger.debug("Lead with TableID {0} was created in C4C, Patch it".format(entry.get("TableID", None)))
+                self.read_created_lead(entry=entry, lead=found_lead)
+                entry["OwnerPartyUUID"] = entry.get("OwnerPartyUUID", None) or found_lead.get("OwnerPartyUUID", None)
+                entry["C4C_Task_Name"] = "update_leads"
+            else:
+                logger.debug("Lead with TableID {0} was not created in C4C, Post it again".format(entry.get("TableID", None)))
+            entry["C4C_Status"] = "pending"
+        return data
+
+    @steps
+    def look_up_lead(self, lead):
+        '''
+        Look up a lead Posted to C4C by the Name, Company and email it was Posted with
+        :param lead: lead prepared by prepare_lead_for_post
+        :return: the lead as returned by C4C, empty dict if not found, or None if the lookup failed
+        '''
+        response = yield "send_limited", dict(method="GET", url=self.lead_uri,
+                                              params=self.get_unknown_lead_params(payload=json.loads(lead["payload"])))
+        if response.status_code != 200:
+            logger.debug("Error status code {0} while looking up lead with TableID {1}".format(
+                response.status_code, lead["entry"].get("TableID", None)))
+            return None
+        results = response.json().get("d", None).get("results", None)
+        return results[0] if results else dict()
+
+    def get_unknown_lead_params(self, payload):
+        '''
+        :param payload: payload of the lead as Posted, see prepare_lead_for_post
+        :return: query params to look up the lead by its Name, Company and email
+        '''
+        clauses = ["{0} eq '{1}'".format(field, str(payload[field]).replace("'", "''"))
+                   for field in ("Name", "Company", "ContactEMail", "ZConsumerEMail_KUT") if payload.get(field, None)]
+        return {"$format": "json",
+                "$filter": " and ".join(clauses),
+                "$select": "ID,ContactUUID,OwnerPartyUUID",
+                "$top": 1}
+
+    def new_post_lead_log(self):
+        '''
+        Create counters and problem lists to fill while posting leads
+        :return: tuple of counts and TableIDs to inspect more by problem
+        '''
+        counts = {"patch": 0, "patch_failed": 0, "patch_skipped": 0, "post": 0, "post_failed": 0, "post_unknown": 0}
         tableid_to_inspect_more = {"existed_mp_for_new_lead": [],
                                    "no_contactuuid_for_new_lead": [],
                                    "no_contactuuid_for_existing_lead": [],
@@ -309,250 +1153,457 @@ class C4CClient:
                                    "error_creating_mp_for_existing_lead": [],
                                    "error_updating_z03_for_existing_lead": [],
                                    "error_creating_z03_for_existing_lead": [],
-                                   "error_creating_z03_for_new_lead": []}
-        headers = CaseInsensitiveDict({"Content-Type": "application/json", "x-csrf-token": token})
-        for entry in data:
-            # preprocess data
-            entry_reformatted = entry.copy()
-            entry_reformatted.pop("TableID", None)
-            entry_reformatted.pop("ID", None)
-            # entry_reformatted.pop("ContactUUID", None)
-            entry_reformatted.pop("URI", None)
-            entry_reformatted.pop("C4C_Task_Name", None)
-            entry_reformatted.pop("C4C_Status", None)
-            # reassign to correct b2b or b2c fields
-            entry_reformatted.pop("B2B_MP_Consent", None)
-            entry_reformatted.pop("B2C_MP_Consent", None)
-            entry_reformatted.pop("Email", None)
-            # check if uri existed to patch
-            entry_table_id = entry.get("TableID") or None
-            entry_id = entry.get("ID") or None
-            entry_uri = entry.get("URI", None) or None
-            entry_task = entry.get("C4C_Task_Name", None) or None
-            entry_contact_uuid = entry.get("ContactUUID", None) or None
-            entry_email = entry.get("Email", None)
-            entry_owner_uuid = entry.get("OwnerPartyUUID", None)
-            entry_company = entry.get("Company", None)
-            entry_address = entry.get("AccountPostalAddressElementsStreetName", None)
-
-            # catch the exceptional case that a lead that is sent got mixed up with an existing email address
-            # thus only Lead ID got emptied, but ContactUUID or URI is not emptied yet
-            if not entry_id:
-                if entry_uri or entry_contact_uuid:
-                    entry_uri = None
-                    entry_contact_uuid = None
-            # get consent: b2b or b2c
-            if "Z103" in entry.get("GroupCode", None) or "Z108" in entry.get("GroupCode", None):
-                entry_consent = entry.get("B2B_MP_Consent", None) or None
-                entry_reformatted["ContactEMail"] = entry_email
-            if "Z101" in entry.get("GroupCode", None):
-                entry_consent = entry.get("B2C_MP_Consent", None) or None
-                entry_reformatted["ZConsumerEMail_KUT"] = entry_email
-            # split company name that is longer than 40 characters
-            # into Company and CompanySecondName (is not written to DB)
-            if entry_company:
-                if len(entry_company) > 40:
-                    entry_reformatted["Company"] = entry_company[:40]
-                    entry_reformatted["CompanySecondName"] = entry_company[40:]
-                    # continue splitting further if CompanySecondName is longer than 40 characters
-                    entry_company_second = entry_reformatted["CompanySecondName"]
-                    if len(entry_company_second) > 40:
-                        entry_reformatted["CompanySecondName"] = entry_company_second[:40]
-                        entry_reformatted["CompanyThirdName"] = entry_company_second[40:]
-            # split address that is longer than 40 characters
-            # into AccountPostalAddressElementsStreetName and AccountPostalAddressElementsStreetSufix (is not written to DB)
-            if entry_address:
-                if len(entry_address) > 40:
-                    entry_reformatted["AccountPostalAddressElementsStreetName"] = entry_address[:40]
-                    entry_reformatted["AccountPostalAddressElementsStreetSufix"] = entry_address[40:]
-                    # continue splitting further if AccountPostalAddressElementsStreetSufix is longer than 40 characters
-                    entry_address_second = entry_reformatted["AccountPostalAddressElementsStreetSufix"]
-                    if len(entry_address_second) > 40:
-                        entry_reformatted["AccountPostalAddressElementsStreetSufix"] = entry_address_second[:40]
-                        entry_reformatted["AccountPostalAddressElementsAdditionalStreetSuffixName"] = entry_address_second[40:]
-
-            # format data as json
-            entry_reformatted_json = json.dumps(entry_reformatted, ensure_ascii=False).encode()
-
-            if entry_id and entry_uri and entry_contact_uuid:
-                if entry_task == "update_leads":
-                    response = session_.patch(url=entry_uri, headers=headers,
-                                              data=entry_reformatted_json)
-                    if response.status_code != 204:
-                        logger.debug("Error with Patch entry with URI to C4C: {0}".format(entry_uri))
-                        logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
-                        # remove entry from data if failed to Patch to C4C
-                        # data.remove(entry)
-                        patch_failed_count += 1
-                        # continue
-                    # change status after patched
-                    else:
-                        entry["C4C_Status"] = "updated"
-                        # set OwnerPartyUUID if not existed
-                        if not entry_owner_uuid:
-                            params = {"$format": "json"}
-                            entry["OwnerPartyUUID"] = session_.get(url=entry_uri, params=params).json().get("d", None).get("results", None).get("OwnerPartyUUID", None)
-                        z03_channel_uri = self.check_if_mark_p_existed(session_=session_, contact_uuid=entry_contact_uuid)
-                        # patch if Z03 URI existed
-                        # (z03_channel_uri is defined as a string)
-                        if z03_channel_uri and isinstance(z03_channel_uri, str):
-                            z03_patch_response = self.post_z03_p(session_=session_, token=token, c4c_task=entry_task,
-                                                                 consent=entry_consent, channel_uri=z03_channel_uri)
-                            if not z03_patch_response:
-                                tableid_to_inspect_more["error_updating_z03_for_existing_lead"].append(entry_table_id)
-                        # create new marketing permission and channel permission if not existed yet
-                        # (z03_channel_uri = False from above)
-                        elif not z03_channel_uri and z03_channel_uri is not None and isinstance(z03_channel_uri, bool):
-                            if entry_contact_uuid:
-                                channel_uri, mark_p_object_id = self.post_mark_p(session_=session_, token=token, contact_uuid=entry_contact_uuid)
-                                # create/update channel permission after finish creating new marketing permission
-                                if channel_uri and mark_p_object_id:
-                                    z03_post_response = self.post_z03_p(session_=session_, token=token, c4c_task="create_leads",
-                                                                        consent=entry_consent, channel_uri=channel_uri,
-                                                                        mark_p_object_id=mark_p_object_id)
-                                    if not z03_post_response:
-                                        tableid_to_inspect_more["error_creating_z03_for_existing_lead"].append(entry_table_id)
-                                else:
-                                    tableid_to_inspect_more["error_creating_mp_for_existing_lead"].append(entry_table_id)
-                            else:
-                                logger.debug("No ContactUUID given cannot proceed with Post or Patch Channel Permission, require more inspection")
-                                tableid_to_inspect_more["no_contactuuid_for_existing_lead"].append(entry_table_id)
-                        # create new Z03 Channel Permission if not existed yet, but Marketing Permission already existed
-                        # (z03_channel_uri = (channel_uri, mark_p_object_id) from above)
-                        elif isinstance(z03_channel_uri, tuple):
-                            channel_uri, mark_p_object_id = z03_channel_uri
-                            z03_post_response = self.post_z03_p(session_=session_, token=token, c4c_task="create_leads",
-                                                                consent=entry_consent, channel_uri=channel_uri,
-                                                                mark_p_object_id=mark_p_object_id)
+                                   "error_creating_z03_for_new_lead": [],
+                                   "unknown_outcome_for_new_lead": [],
+                                   "no_body_nor_location_for_new_lead": [],
+                                   "connection_error": []}
+        return counts, tableid_to_inspect_more
+
+    def log_post_lead_data(self, counts, tableid_to_inspect_more):
+        logger.debug("Finish Patch {0} and Post {1} leads to C4C".format(counts["patch"], counts["post"]))
+        logger.debug("{0} leads failed Patch to C4C".format(counts["patch_failed"]))
+        logger.debug("{0} leads failed Post to C4C".format(counts["post_failed"]))
+        logger.debug("{0} leads Posted to C4C with an unknown outcome, to look up instead of Post again".format(
+            counts["post_unknown"]))
+        logger.debug("{0} leads unchanged since last push, not Patched to C4C".format(counts["patch_skipped"]))
+        logger.debug("C4C rate limiter: {0}".format(self.limiter.metrics()))
+        for problem in tableid_to_inspect_more:
+            logger.debug("Detect {0} problem(s) for '{1}': {2}".format(len(tableid_to_inspect_more[problem]),
+                                                                       problem,
+                                                                       tableid_to_inspect_more[problem]))
+
+    def read_entity(self, response):
+        '''
+        Read the JSON representation of an entity returned by a Post or Patch sent with representation_headers
+        :param response: response of the Post or Patch
+        :return: entity as dict, or None if the response has no JSON body
+        '''
+        if response is None or not response.content:
+            return None
+        try:
+            return response.json().get("d", None).get("results", None)
+        except (ValueError, AttributeError):
+            return None
+
+    @steps
+    def get_entity(self, uri):
+        '''
+        Get an entity by its URI, when it was not returned by its Post or Patch
+        :param uri: URI of the entity
+        :return: entity as dict, or empty dict if no URI
+        '''
+        if not uri:
+            return dict()
+        found, entity = self.get_cached(entity="entity", key=uri)
+        if not found:
+            params = {"$format": "json"}
+            entity = (yield "send_limited", dict(method="GET", url=uri,
+                                                 params=params)).json().get("d", None).get("results", None) or dict()
+            self.set_cached(entity="entity", key=uri, value=entity)
+        return entity
+
+    def read_created_lead(self, entry, lead):
+        '''
+        Set ID, URI and ContactUUID of a newly created lead
+        :param entry: lead
+        :param lead: the created lead as returned by C4C
+        :return: ContactUUID of the lead
+        '''
+        contact_uuid = lead.get("ContactUUID", None)
+        entry["ID"] = lead.get("ID", None)
+        entry["URI"] = lead.get("__metadata", dict()).get("uri", None)
+        entry["ContactUUID"] = contact_uuid
+        return contact_uuid
+
+    def follow_up_lead(self, session_, lead, response, counts, tableid_to_inspect_more):
+        '''
+        Update a lead from the response of its Post or Patch,
+        then create or update its marketing permission and Z03 channel permission
+        :param session_: request session
+        :param lead: lead prepared by prepare_lead_for_post
+        :param response: response of the Post or Patch
+        :param counts: counts to update, see new_post_lead_log
+        :param tableid_to_inspect_more: problems to update, see new_post_lead_log
+        :return: None
+        '''
+        return self.run_steps(session_=session_, steps=self.follow_up_lead_steps(
+            lead=lead, response=response, counts=counts, tableid_to_inspect_more=tableid_to_inspect_more))
+
+    def run_steps(self, session_, steps):
+        '''
+        Send the requests that steps ask for, one after the other, and send their results back to steps
+        :param session_: request session
+        :param steps: generator that yields tuples of the name of a method of the client and its params other than session_,
+        see follow_up_lead_steps and the methods made with steps
+        :return: what steps returns
+        '''
+        result = None
+        while True:
+            try:
+                method, params = steps.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = getattr(self, method)(session_=session_, **params)
+
+    def follow_up_lead_steps(self, lead, response, counts, tableid_to_inspect_more):
+        '''
+        Decisions of follow_up_lead, independent of how requests are sent, so that they are shared by the clients.
+        Requests are yielded as tuples of the name of a method of the client and its params, see run_steps
+        :param lead: lead prepared by prepare_lead_for_post
+        :param response: response of the Post or Patch
+        :param counts: counts to update, see new_post_lead_log
+        :param tableid_to_inspect_more: problems to update, see new_post_lead_log
+        :return: generator of requests
+        '''
+        entry = lead["entry"]
+        entry_table_id = entry.get("TableID") or None
+        entry_task = entry.get("C4C_Task_Name", None) or None
+        entry_owner_uuid = entry.get("OwnerPartyUUID", None)
+        entry_consent = lead["consent"]
+
+        if lead["method"] == "PATCH":
+            entry_uri = lead["uri"]
+            entry_contact_uuid = lead["contact_uuid"]
+            # no response if the lead was unchanged and not sent
+            if response is not None and response.status_code not in lead["expected_status_codes"]:
+                logger.debug("Error with Patch entry with URI to C4C: {0}".format(entry_uri))
+                logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
+                # remove entry from data if failed to Patch to C4C
+                # data.remove(entry)
+                counts["patch_failed"] += 1
+                # continue
+            # change status after patched
+            else:
+                entry["C4C_Status"] = "updated"
+                # set OwnerPartyUUID if not existed, from the updated lead in the response if returned,
+                # a lead that was not sent because it is unchanged is not looked up for it
+                if not entry_owner_uuid and response is not None:
+                    updated_lead = self.read_entity(response=response)
+                    if updated_lead is None:
+                        updated_lead = yield "get_entity", dict(uri=entry_uri)
+                    entry["OwnerPartyUUID"] = updated_lead.get("OwnerPartyUUID", None)
+                z03_channel_uri = None
+                if lead["consent_changed"]:
+                    z03_channel_uri = yield "check_if_mark_p_existed", dict(contact_uuid=entry_contact_uuid)
+                if not lead["consent_changed"]:
+                    logger.debug("Consent of lead with TableID {0} unchanged since last push, skip Channel Permission".format(entry_table_id))
+                # patch if Z03 URI existed
+                # (z03_channel_uri is defined as a string)
+                elif z03_channel_uri and isinstance(z03_channel_uri, str):
+                    z03_patch_response = yield "post_z03_p", dict(c4c_task=entry_task,
+                                                                  consent=entry_consent, channel_uri=z03_channel_uri)
+                    if not z03_patch_response:
+                        tableid_to_inspect_more["error_updating_z03_for_existing_lead"].append(entry_table_id)
+                # create new marketing permission and channel permission if not existed yet
+                # (z03_channel_uri = False from above)
+                elif not z03_channel_uri and z03_channel_uri is not None and isinstance(z03_channel_uri, bool):
+                    if entry_contact_uuid:
+                        channel_uri, mark_p_object_id = yield "post_mark_p", dict(contact_uuid=entry_contact_uuid)
+                        # create/update channel permission after finish creating new marketing permission
+                        if channel_uri and mark_p_object_id:
+                            z03_post_response = yield "post_z03_p", dict(c4c_task="create_leads",
+                                                                         consent=entry_consent, channel_uri=channel_uri,
+                                                                         mark_p_object_id=mark_p_object_id)
                             if not z03_post_response:
                                 tableid_to_inspect_more["error_creating_z03_for_existing_lead"].append(entry_table_id)
-                        # inspect more if cannot find channel permission
                         else:
-                            logger.debug("Unable to get Channel Z03 Permission, require more inspection")
-                            tableid_to_inspect_more["unfound_z03_uri_for_both_existing_lead_and_mp"].append(entry_table_id)
-                        patch_count += 1
-            if not entry_id and not entry_uri and not entry_contact_uuid:
-                if entry_task == "create_leads":
-                    response = session_.post(url=self.lead_uri, headers=headers,
-                                             data=entry_reformatted_json)
-                    if response.status_code != 201:
-                        logger.debug("Error with Post entry with TableID to C4C: {0}".format(entry.get("TableID", None)))
-                        logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
-                        # data.remove(entry)
-                        post_failed_count += 1
-                        # continue
+                            tableid_to_inspect_more["error_creating_mp_for_existing_lead"].append(entry_table_id)
                     else:
-                        xml_tree = ET.fromstring(response.content.decode("utf-8"))
-                        contact_uuid = xml_tree[-1][0][9].text
-                        entry["ID"] = xml_tree[-1][0][1].text
-                        entry["URI"] = xml_tree[0].text
-                        entry["ContactUUID"] = contact_uuid
-                        entry["C4C_Status"] = "created"
-                        # set OwnerPartyUUID if not existed
-                        if not entry_owner_uuid:
-                            params = {"$format": "json"}
-                            entry["OwnerPartyUUID"] = session_.get(url=entry["URI"], params=params).json().get("d", None).get("results", None).get("OwnerPartyUUID", None)
-                        if contact_uuid:
-                            existing_mark_p = self.check_if_mark_p_existed(session_=session_, contact_uuid=contact_uuid)
-                            # create new marketing permission and channel permission if not existed yet
-                            # (existing_mark_p = False)
-                            if not existing_mark_p and existing_mark_p is not None and isinstance(existing_mark_p, bool):
-                                channel_uri, mark_p_object_id = self.post_mark_p(session_=session_, token=token, contact_uuid=contact_uuid)
-                                # create/update channel permission after finish creating new marketing permission
-                                if channel_uri and mark_p_object_id:
-                                    z03_post_response = self.post_z03_p(session_=session_, token=token, c4c_task=entry_task,
-                                                                        consent=entry_consent, channel_uri=channel_uri,
-                                                                        mark_p_object_id=mark_p_object_id)
-                                    if not z03_post_response:
-                                        tableid_to_inspect_more["error_creating_z03_for_new_lead"].append(entry_table_id)
-                                else:
-                                    tableid_to_inspect_more["error_creating_mp_for_new_lead"].append(entry_table_id)
-                            else:
-                                logger.debug("Marketing Permission already existed for a newly create Lead, require more inspection ")
-                                tableid_to_inspect_more["existed_mp_for_new_lead"].append(entry_table_id)
+                        logger.debug("No ContactUUID given cannot proceed with Post or Patch Channel Permission, require more inspection")
+                        tableid_to_inspect_more["no_contactuuid_for_existing_lead"].append(entry_table_id)
+                # create new Z03 Channel Permission if not existed yet, but Marketing Permission already existed
+                # (z03_channel_uri = (channel_uri, mark_p_object_id) from above)
+                elif isinstance(z03_channel_uri, tuple):
+                    channel_uri, mark_p_object_id = z03_channel_uri
+                    z03_post_response = yield "post_z03_p", dict(c4c_task="create_leads",
+                                                                 consent=entry_consent, channel_uri=channel_uri,
+                                                                 mark_p_object_id=mark_p_object_id)
+                    if not z03_post_response:
+                        tableid_to_inspect_more["error_creating_z03_for_existing_lead"].append(entry_table_id)
+                # inspect more if cannot find channel permission
+                else:
+                    logger.debug("Unable to get Channel Z03 Permission, require more inspection")
+                    tableid_to_inspect_more["unfound_z03_uri_for_both_existing_lead_and_mp"].append(entry_table_id)
+                if lead["consent_changed"]:
+                    # its Z03 Channel Permission may have been written
+                    self.invalidate_cached(entity="mp", key=str(entry_contact_uuid).upper())
+                self.record_pushed_lead(lead=lead, tableid_to_inspect_more=tableid_to_inspect_more)
+                if response is not None:
+                    counts["patch"] += 1
+        if lead["method"] == "POST":
+            if lead.get("outcome_unknown", False):
+                # C4C may have created the lead, it is looked up by resolve_unknown_leads instead of being Posted again
+                logger.debug("Unknown whether lead with TableID {0} was created in C4C".format(entry_table_id))
+                entry["C4C_Status"] = "unknown"
+                tableid_to_inspect_more["unknown_outcome_for_new_lead"].append(entry_table_id)
+                counts["post_unknown"] += 1
+            elif response.status_code != 201:
+                logger.debug("Error with Post entry with TableID to C4C: {0}".format(entry.get("TableID", None)))
+                logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
+                # data.remove(entry)
+                counts["post_failed"] += 1
+                # continue
+            else:
+                created_lead = self.read_entity(response=response)
+                if created_lead is None and response.headers.get("Location", None):
+                    # C4C did not return the created lead, get it from its location
+                    created_lead = yield "get_entity", dict(uri=response.headers.get("Location", None))
+                elif created_lead is None:
+                    logger.debug("C4C returned neither lead with TableID {0} nor its location, look it up".format(entry_table_id))
+                    tableid_to_inspect_more["no_body_nor_location_for_new_lead"].append(entry_table_id)
+                    created_lead = yield "look_up_lead", dict(lead=lead)
+                if not created_lead:
+                    # the lead was created, it is looked up again by resolve_unknown_leads instead of being Posted again
+                    entry["C4C_Status"] = "unknown"
+                    counts["post_unknown"] += 1
+                    return
+                contact_uuid = self.read_created_lead(entry=entry, lead=created_lead)
+                entry["C4C_Status"] = "created"
+                # set OwnerPartyUUID if not existed
+                if not entry_owner_uuid:
+                    entry["OwnerPartyUUID"] = created_lead.get("OwnerPartyUUID", None)
+                if contact_uuid:
+                    existing_mark_p = yield "check_if_mark_p_existed", dict(contact_uuid=contact_uuid)
+                    # create new marketing permission and channel permission if not existed yet
+                    # (existing_mark_p = False)
+                    if not existing_mark_p and existing_mark_p is not None and isinstance(existing_mark_p, bool):
+                        channel_uri, mark_p_object_id = yield "post_mark_p", dict(contact_uuid=contact_uuid)
+                        # create/update channel permission after finish creating new marketing permission
+                        if channel_uri and mark_p_object_id:
+                            z03_post_response = yield "post_z03_p", dict(c4c_task=entry_task,
+                                                                         consent=entry_consent, channel_uri=channel_uri,
+                                                                         mark_p_object_id=mark_p_object_id)
+                            if not z03_post_response:
+                                tableid_to_inspect_more["error_creating_z03_for_new_lead"].append(entry_table_id)
                         else:
-                            logger.debug("No ContactUUID given cannot proceed with Post or Patch Channel Permission, require more inspection")
-                            tableid_to_inspect_more["no_contactuuid_for_new_lead"].append(entry_table_id)
-                        post_count += 1
-        logger.debug("Finish Patch {0} and Post {1} leads to C4C".format(patch_count, post_count))
-        logger.debug("{0} leads failed Patch to C4C".format(patch_failed_count))
-        logger.debug("{0} leads failed Post to C4C".format(post_failed_count))
-        for problem in tableid_to_inspect_more:
-            logger.debug("Detect {0} problem(s) for '{1}': {2}".format(len(tableid_to_inspect_more[problem]),
-                                                                       problem,
-                                                                       tableid_to_inspect_more[problem]))
-        return data
+                            tableid_to_inspect_more["error_creating_mp_for_new_lead"].append(entry_table_id)
+                    else:
+                        logger.debug("Marketing Permission already existed for a newly create Lead, require more inspection ")
+                        tableid_to_inspect_more["existed_mp_for_new_lead"].append(entry_table_id)
+                else:
+                    logger.debug("No ContactUUID given cannot proceed with Post or Patch Channel Permission, require more inspection")
+                    tableid_to_inspect_more["no_contactuuid_for_new_lead"].append(entry_table_id)
+                if contact_uuid:
+                    # its Z03 Channel Permission may have been written
+                    self.invalidate_cached(entity="mp", key=str(contact_uuid).upper())
+                self.record_pushed_lead(lead=lead, tableid_to_inspect_more=tableid_to_inspect_more)
+                counts["post"] += 1
 
-    def delete_lead_data(self, session_, token, data):
-        headers = CaseInsensitiveDict({"x-csrf-token": token})
+    @steps
+    def delete_lead_data(self, data):
         for entry in data:
             entry_uri = entry.get("URI", None)
             if entry_uri:
-                response = session_.delete(url=entry_uri, headers=headers)
+                response = yield "write", dict(method="DELETE", url=entry_uri)
                 if response.status_code != 204:
                     logger.debug("Error while Delete entry with URI to C4C: {0}".format(entry_uri))
             else:
                 logger.debug("No URI to delete")
 
-    def check_if_mark_p_existed(self, session_, contact_uuid):
+    @steps
+    def get_mark_p(self, contact_uuid):
+        '''
+        Get a Marketing Permission together with its Channel Permissions in one request
+        :param contact_uuid: ContactUUID of a lead
+        :return: dict of the Marketing Permission and its Z03 Channel Permission, or None if not existed
+        '''
+        found, mark_p = self.get_cached(entity="mp", key=str(contact_uuid).upper())
+        if found:
+            return mark_p
+        response = yield "send_limited", dict(method="GET", url=self.mark_p_uri,
+                                              params=self.get_mark_p_params(contact_uuid=contact_uuid))
+        return self.read_mark_p(contact_uuid=contact_uuid, response=response)
+
+    def get_mark_p_params(self, contact_uuid):
+        return {"$format": "json",
+                "$filter": "BusinessPartnerUUID eq guid'{0}'".format(contact_uuid),
+                "$expand": "ChannelPermission"}
+
+    def read_mark_p(self, contact_uuid, response):
+        '''
+        Read the Marketing Permission of a contact from the response of get_mark_p, and cache it
+        :param contact_uuid: ContactUUID of a lead
+        :param response: response of the request
+        :return: dict of the Marketing Permission and its Z03 Channel Permission, or None if not existed
+        '''
+        results = response.json().get("d", None).get("results", None)
+        mark_p = self.format_mark_p(mark_p=results[0]) if results else None
+        self.set_cached(entity="mp", key=str(contact_uuid).upper(), value=mark_p)
+        return mark_p
+
+    @steps
+    def get_mark_ps(self, contact_uuids, chunk_size=c4c_config.filter_chunk_size):
+        '''
+        Get Marketing Permissions of many contacts with their Channel Permissions,
+        chunk_size contacts per request
+        :param contact_uuids: ContactUUIDs of leads
+        :param chunk_size: number of ContactUUIDs combined with "or" in one filter
+        :return: dict of ContactUUID and its Marketing Permission as given by format_mark_p, only for existing ones
+        '''
+        contact_uuids, uuids_to_get = self.get_mark_ps_to_get(contact_uuids=contact_uuids)
+        if uuids_to_get:
+            yield "look_up_in_chunks", dict(uri=self.mark_p_uri, params=self.get_mark_ps_params(),
+                                            key_field="BusinessPartnerUUID", keys=uuids_to_get,
+                                            chunk_size=chunk_size, type="mp", entity="mp", cache_entry=self.cache_mark_p)
+        return self.get_cached_mark_ps(contact_uuids=contact_uuids)
+
+    def get_mark_ps_params(self):
+        return {"$format": "json",
+                "$expand": "ChannelPermission"}
+
+    def get_mark_ps_to_get(self, contact_uuids):
+        '''
+        :param contact_uuids: ContactUUIDs of leads
+        :return: tuple of distinct ContactUUIDs, and those whose Marketing Permissions were not looked up earlier in the run
+        '''
+        contact_uuids = list(dict.fromkeys(uuid_ for uuid_ in contact_uuids if uuid_))
+        return contact_uuids, self.get_uncached(entity="mp", keys=contact_uuids)
+
+    def cache_mark_p(self, mark_p):
+        '''
+        Cache a Marketing Permission returned by look_up_in_chunks, the first one of a contact is kept
+        :param mark_p: Marketing Permission as returned by C4C
+        :return: None
+        '''
+        # C4C may return GUIDs in another case than given
+        key = str(mark_p.get("BusinessPartnerUUID", None)).upper()
+        if not self.get_cached(entity="mp", key=key)[1]:
+            self.set_cached(entity="mp", key=key, value=self.format_mark_p(mark_p=mark_p))
+
+    def get_cached_mark_ps(self, contact_uuids):
+        '''
+        :param contact_uuids: distinct ContactUUIDs
+        :return: dict of ContactUUID and its cached Marketing Permission, only for existing ones
+        '''
+        result = dict()
+        for contact_uuid in contact_uuids:
+            mark_p = self.get_cached(entity="mp", key=contact_uuid.upper())[1]
+            if mark_p:
+                result[contact_uuid] = mark_p
+        logger.debug("Found {0} Marketing Permissions for {1} ContactUUIDs".format(len(result), len(contact_uuids)))
+        return result
+
+    @steps
+    def look_up_in_chunks(self, uri, params, key_field, keys, entity, cache_entry, chunk_size=c4c_config.filter_chunk_size,
+                          type=None):
+        '''
+        Look up entries of a C4C collection by GUID keys, with chunk_size keys combined with "or" in one filter
+        to stay under URL length limits, and cache them chunk by chunk,
+        so that the chunks received before a failed one are not requested again
+        :param uri: collection URI
+        :param params: query params without $filter
+        :param key_field: GUID field to filter on
+        :param keys: GUIDs to get
+        :param entity: looked up entity to mark the keys of each finished chunk under with set_not_found
+        :param cache_entry: function that caches one entry under entity
+        :param chunk_size: number of keys per request
+        :param type: data type to report the expected total under
+        :return: None
+        '''
+        for i in range(0, len(keys), chunk_size):
+            chunk_params = dict(params)
+            chunk_params["$filter"] = " or ".join("{0} eq guid'{1}'".format(key_field, key) for key in keys[i:i + chunk_size])
+            entries = yield "collect_pages", dict(method="get_pages", params=dict(uri=uri, params=chunk_params, type=type))
+            for entry in entries:
+                cache_entry(entry)
+            self.set_not_found(entity=entity, keys=keys[i:i + chunk_size])
+
+    def format_mark_p(self, mark_p):
+        '''
+        Pick what is needed from a Marketing Permission fetched with $expand=ChannelPermission
+        :param mark_p: Marketing Permission as returned by C4C
+        :return: dict of the Marketing Permission and its Z03 Channel Permission
+        '''
+        channel_ps = mark_p.get("ChannelPermission", None) or []
+        # expanded navigation property is wrapped in "results" in OData v2 JSON
+        if isinstance(channel_ps, dict):
+            channel_ps = channel_ps.get("results", None) or []
+        z03 = next((channel_p for channel_p in channel_ps if channel_p.get("Channel", None) == "Z03"), None)
+        return {"BusinessPartnerUUID": mark_p.get("BusinessPartnerUUID", None),
+                "ObjectID": mark_p.get("ObjectID", None),
+                "BusinessPartner_ID": mark_p.get("BusinessPartner_ID", None),
+                "ChannelPermissionURI": mark_p.get("__metadata", None).get("uri", None) + "/ChannelPermission",
+                "Z03URI": z03.get("__metadata", None).get("uri", None) if z03 else None,
+                "Z03Consent": z03.get("Consent", None) if z03 else None}
+
+    @steps
+    def check_if_mark_p_existed(self, contact_uuid, mark_p=None):
         '''
         Check if a lead has a Marketing Permission and return it, else return False
-        :param session_: request session
         :param contact_uuid: ContactUUID of a lead
+        :param mark_p: Marketing Permission already got with get_mark_p, fetched if not given
         :return: Channel Z03 URI if existed or False if not existed
         '''
-        headers = None
-        params = {"$format": "json",
-                  "$filter": "BusinessPartnerUUID eq guid'{0}'".format(contact_uuid)}
-        response = session_.get(url=self.mark_p_uri, headers=headers,
-                                params=params).json().get("d", None).get("results", None)
-        if response:
+        if mark_p is None:
+            mark_p = yield "get_mark_p", dict(contact_uuid=contact_uuid)
+        if mark_p:
             logger.debug("Marketing Permission for ContactUUID {0} existed".format(contact_uuid))
-            params = {"$format": "json",
-                      "$filter": "Channel eq 'Z03'"}
-            channel_uri = response[0].get("ChannelPermission", None).get("__deferred", None).get("uri", None)
-            mark_p_object_id = response[0].get("ObjectID", None)
-            z03_response = session_.get(url=channel_uri, headers=headers, params=params).json().get("d", None).get("results", None)
             # return z03 uri if existed
-            if z03_response:
-                z03_uri = z03_response[0].get("__metadata", None).get("uri", None)
+            if mark_p["Z03URI"]:
                 logger.debug("Z03 Channel Permission for ContactUUID {0} existed".format(contact_uuid))
-                return z03_uri
+                return mark_p["Z03URI"]
             # else return channel uri and marketing permission objectid for z03 permission creation
             else:
                 logger.debug("Z03 Channel Permission for ContactUUID {0} not existed".format(contact_uuid))
-                return channel_uri, mark_p_object_id
+                return mark_p["ChannelPermissionURI"], mark_p["ObjectID"]
         else:
             logger.debug("Marketing Permission for ContactUUID {0} not existed".format(contact_uuid))
             return False
 
-    def post_mark_p(self, session_, token, contact_uuid):
-        headers = CaseInsensitiveDict({"Content-Type": "application/json", "x-csrf-token": token})
+    @steps
+    def post_mark_p(self, contact_uuid):
+        headers = CaseInsensitiveDict({"Content-Type": "application/json", **c4c_config.representation_headers})
         data = json.dumps({"BusinessPartnerUUID": contact_uuid}, ensure_ascii=False).encode()
-        response = session_.post(url=self.mark_p_uri, headers=headers, data=data)
+        self.invalidate_cached(entity="mp", key=str(contact_uuid).upper())
+        response = yield "write", dict(method="POST", url=self.mark_p_uri, headers=headers, data=data)
+        return self.read_created_mark_p(contact_uuid=contact_uuid, response=response)
+
+    def read_created_mark_p(self, contact_uuid, response):
+        '''
+        Read a newly created Marketing Permission from the Post response
+        :param contact_uuid: ContactUUID of a lead
+        :param response: response of the Post
+        :return: tuple of channel permission URI and Marketing Permission ObjectID, or (None, None) if failed
+        '''
         if response.status_code != 201:
             logger.debug("Error with Post new Marketing Permission with ContactUUID to C4C: {0}".format(contact_uuid))
             logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
             return None, None
         else:
             logger.debug("Finish Post 1 Marketing Permission with ContactUUID to C4C: {0}".format(contact_uuid))
-            xml_tree = ET.fromstring(response.content.decode("utf-8"))
-            channel_uri = xml_tree[0].text + "/ChannelPermission"
-            mark_p_object_id = re.findall(r"'(.*?)'", channel_uri)[0]
+            mark_p = self.read_entity(response=response) or dict()
+            mark_p_uri = mark_p.get("__metadata", dict()).get("uri", None) or response.headers.get("Location", None)
+            if not mark_p_uri:
+                return None, None
+            channel_uri = mark_p_uri + "/ChannelPermission"
+            # ObjectID is also the key in the URI
+            mark_p_object_id = mark_p.get("ObjectID", None) or re.findall(r"'(.*?)'", mark_p_uri)[0]
             return channel_uri, mark_p_object_id
 
-    def post_z03_p(self, session_, token, c4c_task, consent, channel_uri, mark_p_object_id=None):
+    def encode_z03_p(self, c4c_task, consent, mark_p_object_id=None):
+        '''
+        Create the body to Post or Patch a Z03 Channel Permission
+        :param c4c_task: create_leads to Post, update_leads to Patch
+        :param consent: consent of the lead, "1" or "0"
+        :param mark_p_object_id: ObjectID of the parent Marketing Permission
+        :return: JSON body
+        '''
         if consent == "1":
             encoded_consent = "1"
         elif consent == "0":
             encoded_consent = "2"
         else:
             encoded_consent = "3"
-        headers = CaseInsensitiveDict({"Content-Type": "application/json",
-                                       "x-csrf-token": token})
-        data = json.dumps({"ParentObjectID": mark_p_object_id, "Channel": "Z03", "Consent": encoded_consent}, ensure_ascii=False).encode()
+        if c4c_task == "update_leads":
+            return json.dumps({"Channel": "Z03", "Consent": encoded_consent}, ensure_ascii=False).encode()
+        return json.dumps({"ParentObjectID": mark_p_object_id, "Channel": "Z03", "Consent": encoded_consent}, ensure_ascii=False).encode()
+
+    def read_z03_p_response(self, c4c_task, channel_uri, response):
+        '''
+        Check the response of a Post or Patch of a Z03 Channel Permission
+        :return: True if successful, else False
+        '''
         if c4c_task == "create_leads":
-            response = session_.post(url=channel_uri, headers=headers, data=data)
             if response.status_code != 201:
                 logger.debug("Error with Post 1 Channel Z03 Permission with channel URI to C4C: {0}".format(channel_uri))
                 logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
@@ -561,8 +1612,6 @@ class C4CClient:
                 logger.debug("Finish Post 1 Channel Z03 Permission with URI to C4C: {0}".format(channel_uri))
                 return True
         if c4c_task == "update_leads":
-            data = json.dumps({"Channel": "Z03", "Consent": encoded_consent}, ensure_ascii=False).encode()
-            response = session_.patch(url=channel_uri, headers=headers, data=data)
             if response.status_code != 204:
                 logger.debug("Error with Patch 1 Channel Z03 Permission with URI in C4C: {0}".format(channel_uri))
                 logger.debug("Error status code {0} with text: {1}".format(response.status_code, response.text))
@@ -570,3 +1619,15 @@ class C4CClient:
             else:
                 logger.debug("Finish Patch 1 Channel Z03 Permission with URI to C4C: {0}".format(channel_uri))
                 return True
+
+    @steps
+    def post_z03_p(self, c4c_task, consent, channel_uri, mark_p_object_id=None):
+        headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        data = self.encode_z03_p(c4c_task=c4c_task, consent=consent, mark_p_object_id=mark_p_object_id)
+        if c4c_task == "create_leads":
+            response = yield "write", dict(method="POST", url=channel_uri, headers=headers, data=data)
+        elif c4c_task == "update_leads":
+            response = yield "write", dict(method="PATCH", url=channel_uri, headers=headers, data=data)
+        else:
+            return None
+        return self.read_z03_p_response(c4c_task=c4c_task, channel_uri=channel_uri, response=response)
@@ -1,3 +1,50 @@
+# paging
+# C4C OData returns at most 1000 entries per page
+page_size = 1000
+
+# $batch
+# number of leads sent per $batch request, each lead in its own changeset
+lead_batch_size = 100
+
+# concurrent fetch
+# number of collections fetched at the same time by fetch_data_pages, each with its own requests session
+fetch_workers = 4
+# number of pages fetched ahead of the DB writes per collection
+fetch_queue_pages = 20
+
+# backfill
+# EntityLastChangedOn range of each shard of a first-run backfill, fetched concurrently and checkpointed one by one
+backfill_shard_days = 30
+
+# lead queue
+# leads claimed by an import_c4c worker at a time, locked with FOR UPDATE SKIP LOCKED so that concurrent workers claim different leads
+claim_batch_size = 500
+# seconds until the leads of a worker that crashed can be claimed again, longer than it takes to send a batch
+claim_lease_seconds = 900
+
+# async client
+# number of leads posted to C4C at the same time by AsyncC4CClient
+max_in_flight = 8
+
+# adaptive rate limiting
+# responses of C4C throttling requests, the request was not processed and is sent again
+throttle_status_codes = (429, 503)
+max_throttle_retries = 3
+# requests in flight start at max_in_flight, which is also their maximum,
+# are halved on throttling and connection errors, and raised back by one per limit's worth of responses
+min_in_flight = 1
+throttle_decrease_factor = 0.5
+
+# writes
+# fields of a lead that C4C assigns, left out of the payload hash and of the fields compared with the last push
+lead_server_assigned_fields = ("ContactUUID", "OwnerPartyUUID")
+# ask C4C to return the created or updated entity as JSON, so that no follow-up GET is needed
+representation_headers = {"Accept": "application/json", "Prefer": "return=representation"}
+
+# multi-key filter
+# number of GUIDs combined with "or" in one $filter, sized to stay under URL length limits
+filter_chunk_size = 50
+
 # contact
 contact_c4c_uri = "ContactCollection"
 # no space allowed
@@ -50,7 +97,9 @@ chan_p_c4c_fields = "Channel,Consent"
 # employee
 emp_c4c_uri = "EmployeeCollection"
 emp_c4c_fields = "UUID,FirstName,LastName,Email,CountryCode,BusinessPartnerID," \
-                 "EmployeeOrganisationalUnitAssignment,EntityLastChangedOn"
+                 "EmployeeOrganisationalUnitAssignment/OrgUnitID,EntityLastChangedOn"
+# organisational units are expanded inline instead of one request per employee
+emp_c4c_expand = "EmployeeOrganisationalUnitAssignment"
 
 # business partner
 bus_p_uri = "BusinessPartnerCollection"
@@ -0,0 +1,117 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from c4c import c4c_config
+
+
+def parse_retry_after(value):
+    '''
+    Parse a Retry-After header, given either in seconds or as an HTTP date
+    :param value: Retry-After header
+    :return: seconds to wait, or None if not given or not parsable
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    '''
+    Client side limit of requests in flight to C4C, adapted to congestion with AIMD:
+    the limit is halved on a throttled response or request failed without response, at most once per round trip:
+    requests already in flight when it was halved were sent at the old limit, so their congestion is not counted again.
+    It is raised by one after a limit's worth of successful responses, up to the configured limit,
+    so that it settles at the concurrency the tenant tolerates. Retry-After of throttled responses pauses all requests until it has passed.
+    Shared by the threads of a client
+    '''
+    def __init__(self, limit=c4c_config.max_in_flight, min_limit=c4c_config.min_in_flight, max_limit=None,
+                 decrease_factor=c4c_config.throttle_decrease_factor):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        # the configured limit is not exceeded, unless a higher one is given
+        self.max_limit = max_limit or limit
+        self.decrease_factor = decrease_factor
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        # number of the last request sent, and of the last one sent before the limit was last decreased
+        self.sent = 0
+        self.sent_before_decrease = 0
+        # monotonic time until which requests wait because of Retry-After
+        self.paused_until = 0.0
+        self.started_at = time.monotonic()
+        self.responses = 0
+        self.throttled = 0
+        self.failed = 0
+
+    @property
+    def current_limit(self):
+        return max(self.min_limit, int(self.limit))
+
+    def is_throttled(self, status_code):
+        return status_code in c4c_config.throttle_status_codes
+
+    def wait_time(self):
+        return max(0.0, self.paused_until - time.monotonic())
+
+    def can_send(self):
+        return self.in_flight < self.current_limit
+
+    def on_send(self):
+        '''
+        :return: number of the request, to give back to on_response
+        '''
+        with self.lock:
+            self.in_flight += 1
+            self.sent += 1
+            return self.sent
+
+    def on_response(self, status_code, retry_after=None, send_number=None):
+        '''
+        Adapt the limit to a response
+        :param status_code: status code of the response, None if the request failed without response
+        :param retry_after: Retry-After header of the response
+        :param send_number: number of the request given by on_send, the limit is not decreased again
+            for a request sent before its last decrease. Taken as sent after it if not given
+        :return: None
+        '''
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.responses += 1
+            # a connection error or timeout is congestion as well
+            if status_code is None or self.is_throttled(status_code):
+                if status_code is None:
+                    self.failed += 1
+                else:
+                    self.throttled += 1
+                # multiplicative decrease, once for all the requests in flight at the time
+                if send_number is None or send_number > self.sent_before_decrease:
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                    self.sent_before_decrease = self.sent
+                pause = parse_retry_after(retry_after)
+                if pause:
+                    self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            else:
+                # additive increase, by one per limit's worth of responses
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def metrics(self):
+        '''
+        :return: dict of the current limit, requests in flight, responses, throttled responses,
+        requests failed without response and responses per second
+        '''
+        elapsed = time.monotonic() - self.started_at
+        return {"limit": self.current_limit,
+                "in_flight": self.in_flight,
+                "responses": self.responses,
+                "throttled": self.throttled,
+                "failed": self.failed,
+                "rate": round(self.responses / elapsed, 2) if elapsed > 0 else 0.0}
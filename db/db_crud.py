@@ -1,11 +1,15 @@
+import re
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from sqlalchemy.orm import Session
-from sqlalchemy import delete
+from sqlalchemy import and_, delete, exists, func, or_, select, tuple_
+from sqlalchemy.sql import table as sql_table, column as sql_column
+from sqlalchemy.dialects.postgresql import insert
 
 from db.tables_init import *
 from logging_config import setup_logging
+from settings import DB_UPSERT_BATCH_SIZE, DB_COPY_ENTITIES
 
 logger = setup_logging(__name__)
 
@@ -73,26 +77,17 @@ def create_query(session_, purpose, type):
                                    Lead.C_SAP_UTM_Medium_Recent1, Lead.C_SAP_UTM_Source_Recent1,
                                    Lead.ContactUUID, Lead.URI, Lead.C4C_Task_Name, Lead.C4C_Status,
                                    Lead.C_EML_GROUP_Professional1, Lead.C_EML_GROUP_Roofs_and_renovations1,
-                                   Lead.C_SFDC_Survey_Status_Installation1)
+                                   Lead.C_SFDC_Survey_Status_Installation1,
+                                   Lead.C4C_Payload_Hash, Lead.C4C_Consent_Hash, Lead.C4C_Last_Payload)
         if type == "tg":
             query = session_.query(TargetGroup.TargetGroupID, TargetGroup.Name)
         if type == "emp":
             query = session_.query(Employee.Name, Employee.EmployeeID)
-    if purpose == "sort_upsert_data":
-        if type == "contact":
-            query = session_.query(Contact.C_SFDCContactID)
-        if type == "account":
-            query = session_.query(Account.M_SFDCAccountID)
+    if purpose == "upsert":
         if type == "lead":
-            query = session_.query(Lead.TableID, Lead.C_SAP_Lead_ID1, Lead.C4C_Task_Name, Lead.C4C_Status)
-        if type == "tg":
-            query = session_.query(TargetGroup.TargetGroupID)
+            query = session_.query(Lead.TableID, Lead.C_SAP_Lead_ID1)
         if type == "tgm":
-            query = session_.query(TargetGroupMember.C_SFDCContactID)
-        if type == "mp":
-            query = session_.query(MarketingPermission.ContactUUID)
-        if type == "emp":
-            query = session_.query(Employee.EmployeeID)
+            query = session_.query(TargetGroupMember.C_SFDCContactID, TargetGroupMember.TargetGroupID)
     # add other purposes here
     # e.g. if purpose == "..."
     # also, can add cols for outbound integration to Lead query
@@ -158,12 +153,89 @@ def get_data_by_time(session_, purpose, type, date_from=None, date_to=None):
     return result
 
 
-def get_data_for_c4c_import(session_):
-    return create_query(session_=session_, purpose="c4c_import", type="lead").filter(Lead.C4C_Status == "pending").all()
+def claim_leads(session_, worker_id, batch_size, lease_seconds, after_table_id=0):
+    '''
+    Claim a batch of leads to import to C4C: pending leads, and processing leads whose claim expired because their worker
+    did not finish them. The leads are locked with FOR UPDATE SKIP LOCKED while they are claimed, so that concurrent workers
+    skip each other's leads instead of waiting for them, and become "processing" until the claim expires
+    :param session_: SQL session, commit it right away for other workers to see the claim
+    :param worker_id: ID of the worker claiming the leads
+    :param batch_size: max number of leads to claim
+    :param lease_seconds: seconds until the claim expires
+    :param after_table_id: only claim leads with a greater TableID, so that a worker does not claim again the leads it
+    failed to send in the same run
+    :return: list of claimed leads with the columns of create_query for c4c_import, in order of TableID
+    '''
+    claimable_leads = select([Lead.TableID]).where(and_(
+        Lead.TableID > after_table_id,
+        or_(Lead.C4C_Status == "pending",
+            and_(Lead.C4C_Status == "processing",
+                 # processing leads claimed before leases were added have none
+                 or_(Lead.C4C_Lease_Expires_UTC == None, Lead.C4C_Lease_Expires_UTC < func.now())))
+    )).order_by(Lead.TableID).limit(batch_size).with_for_update(skip_locked=True)
+    columns = [Lead.__table__.c[column["name"]]
+               for column in create_query(session_=session_, purpose="c4c_import", type="lead").column_descriptions]
+    result = session_.execute(
+        Lead.__table__.update()
+            .values
+                (
+                    C4C_Status="processing",
+                    C4C_Claimed_By=worker_id,
+                    C4C_Lease_Expires_UTC=func.now() + timedelta(seconds=lease_seconds)
+                )
+            .where(Lead.TableID.in_(claimable_leads))
+            .returning(*columns)
+    ).fetchall()
+    return sorted(result, key=lambda entry: entry[0])
 
 
-def get_data_to_try_again(session_):
-    return create_query(session_=session_, purpose="c4c_import", type="lead").filter(Lead.C4C_Status == "processing").all()
+def renew_leads(session_, worker_id, table_ids, lease_seconds):
+    '''
+    Extend the claim of leads that a worker is about to send, so that their claim does not expire while they are sent
+    :param session_: SQL session, commit it right away
+    :param worker_id: ID of the worker that claimed the leads
+    :param table_ids: TableIDs of the leads
+    :param lease_seconds: seconds from now until the claim expires
+    :return: set of TableIDs of the leads still claimed by the worker, others were claimed by another worker meanwhile
+    '''
+    if not table_ids:
+        return set()
+    result = session_.execute(
+        Lead.__table__.update()
+            .values(C4C_Lease_Expires_UTC=func.now() + timedelta(seconds=lease_seconds))
+            .where(and_(Lead.TableID.in_(table_ids),
+                        Lead.C4C_Status == "processing",
+                        Lead.C4C_Claimed_By == worker_id))
+            .returning(Lead.TableID)
+    ).fetchall()
+    return set(entry[0] for entry in result)
+
+
+def release_leads(session_, worker_id):
+    '''
+    Make the leads that a worker claimed but did not send pending again, to be claimed by the next run
+    :param session_: SQL session
+    :param worker_id: ID of the worker that claimed the leads
+    :return: number of leads released
+    '''
+    return session_.execute(
+        Lead.__table__.update()
+            .values(C4C_Status="pending", C4C_Claimed_By=None, C4C_Lease_Expires_UTC=None)
+            .where(and_(Lead.C4C_Status == "processing", Lead.C4C_Claimed_By == worker_id))
+    ).rowcount
+
+
+def get_unknown_leads(session_, batch_size):
+    '''
+    Get leads whose Post to C4C was in a failed $batch, so it is not known whether C4C created them,
+    or was answered without the created lead nor its location.
+    They are locked with FOR UPDATE SKIP LOCKED until the session ends, so that concurrent workers look up different leads
+    :param session_: SQL session, to write the looked up leads back to before it ends
+    :param batch_size: max number of leads to get
+    :return: list of leads with the columns of create_query for c4c_import, in order of TableID
+    '''
+    return create_query(session_=session_, purpose="c4c_import", type="lead").filter(Lead.C4C_Status == "unknown")\
+        .order_by(Lead.TableID).limit(batch_size).with_for_update(skip_locked=True).all()
 
 
 def get_data_for_eloqua_import(session_, type):
@@ -176,74 +248,99 @@ def get_data_for_eloqua_import(session_, type):
     return result
 
 
-def sort_upsert_data(session_, type, data, outbound=None):
+def upsert_rows(session_, table, rows, index_elements, batch_size=DB_UPSERT_BATCH_SIZE, copy=False, where=None):
     '''
-    Sort data into data to update, data to write and existing data in DB
+    Upsert rows with INSERT ... ON CONFLICT DO UPDATE, one statement per batch of rows.
+    Rows with the same key are deduplicated first, the last one wins, because Postgres cannot update a row twice in one statement
     :param session_: SQL session
-    :param type: data type matching table name
-    :param data: raw data to sort
-    :return: tuple of: (1) dict of (a) data to update, and (b) data to write, and (2) existing data in DB
-    '''
-    ids_to_update = []
-    result = dict()
-    if type == "contact" or type == "tgm":
-        ids = [entry_["ContactID"] for entry_ in data]
-        existing_data = None
-        if type == "contact":
-            existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(Contact.C_SFDCContactID.in_(ids)).all()
-        if type == "tgm":
-            existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(TargetGroupMember.C_SFDCContactID.in_(ids)).all()
-        for entry in existing_data:
-            ids_to_update.append(entry[0])
-        result["entries_to_update"] = [entry for entry in data if entry["ContactID"] in ids_to_update]
-        result["entries_to_insert"] = [entry for entry in data if entry["ContactID"] not in ids_to_update]
-    if type == "account":
-        ids = [entry_["AccountID"] for entry_ in data]
-        existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(Account.M_SFDCAccountID.in_(ids)).all()
-        for entry in existing_data:
-            ids_to_update.append(entry[0])
-        result["entries_to_update"] = [entry for entry in data if entry["AccountID"] in ids_to_update]
-        result["entries_to_insert"] = [entry for entry in data if entry["AccountID"] not in ids_to_update]
-    if type == "lead":
-        if type == "lead":
-            if outbound:
-                ids = [entry_["TableID"] for entry_ in data]
-                existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(
-                    Lead.TableID.in_(ids)).all()
-                for entry in existing_data:
-                    ids_to_update.append(entry[0])
-                result["entries_to_update"] = [entry for entry in data if entry["TableID"] in ids_to_update]
-                result["entries_to_insert"] = [entry for entry in data if entry["TableID"] not in ids_to_update]
-            else:
-                ids = [entry_["ID"] for entry_ in data]
-                existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(
-                    Lead.C_SAP_Lead_ID1.in_(ids)).all()
-                for entry in existing_data:
-                    ids_to_update.append(entry[1])
-                result["entries_to_update"] = [entry for entry in data if entry["ID"] in ids_to_update]
-                result["entries_to_insert"] = [entry for entry in data if entry["ID"] not in ids_to_update]
-    if type == "tg":
-        ids = [entry_["ID"] for entry_ in data]
-        existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(TargetGroup.TargetGroupID.in_(ids)).all()
-        for entry in existing_data:
-            ids_to_update.append(entry[0])
-        result["entries_to_update"] = [entry for entry in data if entry["ID"] in ids_to_update]
-        result["entries_to_insert"] = [entry for entry in data if entry["ID"] not in ids_to_update]
-    if type == "mp":
-        ids = [entry_["BusinessPartnerUUID"] for entry_ in data]
-        existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(MarketingPermission.ContactUUID.in_(ids)).all()
-        for entry in existing_data:
-            ids_to_update.append(entry[0])
-        result["entries_to_update"] = [entry for entry in data if entry["BusinessPartnerUUID"] in ids_to_update]
-        result["entries_to_insert"] = [entry for entry in data if entry["BusinessPartnerUUID"] not in ids_to_update]
-    if type == "emp":
-        ids = [entry_["UUID"] for entry_ in data]
-        existing_data = create_query(session_=session_, purpose="sort_upsert_data", type=type).filter(Employee.EmployeeID.in_(ids)).all()
-        for entry in existing_data:
-            ids_to_update.append(entry[0])
-        result["entries_to_update"] = [entry for entry in data if entry["UUID"] in ids_to_update]
-        result["entries_to_insert"] = [entry for entry in data if entry["UUID"] not in ids_to_update]
-    return result
+    :param table: table to upsert into, e.g. Contact.__table__
+    :param rows: list of dicts of column: value, all with the same columns
+    :param index_elements: list of columns of the primary key that conflicts are detected on
+    :param batch_size: number of rows per statement
+    :param copy: True to COPY the rows into a staging table and upsert them from there in one statement instead
+    :param where: condition on the existing row for it to be updated, rows that do not meet it are left as they are
+    :return: number of rows upserted
+    '''
+    unique_rows = list({tuple(row[column] for column in index_elements): row for row in rows}.values())
+    if copy:
+        staging = copy_to_staging(session_=session_, table=table, rows=unique_rows)
+        statement = insert(table).from_select(list(staging.c.keys()), select(list(staging.c)))
+        session_.execute(statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in staging.c.keys() if column not in index_elements},
+            where=where))
+        return len(unique_rows)
+    for i in range(0, len(unique_rows), batch_size):
+        batch = unique_rows[i:i + batch_size]
+        statement = insert(table).values(batch)
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in batch[0] if column not in index_elements},
+            where=where)
+        session_.execute(statement)
+    return len(unique_rows)
+
+
+class CopyRows:
+    '''
+    File-like object that COPY FROM STDIN reads rows from in CSV format,
+    formatting them as they are read instead of building the whole file in memory
+    '''
+    def __init__(self, rows, columns):
+        self.lines = (",".join(self.format_value(row[column]) for column in columns) + "\n" for row in rows)
+        self.buffer = ""
+
+    @staticmethod
+    def format_value(value):
+        # an unquoted empty value is NULL, anything else is quoted so that empty strings stay empty strings
+        if value is None:
+            return ""
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        result, self.buffer = self.buffer[:size], self.buffer[size:]
+        return result
+
+
+def copy_rows(session_, table_name, columns, rows):
+    '''
+    COPY rows into a table in the transaction of the session
+    :param session_: SQL session
+    :param table_name: name of the table
+    :param columns: list of columns of the rows
+    :param rows: list of dicts of column: value
+    :return: None
+    '''
+    cursor = session_.connection().connection.cursor()
+    try:
+        cursor.copy_expert("COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(
+            table_name, ", ".join('"{0}"'.format(column) for column in columns)), CopyRows(rows=rows, columns=columns))
+    finally:
+        cursor.close()
+
+
+def copy_to_staging(session_, table, rows):
+    '''
+    COPY rows into a temporary staging table with the columns of the rows, which is dropped at the end of the transaction
+    :param session_: SQL session
+    :param table: table that the rows are merged into, e.g. Contact.__table__
+    :param rows: list of dicts of column: value, all with the same columns
+    :return: staging table
+    '''
+    columns = list(rows[0])
+    staging_name = "staging_" + table.name
+    session_.execute("DROP TABLE IF EXISTS {0}".format(staging_name))
+    session_.execute("CREATE TEMP TABLE {0} ON COMMIT DROP AS SELECT {1} FROM {2} WITH NO DATA".format(
+        staging_name, ", ".join('"{0}"'.format(column) for column in columns), table.name))
+    copy_rows(session_=session_, table_name=staging_name, columns=columns, rows=rows)
+    return sql_table(staging_name, *[sql_column(column) for column in columns])
 
 
 def decode_c4c_date_time(date_time_string):
@@ -254,618 +351,489 @@ def decode_c4c_date_time(date_time_string):
     return "{0}T{1}".format(date, time)
 
 
+def parse_c4c_date_time_offset(date_time_string):
+    '''
+    Parse a C4C Edm.DateTimeOffset in OData JSON format, e.g. /Date(1600000000000)/ or /Date(1600000000000+0120)/
+    :param date_time_string: date time string from C4C
+    :return: datetime in UTC, None if not parsable
+    '''
+    match = re.match(r"/Date\((-?\d+)(?:[+-]\d{4})?\)/", date_time_string or "")
+    if not match:
+        return None
+    # the ticks are in UTC, the offset is only informative
+    return datetime.fromtimestamp(int(match.group(1)) / 1000, tz=timezone.utc)
+
+
+def get_watermark(session_, entity):
+    '''
+    Get the watermark of an entity in C4C date time format to filter EntityLastChangedOn with
+    :param session_: SQL session
+    :param entity: entity of the watermark
+    :return: date time string e.g. 2020-07-06T00:00:00Z, None if no data of the entity ingested yet
+    '''
+    watermark = session_.query(SyncWatermark.LastChangedOn).filter(SyncWatermark.Entity == entity).scalar()
+    if watermark:
+        # EntityLastChangedOn ge the watermark in seconds,
+        # entries changed in the same second as the watermark are downloaded again and upserted idempotently
+        return watermark.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return None
+
+
+def advance_watermark(session_, entity, data):
+    '''
+    Advance the watermark of an entity to the max EntityLastChangedOn of ingested data,
+    in the same SQL session as the data so that both are committed together
+    :param session_: SQL session
+    :param entity: entity of the watermark
+    :param data: ingested data from C4C
+    :return: None
+    '''
+    changed_ons = [parse_c4c_date_time_offset(entry.get("EntityLastChangedOn", None)) for entry in data or []]
+    changed_ons = [changed_on for changed_on in changed_ons if changed_on]
+    if not changed_ons:
+        return
+    last_changed_on = max(changed_ons)
+    existing_watermark = session_.query(SyncWatermark.Entity, SyncWatermark.LastChangedOn)\
+        .filter(SyncWatermark.Entity == entity).first()
+    if not existing_watermark:
+        session_.execute(SyncWatermark.__table__.insert(),
+                         [dict(Entity=entity, LastChangedOn=last_changed_on, TimeInsertedUTC=datetime.utcnow())])
+    elif not existing_watermark[1] or last_changed_on > existing_watermark[1]:
+        session_.execute(SyncWatermark.__table__.update()
+                         .values(LastChangedOn=last_changed_on, TimeInsertedUTC=datetime.utcnow())
+                         .where(SyncWatermark.Entity == entity))
+    else:
+        return
+    logger.debug("Advance watermark of {0} to {1}".format(entity, last_changed_on))
+
+
+def get_completed_shards(session_, entity):
+    '''
+    Get the backfill shards of an entity that were completed
+    :param session_: SQL session
+    :param entity: entity of the backfill
+    :return: dict of DateFrom: DateTo of completed shards, in UTC
+    '''
+    return {date_from.astimezone(timezone.utc): date_to.astimezone(timezone.utc)
+            for date_from, date_to in session_.query(BackfillShard.DateFrom, BackfillShard.DateTo)
+            .filter(BackfillShard.Entity == entity).all()}
+
+
+def complete_shard(session_, entity, date_from, date_to, entry_count):
+    '''
+    Record a backfill shard as completed, in the same SQL session as its data so that both are committed together
+    :param session_: SQL session
+    :param entity: entity of the backfill
+    :param date_from: start of the shard
+    :param date_to: end of the shard, excluded
+    :param entry_count: number of entries ingested in the shard
+    :return: None
+    '''
+    # a shard of another size starting at the same time is replaced
+    session_.execute(delete(BackfillShard).where(BackfillShard.Entity == entity).where(BackfillShard.DateFrom == date_from))
+    session_.execute(BackfillShard.__table__.insert(),
+                     [dict(Entity=entity, DateFrom=date_from, DateTo=date_to, EntryCount=entry_count,
+                           TimeInsertedUTC=datetime.utcnow())])
+    logger.debug("Complete backfill shard of {0} from {1} to {2} with {3} entries".format(entity, date_from, date_to,
+                                                                                          entry_count))
+
+
+def contact_row(entry, time_inserted):
+    return dict(
+        C_SFDCContactID=entry.get("ContactID", None),
+        C_Company=entry.get("AccountUUID", None) or None,
+        C_SFDCAccountID=entry.get("AccountID", None) or None,
+        C_City=entry.get("BusinessAddressCity", None) or None,
+        C_Country=entry.get("BusinessAddressCountryCode", None) or None,
+        C_EmailAddress=entry.get("Email", None) or None,
+        C_SAP_Field_of_Work1=entry.get("ZFieldofWork", None) or None,
+        C_FirstName=entry.get("FirstName", None) or None,
+        C_LastName=entry.get("LastName", None) or None,
+        C_Title=entry.get("JobTitle", None) or None,
+        C_MobilePhone=entry.get("Mobile", None) or None,
+        C_SAP_Dealer_ID1=entry.get("ContactOwnerUUID", None) or None,
+        C_BusPhone=entry.get("Phone", None) or None,
+        C_SAP___Is_Plannja_Dealer1=entry.get("ZisPlannjaDealer", None) or None,
+        C_SAP_Contact_Status1=entry.get("StatusCode", None) or None,
+        C_Zip_Postal=entry.get("BusinessAddressStreetPostalCode", None) or None,
+        C_SAP_Plannja_Price_List1=entry.get("ZPlannjaPricelist", None) or None,
+        ContactUUID=entry.get("ContactUUID", None) or None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def account_row(entry, time_inserted):
+    return dict(
+        M_SFDCAccountID=entry.get("AccountID", None),
+        M_Address1=entry.get("AddressLine1", None) or None,
+        M_SAP_BC_ABC_Classification1=entry.get("ZBCABCClassification", None) or None,
+        M_City=entry.get("City", None) or None,
+        M_Country=entry.get("CountryCode", None) or None,
+        M_CompanyName=entry.get("Name", None) or None,
+        M_SAP_Dealer_ID1=entry.get("OwnerUUID", None) or None,
+        M_SAP_RC_Customer_Segment1=entry.get("ZRCCustomerSegments_KUT", None) or None,
+        M_SAP_Account_Role1=entry.get("RoleCode", None) or None,
+        M_SAP_RR_ABC_Classification1=entry.get("ZRRABCClassification", None) or None,
+        M_SAP_RR_Tactical_Classification1=entry.get("ZRRTacticalClassification", None) or None,
+        M_SAP_Account_Status1=entry.get("LifeCycleStatusCode", None) or None,
+        M_Zip_Postal=entry.get("StreetPostalCode", None) or None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def inbound_lead_row(entry, time_inserted):
+    return dict(
+        C_SAP_Lead_ID1=entry.get("ID", None),
+        C_SFDC___Lead_Record_Type_ID1=entry.get("GroupCode", None) or None,
+        C_SFDC___Lead_Name1=entry.get("Name", None) or None,
+        C_SAP_Lead_Status1=entry.get("UserStatusCode", None) or None,
+        C_SAP_Dealer_ID1=entry.get("OwnerPartyUUID", None) or None,
+        C_Company=entry.get("Company", None) or None,
+        C_Address1=entry.get("AccountPostalAddressElementsStreetName", None) or None,
+        C_City=entry.get("AccountCity", None) or None,
+        C_Zip_Postal=entry.get("AccountPostalAddressElementsStreetPostalCode", None) or None,
+        C_State_Prov=entry.get("AccountState", None) or None,
+        C_Country=entry.get("AccountCountry", None) or None,
+        C_EmailAddress=entry["ZConsumerEMail_KUT"] or None
+            if entry.get("ZConsumerEMail_KUT", None)
+            else entry.get("ContactEMail", None) or None,
+        C_FirstName=entry.get("ContactFirstName", None) or None,
+        C_LastName=entry.get("ContactLastName", None) or None,
+        C_Title=entry.get("ContactFunctionalTitleName", None) or None,
+        C_MobilePhone=entry.get("ContactMobile", None) or None,
+        C_BusPhone=entry.get("ContactPhone", None) or None,
+        C_Description1=entry.get("Note", None) or None,
+        C_SAP_Field_of_Work1=entry.get("ZFieldofWork_KUT", None) or None,
+        C_SAP_B2B_Product_Group1=entry.get("ZProductGrp_KUT", None) or None,
+        C_SFDC___Dealer_Source1=entry.get("ZDealerSource_KUT", None) or None,
+        C_SAP_Lead_Campaign_Value1=entry.get("ZCampaignvalue_KUT", None) or None,
+        C_SFDC___Roofing_lead_category1=entry.get("ZRoofLeadCat_KUT", None) or None,
+        C_SAP_Related_Roofing_Installation1=entry.get("ZRelRoofInstallation_KUT", None) or None,
+        C_SAP_Related_Roofing_Profile1=entry.get("ZRelRoofProfile_KUT", None) or None,
+        C_SAP_Related_Roofing_RWS1=entry.get("ZRelRoofRWS_KUT", None) or None,
+        C_SAP_Related_Roofing_Safety1=entry.get("ZRelRoofSafety_KUT", None) or None,
+        C_SAP_Related_Roofing_Accessories1=entry.get("ZRelRoofAccessories_KUT", None) or None,
+        C_SAP_Related_Roofing_Solar1=entry.get("ZRelRoofSolar_KUT", None) or None,
+        C_SAP_Attachment_I1=entry.get("ZAttachment1URL_KUT", None) or None,
+        C_SAP_Attachment_II1=entry.get("ZAttachment2URL_KUT", None) or None,
+        C_SAP_Attachment_III1=entry.get("ZAttachment3URL_KUT", None) or None,
+        C_SAP_Attachment_IV1=entry.get("ZAttachment4URL_KUT", None) or None,
+        C_SAP_Attachment_V1=entry.get("ZAttachment5URL_KUT", None) or None,
+        C_SFDC_iPDF_01_Project_Status1=entry.get("ZProjectStatus_KUT", None) or None,
+        C_SFDC_iPDF_13_Billing_Address_Name1=entry.get("ZBillAddrName_KUT", None) or None,
+        C_SFDC_iPDF_09_Billing_Address_Street1=entry.get("ZBillAddrStreet_KUT", None) or None,
+        C_SFDC_iPDF_11_Billing_Address_City1=entry.get("ZBillAddrCity_KUT", None) or None,
+        C_SFDC_iPDF_10_Billing_Address_Zip1=entry.get("ZBillAddrPostcode_KUT", None) or None,
+        C_SFDC_iPDF_12_Billing_Address_Country1=entry.get("ZBillAddrCtry_KUT", None) or None,
+        C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=entry.get("ZInstatsiteearlatweek_KUT", None) or None,
+        C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=entry.get("ZInstatsitelateatweek_KUT", None) or None,
+        C_SFDC_iPDF_02_Products_at_Site_Week1=entry.get("ZProductsatsiteweek_KUT", None) or None,
+        C_SFDC_iPDF_14_Homing_Date1=decode_c4c_date_time(entry.get("ZEloquaHomLettDate_KUT", None))
+            if entry.get("ZEloquaHomLettDate_KUT", None)
+            else None,
+        C_SFDC_iPDF_05_Project_Manager_1_Name1=entry.get("ZProjMan1Name_KUT", None) or None,
+        C_SFDC_iPDF_05_Project_Manager_1_Email1=entry.get("ZProjMan1Email_KUT", None) or None,
+        C_SFDC_iPDF_06_Project_Manager_1_Mobile1=entry.get("ZProjMan1Mobile_KUT", None) or None,
+        C_SFDC_iPDF_07_Project_Manager_2_Name_1=entry.get("ZProjMan2Name_KUT", None) or None,
+        C_SFDC_iPDF_05_Project_Manager_2_Email1=entry.get("ZProjMan2Email_KUT", None) or None,
+        C_SFDC_iPDF_08_Project_Manager_2_Mobile1=entry.get("ZProjMan2Mobile_KUT", None) or None,
+        C_SAP_Created_to_Kata_Date1=decode_c4c_date_time(entry.get("ZCreatedToKataDate_KUT", None))
+            if entry.get("ZCreatedToKataDate_KUT", None)
+            else None,
+        C_SFDC___Created_To_Kata_Time1=entry.get("ZCreatedToKataTime_KUT", None) or None,
+        C_Meeting_Date_for_email1=decode_c4c_date_time(entry.get("ZAgreedappdate_KUT", None))
+            if entry.get("ZAgreedappdate_KUT", None)
+            else None,
+        C_Meeting_time_for_email1=entry.get("ZAgreedapptime_KUT", None) or None,
+        C_SAP_UTM_Medium_Original1=entry.get("ZUTMMediumOriginal_KUT", None) or None,
+        C_SAP_UTM_Source_Original1=entry.get("ZUTMSourceOriginal_KUT", None) or None,
+        C_SAP_UTM_Medium_Recent1=entry.get("ZUTMMediumRecent_KUT", None) or None,
+        C_SAP_UTM_Source_Recent1=entry.get("ZUTMSourceRecent_KUT", None) or None,
+        C_SAP_Send_Email_to_Dealer1=entry.get("ZSendEmailToDealer_KUT", None) or None,
+        C_SFDC_Survey_Status_Installation1=entry.get("ZCustomerSurveyStatus_KUT", None) or None,
+        ContactUUID=entry.get("ContactUUID", None) or None,
+        URI=entry.get("__metadata", None).get("uri", None) or None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def outbound_lead_row(entry, time_inserted):
+    return dict(
+        TableID=entry.get("TableID", None),
+        C_SAP_Lead_ID1=entry.get("ID", None) or None,
+        C_SFDC___Lead_Record_Type_ID1=entry.get("GroupCode", None) or None,
+        C_SFDC___Lead_Name1=entry.get("Name", None) or None,
+        C_SAP_Lead_Status1=entry.get("UserStatusCode", None) or None,
+        C_SAP_Dealer_ID1=entry.get("OwnerPartyUUID", None) or None,
+        C_Company=entry.get("Company", None) or None,
+        C_Address1=entry.get("AccountPostalAddressElementsStreetName", None) or None,
+        C_City=entry.get("AccountCity", None) or None,
+        C_Zip_Postal=entry.get("AccountPostalAddressElementsStreetPostalCode", None) or None,
+        C_State_Prov=entry.get("AccountState", None) or None,
+        C_Country=entry.get("AccountCountry", None) or None,
+        C_EmailAddress=entry.get("Email", None) or None,
+        C_FirstName=entry.get("ContactFirstName", None) or None,
+        C_LastName=entry.get("ContactLastName", None) or None,
+        C_Title=entry.get("ContactFunctionalTitleName", None) or None,
+        C_MobilePhone=entry.get("ContactMobile", None) or None,
+        C_BusPhone=entry.get("ContactPhone", None) or None,
+        C_Description1=entry.get("Note", None) or None,
+        C_SAP_Field_of_Work1=entry.get("ZFieldofWork_KUT", None) or None,
+        C_SAP_B2B_Product_Group1=entry.get("ZProductGrp_KUT", None) or None,
+        C_SFDC___Dealer_Source1=entry.get("ZDealerSource_KUT", None) or None,
+        C_SAP_Lead_Campaign_Value1=entry.get("ZCampaignvalue_KUT", None) or None,
+        C_SFDC___Roofing_lead_category1=entry.get("ZRoofLeadCat_KUT", None) or None,
+        C_SAP_Related_Roofing_Installation1=entry.get("ZRelRoofInstallation_KUT", None) or None,
+        C_SAP_Related_Roofing_Profile1=entry.get("ZRelRoofProfile_KUT", None) or None,
+        C_SAP_Related_Roofing_RWS1=entry.get("ZRelRoofRWS_KUT", None) or None,
+        C_SAP_Related_Roofing_Safety1=entry.get("ZRelRoofSafety_KUT", None) or None,
+        C_SAP_Related_Roofing_Accessories1=entry.get("ZRelRoofAccessories_KUT", None) or None,
+        C_SAP_Related_Roofing_Solar1=entry.get("ZRelRoofSolar_KUT", None) or None,
+        C_SAP_Attachment_I1=entry.get("ZAttachment1URL_KUT", None) or None,
+        C_SAP_Attachment_II1=entry.get("ZAttachment2URL_KUT", None) or None,
+        C_SAP_Attachment_III1=entry.get("ZAttachment3URL_KUT", None) or None,
+        C_SAP_Attachment_IV1=entry.get("ZAttachment4URL_KUT", None) or None,
+        C_SAP_Attachment_V1=entry.get("ZAttachment5URL_KUT", None) or None,
+        C_SFDC_iPDF_01_Project_Status1=entry.get("ZProjectStatus_KUT", None) or None,
+        C_SFDC_iPDF_13_Billing_Address_Name1=entry.get("ZBillAddrName_KUT", None) or None,
+        C_SFDC_iPDF_09_Billing_Address_Street1=entry.get("ZBillAddrStreet_KUT", None) or None,
+        C_SFDC_iPDF_11_Billing_Address_City1=entry.get("ZBillAddrCity_KUT", None) or None,
+        C_SFDC_iPDF_10_Billing_Address_Zip1=entry.get("ZBillAddrPostcode_KUT", None) or None,
+        C_SFDC_iPDF_12_Billing_Address_Country1=entry.get("ZBillAddrCtry_KUT", None) or None,
+        C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=entry.get("ZInstatsiteearlatweek_KUT", None) or None,
+        C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=entry.get("ZInstatsitelateatweek_KUT", None) or None,
+        C_SFDC_iPDF_02_Products_at_Site_Week1=entry.get("ZProductsatsiteweek_KUT", None) or None,
+        C_SFDC_iPDF_14_Homing_Date1=entry.get("ZEloquaHomLettDate_KUT", None) or None,
+        C_SFDC_iPDF_05_Project_Manager_1_Name1=entry.get("ZProjMan1Name_KUT", None) or None,
+        C_SFDC_iPDF_05_Project_Manager_1_Email1=entry.get("ZProjMan1Email_KUT", None) or None,
+        C_SFDC_iPDF_06_Project_Manager_1_Mobile1=entry.get("ZProjMan1Mobile_KUT", None) or None,
+        C_SFDC_iPDF_07_Project_Manager_2_Name_1=entry.get("ZProjMan2Name_KUT", None) or None,
+        C_SFDC_iPDF_05_Project_Manager_2_Email1=entry.get("ZProjMan2Email_KUT", None) or None,
+        C_SFDC_iPDF_08_Project_Manager_2_Mobile1=entry.get("ZProjMan2Mobile_KUT", None) or None,
+        C_SAP_Created_to_Kata_Date1=entry.get("ZCreatedToKataDate_KUT", None) or None,
+        C_SFDC___Created_To_Kata_Time1=entry.get("ZCreatedToKataTime_KUT", None) or None,
+        C_Meeting_Date_for_email1=entry.get("ZAgreedappdate_KUT", None) or None,
+        C_Meeting_time_for_email1=entry.get("ZAgreedapptime_KUT", None) or None,
+        C_SAP_UTM_Medium_Original1=entry.get("ZUTMMediumOriginal_KUT", None) or None,
+        C_SAP_UTM_Source_Original1=entry.get("ZUTMSourceOriginal_KUT", None) or None,
+        C_SAP_UTM_Medium_Recent1=entry.get("ZUTMMediumRecent_KUT", None) or None,
+        C_SAP_UTM_Source_Recent1=entry.get("ZUTMSourceRecent_KUT", None) or None,
+        C_EML_GROUP_Professional1=entry.get("B2B_MP_Consent", None) or None,
+        C_EML_GROUP_Roofs_and_renovations1=entry.get("B2C_MP_Consent", None) or None,
+        C_SFDC_Survey_Status_Installation1=entry.get("ZCustomerSurveyStatus_KUT", None) or None,
+        ContactUUID=entry.get("ContactUUID", None) or None,
+        URI=entry.get("URI", None) or None,
+        C4C_Task_Name=entry.get("C4C_Task_Name", None) or None,
+        C4C_Status=entry.get("C4C_Status", None) or None,
+        C4C_Payload_Hash=entry.get("C4C_Payload_Hash", None) or None,
+        C4C_Consent_Hash=entry.get("C4C_Consent_Hash", None) or None,
+        C4C_Last_Payload=entry.get("C4C_Last_Payload", None) or None,
+        # writing a lead back ends its claim
+        C4C_Claimed_By=None,
+        C4C_Lease_Expires_UTC=None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def target_gr_row(entry, contact_list_ids, time_inserted):
+    return dict(
+        TargetGroupID=entry.get("ID", None) or None,
+        Name=entry.get("Description", None) or None,
+        ContactListIDInEloqua=contact_list_ids.get(entry.get("Description", None), None) or None
+            if contact_list_ids
+            else None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def mark_p_row(entry, time_inserted):
+    return dict(
+        ContactUUID=entry.get("BusinessPartnerUUID", None) or None,
+        GeneralConsent=entry.get("GeneralConsent", None) or None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
+def emp_row(entry, time_inserted):
+    return dict(
+        EmployeeID=entry.get("UUID", None) or None,
+        Name=str(entry["FirstName"]) + " " + str(entry["LastName"])
+            if entry.get("FirstName", None) and entry.get("LastName", None)
+            # business partner
+            else entry.get("Name", None) or None,
+        Email=entry.get("Email", None) or None,
+        Department=entry.get("Department", None) or None,
+        Country=entry.get("CountryCode", None) or None,
+        BusinessPartnerID=entry.get("BusinessPartnerID", None) or None,
+        TimeInsertedUTC=time_inserted
+    )
+
+
 def upsert_contact(session_, data):
     if data:
-        upsert_data = sort_upsert_data(session_=session_, type="contact", data=data)
-        contacts_to_update = upsert_data.get("entries_to_update", [])
-        contacts_to_insert = upsert_data.get("entries_to_insert", [])
-        if contacts_to_update:
-            for i in range(0, len(contacts_to_update)):
-                session_.execute(
-                    Contact.__table__.update()
-                        .values
-                            (
-                                C_Company=contacts_to_update[i].get("AccountUUID", None),
-                                C_SFDCAccountID=contacts_to_update[i].get("AccountID", None) or None,
-                                C_City=contacts_to_update[i].get("BusinessAddressCity", None) or None,
-                                C_Country=contacts_to_update[i].get("BusinessAddressCountryCode", None) or None,
-                                C_EmailAddress=contacts_to_update[i].get("Email", None) or None,
-                                C_SAP_Field_of_Work1=contacts_to_update[i].get("ZFieldofWork", None) or None,
-                                C_FirstName=contacts_to_update[i].get("FirstName", None) or None,
-                                C_LastName=contacts_to_update[i].get("LastName", None) or None,
-                                C_Title=contacts_to_update[i].get("JobTitle", None) or None,
-                                C_MobilePhone=contacts_to_update[i].get("Mobile", None) or None,
-                                C_SAP_Dealer_ID1=contacts_to_update[i].get("ContactOwnerUUID", None) or None,
-                                C_BusPhone=contacts_to_update[i].get("Phone", None) or None,
-                                C_SAP___Is_Plannja_Dealer1=contacts_to_update[i].get("ZisPlannjaDealer", None) or None,
-                                C_SAP_Contact_Status1=contacts_to_update[i].get("StatusCode", None) or None,
-                                C_Zip_Postal=contacts_to_update[i].get("BusinessAddressStreetPostalCode", None) or None,
-                                C_SAP_Plannja_Price_List1=contacts_to_update[i].get("ZPlannjaPricelist", None) or None,
-                                ContactUUID=contacts_to_update[i].get("ContactUUID", None) or None,
-                                TimeInsertedUTC=datetime.utcnow()
-                            )
-                        .where(Contact.C_SFDCContactID == contacts_to_update[i]["ContactID"])
-                )
-            logger.debug("Finish Inbound Bulk Update {0} records to table Contact".format(len(contacts_to_update)))
-        if contacts_to_insert:
-            session_.execute(
-                Contact.__table__.insert(),
-                [
-                    dict
-                        (
-                            C_SFDCContactID=contacts_to_insert[i].get("ContactID", None),
-                            C_Company=contacts_to_insert[i].get("AccountUUID", None) or None,
-                            C_SFDCAccountID=contacts_to_insert[i].get("AccountID", None) or None,
-                            C_City=contacts_to_insert[i].get("BusinessAddressCity", None) or None,
-                            C_Country=contacts_to_insert[i].get("BusinessAddressCountryCode", None) or None,
-                            C_EmailAddress=contacts_to_insert[i].get("Email", None) or None,
-                            C_SAP_Field_of_Work1=contacts_to_insert[i].get("ZFieldofWork", None) or None,
-                            C_FirstName=contacts_to_insert[i].get("FirstName", None) or None,
-                            C_LastName=contacts_to_insert[i].get("LastName", None) or None,
-                            C_Title=contacts_to_insert[i].get("JobTitle", None) or None,
-                            C_MobilePhone=contacts_to_insert[i].get("Mobile", None) or None,
-                            C_SAP_Dealer_ID1=contacts_to_insert[i].get("ContactOwnerUUID", None) or None,
-                            C_BusPhone=contacts_to_insert[i].get("Phone", None) or None,
-                            C_SAP___Is_Plannja_Dealer1=contacts_to_insert[i].get("ZisPlannjaDealer", None) or None,
-                            C_SAP_Contact_Status1=contacts_to_insert[i].get("StatusCode", None) or None,
-                            C_Zip_Postal=contacts_to_insert[i].get("BusinessAddressStreetPostalCode", None) or None,
-                            C_SAP_Plannja_Price_List1=contacts_to_insert[i].get("ZPlannjaPricelist", None) or None,
-                            ContactUUID=contacts_to_insert[i].get("ContactUUID", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(contacts_to_insert))
-                ]
-            )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Contact".format(len(contacts_to_insert)))
+        time_inserted = datetime.utcnow()
+        count = upsert_rows(session_=session_, table=Contact.__table__, index_elements=["C_SFDCContactID"],
+                            rows=[contact_row(entry, time_inserted) for entry in data],
+                            copy="contact" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Bulk Upsert {0} records to table Contact".format(count))
     else:
         logger.debug("No data to insert/update table Contact")
 
 
 def upsert_account(session_, data):
     if data:
-        upsert_data = sort_upsert_data(session_=session_, type="account", data=data)
-        accounts_to_update = upsert_data.get("entries_to_update", [])
-        accounts_to_insert = upsert_data.get("entries_to_insert", [])
-        if accounts_to_update:
-            for i in range(0, len(accounts_to_update)):
-                session_.execute(
-                    Account.__table__.update()
-                        .values
-                            (
-                                M_Address1=accounts_to_update[i].get("AddressLine1", None) or None,
-                                M_SAP_BC_ABC_Classification1=accounts_to_update[i].get("ZBCABCClassification", None) or None,
-                                M_City=accounts_to_update[i].get("City", None) or None,
-                                M_Country=accounts_to_update[i].get("CountryCode", None) or None,
-                                M_CompanyName=accounts_to_update[i].get("Name", None) or None,
-                                M_SAP_Dealer_ID1=accounts_to_update[i].get("OwnerUUID", None) or None,
-                                M_SAP_RC_Customer_Segment1=accounts_to_update[i].get("ZRCCustomerSegments_KUT", None) or None,
-                                M_SAP_Account_Role1=accounts_to_update[i].get("RoleCode", None) or None,
-                                M_SAP_RR_ABC_Classification1=accounts_to_update[i].get("ZRRABCClassification", None) or None,
-                                M_SAP_RR_Tactical_Classification1=accounts_to_update[i].get("ZRRTacticalClassification", None) or None,
-                                M_SAP_Account_Status1=accounts_to_update[i].get("LifeCycleStatusCode", None) or None,
-                                M_Zip_Postal=accounts_to_update[i].get("StreetPostalCode", None) or None,
-                                TimeInsertedUTC=datetime.utcnow()
-                            )
-                        .where(Account.M_SFDCAccountID == accounts_to_update[i]["AccountID"])
-                )
-            logger.debug("Finish Inbound Bulk Update {0} records to table Account".format(len(accounts_to_update)))
-        if accounts_to_insert:
-            session_.execute(
-                Account.__table__.insert(),
-                [
-                    dict
-                        (
-                            M_SFDCAccountID=accounts_to_insert[i].get("AccountID", None),
-                            M_Address1=accounts_to_insert[i].get("AddressLine1", None) or None,
-                            M_SAP_BC_ABC_Classification1=accounts_to_insert[i].get("ZBCABCClassification", None) or None,
-                            M_City=accounts_to_insert[i].get("City", None) or None,
-                            M_Country=accounts_to_insert[i].get("CountryCode", None) or None,
-                            M_CompanyName=accounts_to_insert[i].get("Name", None) or None,
-                            M_SAP_Dealer_ID1=accounts_to_insert[i].get("OwnerUUID", None) or None,
-                            M_SAP_RC_Customer_Segment1=accounts_to_insert[i].get("ZRCCustomerSegments_KUT", None) or None,
-                            M_SAP_Account_Role1=accounts_to_insert[i].get("RoleCode", None) or None,
-                            M_SAP_RR_ABC_Classification1=accounts_to_insert[i].get("ZRRABCClassification", None) or None,
-                            M_SAP_RR_Tactical_Classification1=accounts_to_insert[i].get("ZRRTacticalClassification", None) or None,
-                            M_SAP_Account_Status1=accounts_to_insert[i].get("LifeCycleStatusCode", None) or None,
-                            M_Zip_Postal=accounts_to_insert[i].get("StreetPostalCode", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(accounts_to_insert))
-                ]
-            )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Account".format(len(accounts_to_insert)))
+        time_inserted = datetime.utcnow()
+        count = upsert_rows(session_=session_, table=Account.__table__, index_elements=["M_SFDCAccountID"],
+                            rows=[account_row(entry, time_inserted) for entry in data],
+                            copy="account" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Bulk Upsert {0} records to table Account".format(count))
     else:
         logger.debug("No data to insert/update table Account")
 
 
-def upsert_lead(session_, data, inbound=None, outbound=None):
+def upsert_inbound_leads(session_, rows, batch_size=DB_UPSERT_BATCH_SIZE, copy=False):
+    '''
+    Upsert leads from C4C, which are identified by C_SAP_Lead_ID1 and not by a unique key of table Lead.
+    Each batch looks up the TableIDs of its leads in one query, then existing leads are upserted on TableID
+    and new leads are inserted, so that every batch takes 3 statements
+    :param session_: SQL session
+    :param rows: list of dicts of column: value, see inbound_lead_row
+    :param batch_size: number of leads per batch
+    :param copy: True to COPY the leads into a staging table and update and insert them from there in one statement each instead
+    :return: tuple of number of leads updated and inserted
+    '''
+    unique_rows = list({row["C_SAP_Lead_ID1"]: row for row in rows}.values())
+    if copy:
+        staging = copy_to_staging(session_=session_, table=Lead.__table__, rows=unique_rows)
+        updated = session_.execute(
+            Lead.__table__.update()
+                .values({column: staging.c[column] for column in staging.c.keys() if column != "C_SAP_Lead_ID1"})
+                .where(Lead.C_SAP_Lead_ID1 == staging.c.C_SAP_Lead_ID1)
+        ).rowcount
+        inserted = session_.execute(
+            insert(Lead.__table__).from_select(
+                list(staging.c.keys()),
+                select(list(staging.c)).where(~exists().where(Lead.C_SAP_Lead_ID1 == staging.c.C_SAP_Lead_ID1)))
+        ).rowcount
+        return updated, inserted
+    updated, inserted = 0, 0
+    for i in range(0, len(unique_rows), batch_size):
+        batch = unique_rows[i:i + batch_size]
+        table_ids = dict()
+        existing_leads = create_query(session_=session_, purpose="upsert", type="lead").filter(
+            Lead.C_SAP_Lead_ID1.in_([row["C_SAP_Lead_ID1"] for row in batch])).all()
+        for table_id, lead_id in existing_leads:
+            table_ids.setdefault(lead_id, []).append(table_id)
+        # a lead that is in DB more than once has all of its rows updated
+        rows_to_update = [dict(row, TableID=table_id)
+                          for row in batch for table_id in table_ids.get(row["C_SAP_Lead_ID1"], [])]
+        rows_to_insert = [row for row in batch if row["C_SAP_Lead_ID1"] not in table_ids]
+        if rows_to_update:
+            updated += upsert_rows(session_=session_, table=Lead.__table__, rows=rows_to_update,
+                                   index_elements=["TableID"], batch_size=len(rows_to_update))
+        if rows_to_insert:
+            session_.execute(insert(Lead.__table__).values(rows_to_insert))
+            inserted += len(rows_to_insert)
+    return updated, inserted
+
+
+def upsert_lead(session_, data, inbound=None, outbound=None, worker_id=None):
+    '''
+    Upsert leads fetched from C4C (inbound), or write back leads sent to C4C (outbound)
+    :param session_: SQL session
+    :param data: leads
+    :param inbound: True for leads fetched from C4C
+    :param outbound: True for leads sent to C4C
+    :param worker_id: ID of the worker that claimed the outbound leads, only leads still claimed by it are written back,
+    so that a worker whose claim expired does not overwrite the result of the worker that claimed the leads after it
+    :return: None
+    '''
     if data:
+        time_inserted = datetime.utcnow()
         if inbound:
-            upsert_data = sort_upsert_data(session_=session_, type="lead", data=data)
-            leads_to_update = upsert_data.get("entries_to_update", [])
-            leads_to_insert = upsert_data.get("entries_to_insert", [])
-            if leads_to_update:
-                for i in range(0, len(leads_to_update)):
-                    session_.execute(
-                        Lead.__table__.update()
-                            .values
-                                (
-                                    C_SFDC___Lead_Record_Type_ID1=leads_to_update[i].get("GroupCode", None) or None,
-                                    C_SFDC___Lead_Name1=leads_to_update[i].get("Name", None) or None,
-                                    C_SAP_Lead_Status1=leads_to_update[i].get("UserStatusCode", None) or None,
-                                    C_SAP_Dealer_ID1=leads_to_update[i].get("OwnerPartyUUID", None) or None,
-                                    C_Company=leads_to_update[i].get("Company", None) or None,
-                                    C_Address1=leads_to_update[i].get("AccountPostalAddressElementsStreetName", None) or None,
-                                    C_City=leads_to_update[i].get("AccountCity", None) or None,
-                                    C_Zip_Postal=leads_to_update[i].get("AccountPostalAddressElementsStreetPostalCode", None) or None,
-                                    C_State_Prov=leads_to_update[i].get("AccountState", None) or None,
-                                    C_Country=leads_to_update[i].get("AccountCountry", None) or None,
-                                    C_EmailAddress=leads_to_update[i]["ZConsumerEMail_KUT"] or None
-                                        if leads_to_update[i].get("ZConsumerEMail_KUT", None)
-                                        else leads_to_update[i].get("ContactEMail", None) or None,
-                                    C_FirstName=leads_to_update[i].get("ContactFirstName", None) or None,
-                                    C_LastName=leads_to_update[i].get("ContactLastName", None) or None,
-                                    C_Title=leads_to_update[i].get("ContactFunctionalTitleName", None) or None,
-                                    C_MobilePhone=leads_to_update[i].get("ContactMobile", None) or None,
-                                    C_BusPhone=leads_to_update[i].get("ContactPhone", None) or None,
-                                    C_Description1=leads_to_update[i].get("Note", None) or None,
-                                    C_SAP_Field_of_Work1=leads_to_update[i].get("ZFieldofWork_KUT", None) or None,
-                                    C_SAP_B2B_Product_Group1=leads_to_update[i].get("ZProductGrp_KUT", None) or None,
-                                    C_SFDC___Dealer_Source1=leads_to_update[i].get("ZDealerSource_KUT", None) or None,
-                                    C_SAP_Lead_Campaign_Value1=leads_to_update[i].get("ZCampaignvalue_KUT", None) or None,
-                                    C_SFDC___Roofing_lead_category1=leads_to_update[i].get("ZRoofLeadCat_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Installation1=leads_to_update[i].get("ZRelRoofInstallation_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Profile1=leads_to_update[i].get("ZRelRoofProfile_KUT", None) or None,
-                                    C_SAP_Related_Roofing_RWS1=leads_to_update[i].get("ZRelRoofRWS_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Safety1=leads_to_update[i].get("ZRelRoofSafety_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Accessories1=leads_to_update[i].get("ZRelRoofAccessories_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Solar1=leads_to_update[i].get("ZRelRoofSolar_KUT", None) or None,
-                                    C_SAP_Attachment_I1=leads_to_update[i].get("ZAttachment1URL_KUT", None) or None,
-                                    C_SAP_Attachment_II1=leads_to_update[i].get("ZAttachment2URL_KUT", None) or None,
-                                    C_SAP_Attachment_III1=leads_to_update[i].get("ZAttachment3URL_KUT", None) or None,
-                                    C_SAP_Attachment_IV1=leads_to_update[i].get("ZAttachment4URL_KUT", None) or None,
-                                    C_SAP_Attachment_V1=leads_to_update[i].get("ZAttachment5URL_KUT", None) or None,
-                                    C_SFDC_iPDF_01_Project_Status1=leads_to_update[i].get("ZProjectStatus_KUT", None) or None,
-                                    C_SFDC_iPDF_13_Billing_Address_Name1=leads_to_update[i].get("ZBillAddrName_KUT", None) or None,
-                                    C_SFDC_iPDF_09_Billing_Address_Street1=leads_to_update[i].get("ZBillAddrStreet_KUT", None) or None,
-                                    C_SFDC_iPDF_11_Billing_Address_City1=leads_to_update[i].get("ZBillAddrCity_KUT", None) or None,
-                                    C_SFDC_iPDF_10_Billing_Address_Zip1=leads_to_update[i].get("ZBillAddrPostcode_KUT", None) or None,
-                                    C_SFDC_iPDF_12_Billing_Address_Country1=leads_to_update[i].get("ZBillAddrCtry_KUT", None) or None,
-                                    C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=leads_to_update[i].get("ZInstatsiteearlatweek_KUT", None) or None,
-                                    C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=leads_to_update[i].get("ZInstatsitelateatweek_KUT", None) or None,
-                                    C_SFDC_iPDF_02_Products_at_Site_Week1=leads_to_update[i].get("ZProductsatsiteweek_KUT", None) or None,
-                                    C_SFDC_iPDF_14_Homing_Date1=decode_c4c_date_time(leads_to_update[i].get("ZEloquaHomLettDate_KUT", None))
-                                        if leads_to_update[i].get("ZEloquaHomLettDate_KUT", None)
-                                        else None,
-                                    C_SFDC_iPDF_05_Project_Manager_1_Name1=leads_to_update[i].get("ZProjMan1Name_KUT", None) or None,
-                                    C_SFDC_iPDF_05_Project_Manager_1_Email1=leads_to_update[i].get("ZProjMan1Email_KUT", None) or None,
-                                    C_SFDC_iPDF_06_Project_Manager_1_Mobile1=leads_to_update[i].get("ZProjMan1Mobile_KUT", None) or None,
-                                    C_SFDC_iPDF_07_Project_Manager_2_Name_1=leads_to_update[i].get("ZProjMan2Name_KUT", None) or None,
-                                    C_SFDC_iPDF_05_Project_Manager_2_Email1=leads_to_update[i].get("ZProjMan2Email_KUT", None) or None,
-                                    C_SFDC_iPDF_08_Project_Manager_2_Mobile1=leads_to_update[i].get("ZProjMan2Mobile_KUT", None) or None,
-                                    C_SAP_Created_to_Kata_Date1=decode_c4c_date_time(leads_to_update[i].get("ZCreatedToKataDate_KUT", None))
-                                        if leads_to_update[i].get("ZCreatedToKataDate_KUT", None)
-                                        else None,
-                                    C_SFDC___Created_To_Kata_Time1=leads_to_update[i].get("ZCreatedToKataTime_KUT", None) or None,
-                                    C_Meeting_Date_for_email1=decode_c4c_date_time(leads_to_update[i].get("ZAgreedappdate_KUT", None))
-                                        if leads_to_update[i].get("ZAgreedappdate_KUT", None)
-                                        else None,
-                                    C_Meeting_time_for_email1=leads_to_update[i].get("ZAgreedapptime_KUT", None) or None,
-                                    C_SAP_UTM_Medium_Original1=leads_to_update[i].get("ZUTMMediumOriginal_KUT", None) or None,
-                                    C_SAP_UTM_Source_Original1=leads_to_update[i].get("ZUTMSourceOriginal_KUT", None) or None,
-                                    C_SAP_UTM_Medium_Recent1=leads_to_update[i].get("ZUTMMediumRecent_KUT", None) or None,
-                                    C_SAP_UTM_Source_Recent1=leads_to_update[i].get("ZUTMSourceRecent_KUT", None) or None,
-                                    C_SAP_Send_Email_to_Dealer1=leads_to_update[i].get("ZSendEmailToDealer_KUT", None) or None,
-                                    C_SFDC_Survey_Status_Installation1=leads_to_update[i].get("ZCustomerSurveyStatus_KUT", None) or None,
-                                    ContactUUID=leads_to_update[i].get("ContactUUID", None) or None,
-                                    URI=leads_to_update[i].get("__metadata", None).get("uri", None) or None,
-                                    TimeInsertedUTC=datetime.utcnow(),
-                                )
-                            .where(Lead.C_SAP_Lead_ID1 == leads_to_update[i]["ID"])
-                    )
-                logger.debug("Finish Inbound Bulk Update {0} records to table Lead".format(len(leads_to_update)))
-            if leads_to_insert:
-                session_.execute(
-                    Lead.__table__.insert(),
-                    [
-                        dict
-                            (
-                                C_SAP_Lead_ID1=leads_to_insert[i].get("ID", None),
-                                C_SFDC___Lead_Record_Type_ID1=leads_to_insert[i].get("GroupCode", None) or None,
-                                C_SFDC___Lead_Name1=leads_to_insert[i].get("Name", None) or None,
-                                C_SAP_Lead_Status1=leads_to_insert[i].get("UserStatusCode", None) or None,
-                                C_SAP_Dealer_ID1=leads_to_insert[i].get("OwnerPartyUUID", None) or None,
-                                C_Company=leads_to_insert[i].get("Company", None) or None,
-                                C_Address1=leads_to_insert[i].get("AccountPostalAddressElementsStreetName", None) or None,
-                                C_City=leads_to_insert[i].get("AccountCity", None) or None,
-                                C_Zip_Postal=leads_to_insert[i].get("AccountPostalAddressElementsStreetPostalCode", None) or None,
-                                C_State_Prov=leads_to_insert[i].get("AccountState", None) or None,
-                                C_Country=leads_to_insert[i].get("AccountCountry", None) or None,
-                                C_EmailAddress=leads_to_insert[i]["ZConsumerEMail_KUT"] or None
-                                    if leads_to_insert[i].get("ZConsumerEMail_KUT", None)
-                                    else leads_to_insert[i].get("ContactEMail", None) or None,
-                                C_FirstName=leads_to_insert[i].get("ContactFirstName", None) or None,
-                                C_LastName=leads_to_insert[i].get("ContactLastName", None) or None,
-                                C_Title=leads_to_insert[i].get("ContactFunctionalTitleName", None) or None,
-                                C_MobilePhone=leads_to_insert[i].get("ContactMobile", None) or None,
-                                C_BusPhone=leads_to_insert[i].get("ContactPhone", None) or None,
-                                C_Description1=leads_to_insert[i].get("Note", None) or None,
-                                C_SAP_Field_of_Work1=leads_to_insert[i].get("ZFieldofWork_KUT", None) or None,
-                                C_SAP_B2B_Product_Group1=leads_to_insert[i].get("ZProductGrp_KUT", None) or None,
-                                C_SFDC___Dealer_Source1=leads_to_insert[i].get("ZDealerSource_KUT", None) or None,
-                                C_SAP_Lead_Campaign_Value1=leads_to_insert[i].get("ZCampaignvalue_KUT", None) or None,
-                                C_SFDC___Roofing_lead_category1=leads_to_insert[i].get("ZRoofLeadCat_KUT", None) or None,
-                                C_SAP_Related_Roofing_Installation1=leads_to_insert[i].get("ZRelRoofInstallation_KUT", None) or None,
-                                C_SAP_Related_Roofing_Profile1=leads_to_insert[i].get("ZRelRoofProfile_KUT", None) or None,
-                                C_SAP_Related_Roofing_RWS1=leads_to_insert[i].get("ZRelRoofRWS_KUT", None) or None,
-                                C_SAP_Related_Roofing_Safety1=leads_to_insert[i].get("ZRelRoofSafety_KUT", None) or None,
-                                C_SAP_Related_Roofing_Accessories1=leads_to_insert[i].get("ZRelRoofAccessories_KUT", None) or None,
-                                C_SAP_Related_Roofing_Solar1=leads_to_insert[i].get("ZRelRoofSolar_KUT", None) or None,
-                                C_SAP_Attachment_I1=leads_to_insert[i].get("ZAttachment1URL_KUT", None) or None,
-                                C_SAP_Attachment_II1=leads_to_insert[i].get("ZAttachment2URL_KUT", None) or None,
-                                C_SAP_Attachment_III1=leads_to_insert[i].get("ZAttachment3URL_KUT", None) or None,
-                                C_SAP_Attachment_IV1=leads_to_insert[i].get("ZAttachment4URL_KUT", None) or None,
-                                C_SAP_Attachment_V1=leads_to_insert[i].get("ZAttachment5URL_KUT", None) or None,
-                                C_SFDC_iPDF_01_Project_Status1=leads_to_insert[i].get("ZProjectStatus_KUT", None) or None,
-                                C_SFDC_iPDF_13_Billing_Address_Name1=leads_to_insert[i].get("ZBillAddrName_KUT", None) or None,
-                                C_SFDC_iPDF_09_Billing_Address_Street1=leads_to_insert[i].get("ZBillAddrStreet_KUT", None) or None,
-                                C_SFDC_iPDF_11_Billing_Address_City1=leads_to_insert[i].get("ZBillAddrCity_KUT", None) or None,
-                                C_SFDC_iPDF_10_Billing_Address_Zip1=leads_to_insert[i].get("ZBillAddrPostcode_KUT", None) or None,
-                                C_SFDC_iPDF_12_Billing_Address_Country1=leads_to_insert[i].get("ZBillAddrCtry_KUT", None) or None,
-                                C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=leads_to_insert[i].get("ZInstatsiteearlatweek_KUT", None) or None,
-                                C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=leads_to_insert[i].get("ZInstatsitelateatweek_KUT", None) or None,
-                                C_SFDC_iPDF_02_Products_at_Site_Week1=leads_to_insert[i].get("ZProductsatsiteweek_KUT", None) or None,
-                                C_SFDC_iPDF_14_Homing_Date1=decode_c4c_date_time(leads_to_insert[i].get("ZEloquaHomLettDate_KUT", None))
-                                    if leads_to_insert[i].get("ZEloquaHomLettDate_KUT", None)
-                                    else None,
-                                C_SFDC_iPDF_05_Project_Manager_1_Name1=leads_to_insert[i].get("ZProjMan1Name_KUT", None) or None,
-                                C_SFDC_iPDF_05_Project_Manager_1_Email1=leads_to_insert[i].get("ZProjMan1Email_KUT", None) or None,
-                                C_SFDC_iPDF_06_Project_Manager_1_Mobile1=leads_to_insert[i].get("ZProjMan1Mobile_KUT", None) or None,
-                                C_SFDC_iPDF_07_Project_Manager_2_Name_1=leads_to_insert[i].get("ZProjMan2Name_KUT", None) or None,
-                                C_SFDC_iPDF_05_Project_Manager_2_Email1=leads_to_insert[i].get("ZProjMan2Email_KUT", None) or None,
-                                C_SFDC_iPDF_08_Project_Manager_2_Mobile1=leads_to_insert[i].get("ZProjMan2Mobile_KUT", None) or None,
-                                C_SAP_Created_to_Kata_Date1=decode_c4c_date_time(leads_to_insert[i].get("ZCreatedToKataDate_KUT", None))
-                                    if leads_to_insert[i].get("ZCreatedToKataDate_KUT", None)
-                                    else None,
-                                C_SFDC___Created_To_Kata_Time1=leads_to_insert[i].get("ZCreatedToKataTime_KUT", None) or None,
-                                C_Meeting_Date_for_email1=decode_c4c_date_time(leads_to_insert[i].get("ZAgreedappdate_KUT", None))
-                                    if leads_to_insert[i].get("ZAgreedappdate_KUT", None)
-                                    else None,
-                                C_Meeting_time_for_email1=leads_to_insert[i].get("ZAgreedapptime_KUT", None) or None,
-                                C_SAP_UTM_Medium_Original1=leads_to_insert[i].get("ZUTMMediumOriginal_KUT", None) or None,
-                                C_SAP_UTM_Source_Original1=leads_to_insert[i].get("ZUTMSourceOriginal_KUT", None) or None,
-                                C_SAP_UTM_Medium_Recent1=leads_to_insert[i].get("ZUTMMediumRecent_KUT", None) or None,
-                                C_SAP_UTM_Source_Recent1=leads_to_insert[i].get("ZUTMSourceRecent_KUT", None) or None,
-                                C_SAP_Send_Email_to_Dealer1=leads_to_insert[i].get("ZSendEmailToDealer_KUT", None) or None,
-                                C_SFDC_Survey_Status_Installation1=leads_to_insert[i].get("ZCustomerSurveyStatus_KUT", None) or None,
-                                ContactUUID=leads_to_insert[i].get("ContactUUID", None) or None,
-                                URI=leads_to_insert[i].get("__metadata", None).get("uri", None) or None,
-                                TimeInsertedUTC=datetime.utcnow(),
-                            )
-                        for i in range(0, len(leads_to_insert))
-                    ]
-                )
-                logger.debug("Finish Inbound Bulk Insert {0} records table Lead".format(len(leads_to_insert)))
+            updated, inserted = upsert_inbound_leads(session_=session_,
+                                                     rows=[inbound_lead_row(entry, time_inserted) for entry in data],
+                                                     copy="lead" in DB_COPY_ENTITIES)
+            logger.debug("Finish Inbound Bulk Upsert {0} records to table Lead, {1} updated and {2} inserted".format(
+                updated + inserted, updated, inserted))
 
         if outbound:
-            upsert_data = sort_upsert_data(session_=session_, type="lead", data=data, outbound=outbound)
-            leads_to_update = upsert_data.get("entries_to_update", [])
-            leads_to_insert = upsert_data.get("entries_to_insert", [])
-            if leads_to_update:
-                for i in range(0, len(leads_to_update)):
-                    session_.execute(
-                        Lead.__table__.update()
-                            .values
-                                (
-                                    C_SAP_Lead_ID1=leads_to_update[i].get("ID", None) or None,
-                                    C_SFDC___Lead_Record_Type_ID1=leads_to_update[i].get("GroupCode", None) or None,
-                                    C_SFDC___Lead_Name1=leads_to_update[i].get("Name", None) or None,
-                                    C_SAP_Lead_Status1=leads_to_update[i].get("UserStatusCode", None) or None,
-                                    C_SAP_Dealer_ID1=leads_to_update[i].get("OwnerPartyUUID", None) or None,
-                                    C_Company=leads_to_update[i].get("Company", None) or None,
-                                    C_Address1=leads_to_update[i].get("AccountPostalAddressElementsStreetName", None) or None,
-                                    C_City=leads_to_update[i].get("AccountCity", None) or None,
-                                    C_Zip_Postal=leads_to_update[i].get("AccountPostalAddressElementsStreetPostalCode", None) or None,
-                                    C_State_Prov=leads_to_update[i].get("AccountState", None) or None,
-                                    C_Country=leads_to_update[i].get("AccountCountry", None) or None,
-                                    C_EmailAddress=leads_to_update[i].get("Email", None) or None,
-                                    C_FirstName=leads_to_update[i].get("ContactFirstName", None) or None,
-                                    C_LastName=leads_to_update[i].get("ContactLastName", None) or None,
-                                    C_Title=leads_to_update[i].get("ContactFunctionalTitleName", None) or None,
-                                    C_MobilePhone=leads_to_update[i].get("ContactMobile", None) or None,
-                                    C_BusPhone=leads_to_update[i].get("ContactPhone", None) or None,
-                                    C_Description1=leads_to_update[i].get("Note", None) or None,
-                                    C_SAP_Field_of_Work1=leads_to_update[i].get("ZFieldofWork_KUT", None) or None,
-                                    C_SAP_B2B_Product_Group1=leads_to_update[i].get("ZProductGrp_KUT", None) or None,
-                                    C_SFDC___Dealer_Source1=leads_to_update[i].get("ZDealerSource_KUT", None) or None,
-                                    C_SAP_Lead_Campaign_Value1=leads_to_update[i].get("ZCampaignvalue_KUT", None) or None,
-                                    C_SFDC___Roofing_lead_category1=leads_to_update[i].get("ZRoofLeadCat_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Installation1=leads_to_update[i].get("ZRelRoofInstallation_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Profile1=leads_to_update[i].get("ZRelRoofProfile_KUT", None) or None,
-                                    C_SAP_Related_Roofing_RWS1=leads_to_update[i].get("ZRelRoofRWS_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Safety1=leads_to_update[i].get("ZRelRoofSafety_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Accessories1=leads_to_update[i].get("ZRelRoofAccessories_KUT", None) or None,
-                                    C_SAP_Related_Roofing_Solar1=leads_to_update[i].get("ZRelRoofSolar_KUT", None) or None,
-                                    C_SAP_Attachment_I1=leads_to_update[i].get("ZAttachment1URL_KUT", None) or None,
-                                    C_SAP_Attachment_II1=leads_to_update[i].get("ZAttachment2URL_KUT", None) or None,
-                                    C_SAP_Attachment_III1=leads_to_update[i].get("ZAttachment3URL_KUT", None) or None,
-                                    C_SAP_Attachment_IV1=leads_to_update[i].get("ZAttachment4URL_KUT", None) or None,
-                                    C_SAP_Attachment_V1=leads_to_update[i].get("ZAttachment5URL_KUT", None) or None,
-                                    C_SFDC_iPDF_01_Project_Status1=leads_to_update[i].get("ZProjectStatus_KUT", None) or None,
-                                    C_SFDC_iPDF_13_Billing_Address_Name1=leads_to_update[i].get("ZBillAddrName_KUT", None) or None,
-                                    C_SFDC_iPDF_09_Billing_Address_Street1=leads_to_update[i].get("ZBillAddrStreet_KUT", None) or None,
-                                    C_SFDC_iPDF_11_Billing_Address_City1=leads_to_update[i].get("ZBillAddrCity_KUT", None) or None,
-                                    C_SFDC_iPDF_10_Billing_Address_Zip1=leads_to_update[i].get("ZBillAddrPostcode_KUT", None) or None,
-                                    C_SFDC_iPDF_12_Billing_Address_Country1=leads_to_update[i].get("ZBillAddrCtry_KUT", None) or None,
-                                    C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=leads_to_update[i].get("ZInstatsiteearlatweek_KUT", None) or None,
-                                    C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=leads_to_update[i].get("ZInstatsitelateatweek_KUT", None) or None,
-                                    C_SFDC_iPDF_02_Products_at_Site_Week1=leads_to_update[i].get("ZProductsatsiteweek_KUT", None) or None,
-                                    C_SFDC_iPDF_14_Homing_Date1=leads_to_update[i].get("ZEloquaHomLettDate_KUT", None) or None,
-                                    C_SFDC_iPDF_05_Project_Manager_1_Name1=leads_to_update[i].get("ZProjMan1Name_KUT", None) or None,
-                                    C_SFDC_iPDF_05_Project_Manager_1_Email1=leads_to_update[i].get("ZProjMan1Email_KUT", None) or None,
-                                    C_SFDC_iPDF_06_Project_Manager_1_Mobile1=leads_to_update[i].get("ZProjMan1Mobile_KUT", None) or None,
-                                    C_SFDC_iPDF_07_Project_Manager_2_Name_1=leads_to_update[i].get("ZProjMan2Name_KUT", None) or None,
-                                    C_SFDC_iPDF_05_Project_Manager_2_Email1=leads_to_update[i].get("ZProjMan2Email_KUT", None) or None,
-                                    C_SFDC_iPDF_08_Project_Manager_2_Mobile1=leads_to_update[i].get("ZProjMan2Mobile_KUT", None) or None,
-                                    C_SAP_Created_to_Kata_Date1=leads_to_update[i].get("ZCreatedToKataDate_KUT", None) or None,
-                                    C_SFDC___Created_To_Kata_Time1=leads_to_update[i].get("ZCreatedToKataTime_KUT", None) or None,
-                                    C_Meeting_Date_for_email1=leads_to_update[i].get("ZAgreedappdate_KUT", None) or None,
-                                    C_Meeting_time_for_email1=leads_to_update[i].get("ZAgreedapptime_KUT", None) or None,
-                                    C_SAP_UTM_Medium_Original1=leads_to_update[i].get("ZUTMMediumOriginal_KUT", None) or None,
-                                    C_SAP_UTM_Source_Original1=leads_to_update[i].get("ZUTMSourceOriginal_KUT", None) or None,
-                                    C_SAP_UTM_Medium_Recent1=leads_to_update[i].get("ZUTMMediumRecent_KUT", None) or None,
-                                    C_SAP_UTM_Source_Recent1=leads_to_update[i].get("ZUTMSourceRecent_KUT", None) or None,
-                                    C_EML_GROUP_Professional1=leads_to_update[i].get("B2B_MP_Consent", None) or None,
-                                    C_EML_GROUP_Roofs_and_renovations1 = leads_to_update[i].get("B2C_MP_Consent", None) or None,
-                                    C_SFDC_Survey_Status_Installation1=leads_to_update[i].get("ZCustomerSurveyStatus_KUT", None) or None,
-                                    ContactUUID=leads_to_update[i].get("ContactUUID", None) or None,
-                                    URI=leads_to_update[i].get("URI", None) or None,
-                                    C4C_Task_Name=leads_to_update[i].get("C4C_Task_Name", None) or None,
-                                    C4C_Status=leads_to_update[i].get("C4C_Status", None) or None,
-                                    TimeInsertedUTC=datetime.utcnow(),
-                                )
-                            .where(Lead.TableID == leads_to_update[i]["TableID"])
-                    )
-                logger.debug("Finish Outbound Bulk Update {0} records to table Lead".format(len(leads_to_update)))
-            if leads_to_insert:
-                session_.execute(
-                    Lead.__table__.insert(),
-                    [
-                        dict
-                            (
-                                C_SAP_Lead_ID1=leads_to_insert[i].get("ID", None) or None,
-                                C_SFDC___Lead_Record_Type_ID1=leads_to_insert[i].get("GroupCode", None) or None,
-                                C_SFDC___Lead_Name1=leads_to_insert[i].get("Name", None) or None,
-                                C_SAP_Lead_Status1=leads_to_insert[i].get("UserStatusCode", None) or None,
-                                C_SAP_Dealer_ID1=leads_to_insert[i].get("OwnerPartyUUID", None) or None,
-                                C_Company=leads_to_insert[i].get("Company", None) or None,
-                                C_Address1=leads_to_insert[i].get("AccountPostalAddressElementsStreetName", None) or None,
-                                C_City=leads_to_insert[i].get("AccountCity", None) or None,
-                                C_Zip_Postal=leads_to_insert[i].get("AccountPostalAddressElementsStreetPostalCode", None) or None,
-                                C_State_Prov=leads_to_insert[i].get("AccountState", None) or None,
-                                C_Country=leads_to_insert[i].get("AccountCountry", None) or None,
-                                C_EmailAddress=leads_to_insert[i].get("Email", None) or None,
-                                C_FirstName=leads_to_insert[i].get("ContactFirstName", None) or None,
-                                C_LastName=leads_to_insert[i].get("ContactLastName", None) or None,
-                                C_Title=leads_to_insert[i].get("ContactFunctionalTitleName", None) or None,
-                                C_MobilePhone=leads_to_insert[i].get("ContactMobile", None) or None,
-                                C_BusPhone=leads_to_insert[i].get("ContactPhone", None) or None,
-                                C_Description1=leads_to_insert[i].get("Note", None) or None,
-                                C_SAP_Field_of_Work1=leads_to_insert[i].get("ZFieldofWork_KUT", None) or None,
-                                C_SAP_B2B_Product_Group1=leads_to_insert[i].get("ZProductGrp_KUT", None) or None,
-                                C_SFDC___Dealer_Source1=leads_to_insert[i].get("ZDealerSource_KUT", None) or None,
-                                C_SAP_Lead_Campaign_Value1=leads_to_insert[i].get("ZCampaignvalue_KUT", None) or None,
-                                C_SFDC___Roofing_lead_category1=leads_to_insert[i].get("ZRoofLeadCat_KUT", None) or None,
-                                C_SAP_Related_Roofing_Installation1=leads_to_insert[i].get("ZRelRoofInstallation_KUT", None) or None,
-                                C_SAP_Related_Roofing_Profile1=leads_to_insert[i].get("ZRelRoofProfile_KUT", None) or None,
-                                C_SAP_Related_Roofing_RWS1=leads_to_insert[i].get("ZRelRoofRWS_KUT", None) or None,
-                                C_SAP_Related_Roofing_Safety1=leads_to_insert[i].get("ZRelRoofSafety_KUT", None) or None,
-                                C_SAP_Related_Roofing_Accessories1=leads_to_insert[i].get("ZRelRoofAccessories_KUT", None) or None,
-                                C_SAP_Related_Roofing_Solar1=leads_to_insert[i].get("ZRelRoofSolar_KUT", None) or None,
-                                C_SAP_Attachment_I1=leads_to_insert[i].get("ZAttachment1URL_KUT", None) or None,
-                                C_SAP_Attachment_II1=leads_to_insert[i].get("ZAttachment2URL_KUT", None) or None,
-                                C_SAP_Attachment_III1=leads_to_insert[i].get("ZAttachment3URL_KUT", None) or None,
-                                C_SAP_Attachment_IV1=leads_to_insert[i].get("ZAttachment4URL_KUT", None) or None,
-                                C_SAP_Attachment_V1=leads_to_insert[i].get("ZAttachment5URL_KUT", None) or None,
-                                C_SFDC_iPDF_01_Project_Status1=leads_to_insert[i].get("ZProjectStatus_KUT", None) or None,
-                                C_SFDC_iPDF_13_Billing_Address_Name1=leads_to_insert[i].get("ZBillAddrName_KUT", None) or None,
-                                C_SFDC_iPDF_09_Billing_Address_Street1=leads_to_insert[i].get("ZBillAddrStreet_KUT", None) or None,
-                                C_SFDC_iPDF_11_Billing_Address_City1=leads_to_insert[i].get("ZBillAddrCity_KUT", None) or None,
-                                C_SFDC_iPDF_10_Billing_Address_Zip1=leads_to_insert[i].get("ZBillAddrPostcode_KUT", None) or None,
-                                C_SFDC_iPDF_12_Billing_Address_Country1=leads_to_insert[i].get("ZBillAddrCtry_KUT", None) or None,
-                                C_SFDC_iPDF_03_Installers_at_Site_Earliest_We=leads_to_insert[i].get("ZInstatsiteearlatweek_KUT", None) or None,
-                                C_SFDC_iPDF_04_Installers_at_Site_Latest_Week=leads_to_insert[i].get("ZInstatsitelateatweek_KUT", None) or None,
-                                C_SFDC_iPDF_02_Products_at_Site_Week1=leads_to_insert[i].get("ZProductsatsiteweek_KUT", None) or None,
-                                C_SFDC_iPDF_14_Homing_Date1=leads_to_insert[i].get("ZEloquaHomLettDate_KUT", None) or None,
-                                C_SFDC_iPDF_05_Project_Manager_1_Name1=leads_to_insert[i].get("ZProjMan1Name_KUT", None) or None,
-                                C_SFDC_iPDF_05_Project_Manager_1_Email1=leads_to_insert[i].get("ZProjMan1Email_KUT", None) or None,
-                                C_SFDC_iPDF_06_Project_Manager_1_Mobile1=leads_to_insert[i].get("ZProjMan1Mobile_KUT", None) or None,
-                                C_SFDC_iPDF_07_Project_Manager_2_Name_1=leads_to_insert[i].get("ZProjMan2Name_KUT", None) or None,
-                                C_SFDC_iPDF_05_Project_Manager_2_Email1=leads_to_insert[i].get("ZProjMan2Email_KUT", None) or None,
-                                C_SFDC_iPDF_08_Project_Manager_2_Mobile1=leads_to_insert[i].get("ZProjMan2Mobile_KUT", None) or None,
-                                C_SAP_Created_to_Kata_Date1=leads_to_insert[i].get("ZCreatedToKataDate_KUT", None) or None,
-                                C_SFDC___Created_To_Kata_Time1=leads_to_insert[i].get("ZCreatedToKataTime_KUT", None) or None,
-                                C_Meeting_Date_for_email1=leads_to_insert[i].get("ZAgreedappdate_KUT", None) or None,
-                                C_Meeting_time_for_email1=leads_to_insert[i].get("ZAgreedapptime_KUT", None) or None,
-                                C_SAP_UTM_Medium_Original1=leads_to_insert[i].get("ZUTMMediumOriginal_KUT", None) or None,
-                                C_SAP_UTM_Source_Original1=leads_to_insert[i].get("ZUTMSourceOriginal_KUT", None) or None,
-                                C_SAP_UTM_Medium_Recent1=leads_to_insert[i].get("ZUTMMediumRecent_KUT", None) or None,
-                                C_SAP_UTM_Source_Recent1=leads_to_insert[i].get("ZUTMSourceRecent_KUT", None) or None,
-                                C_EML_GROUP_Professional1=leads_to_insert[i].get("B2B_MP_Consent", None) or None,
-                                C_EML_GROUP_Roofs_and_renovations1=leads_to_insert[i].get("B2C_MP_Consent", None) or None,
-                                C_SFDC_Survey_Status_Installation1=leads_to_insert[i].get("ZCustomerSurveyStatus_KUT", None) or None,
-                                ContactUUID=leads_to_insert[i].get("ContactUUID", None) or None,
-                                URI=leads_to_insert[i].get("URI", None) or None,
-                                C4C_Task_Name=leads_to_insert[i].get("C4C_Task_Name", None) or None,
-                                C4C_Status=leads_to_insert[i].get("C4C_Status", None) or None,
-                                TimeInsertedUTC=datetime.utcnow(),
-                        )
-                        for i in range(0, len(leads_to_insert))
-                    ]
-                )
-                logger.debug("Finish Outbound Bulk Insert {0} records table Lead".format(len(leads_to_insert)))
+            # outbound leads are read from DB and always have their TableID
+            count = upsert_rows(session_=session_, table=Lead.__table__, index_elements=["TableID"],
+                                rows=[outbound_lead_row(entry, time_inserted) for entry in data],
+                                where=Lead.C4C_Claimed_By == worker_id if worker_id else None)
+            logger.debug("Finish Outbound Bulk Upsert {0} records to table Lead".format(count))
     else:
         logger.debug("No data to insert/update table Lead")
 
 
 def upsert_target_gr(session_, data, contact_list_ids):
     if data:
-        upsert_data = sort_upsert_data(session_=session_, type="tg", data=data)
-        target_grs_to_update = upsert_data.get("entries_to_update", [])
-        target_grs_to_insert = upsert_data.get("entries_to_insert", [])
-        if target_grs_to_update:
-            for i in range(0, len(target_grs_to_update)):
-                session_.execute(
-                    TargetGroup.__table__.update()
-                        .values
-                            (
-                                TargetGroupID=target_grs_to_update[i].get("ID", None) or None,
-                                Name=target_grs_to_update[i].get("Description", None) or None,
-                                ContactListIDInEloqua=contact_list_ids.get(target_grs_to_update[i].get("Description", None), None) or None
-                                    if contact_list_ids
-                                    else None,
-                                TimeInsertedUTC=datetime.utcnow()
-                            )
-                        .where(TargetGroup.TargetGroupID == target_grs_to_update[i]["ID"])
-                )
-            logger.debug("Finish Inbound Bulk Update {0} records to table Target Group".format(len(target_grs_to_update)))
-        if target_grs_to_insert:
-            session_.execute(
-                TargetGroup.__table__.insert(),
-                [
-                    dict
-                        (
-                            TargetGroupID=target_grs_to_insert[i].get("ID", None) or None,
-                            Name=target_grs_to_insert[i].get("Description", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(target_grs_to_insert))
-                ]
-            )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Target Group".format(len(target_grs_to_insert)))
+        time_inserted = datetime.utcnow()
+        count = upsert_rows(session_=session_, table=TargetGroup.__table__, index_elements=["TargetGroupID"],
+                            rows=[target_gr_row(entry, contact_list_ids, time_inserted) for entry in data],
+                            copy="tg" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Bulk Upsert {0} records to table Target Group".format(count))
     else:
         logger.debug("No data to insert/update table Target Group")
 
 
-def upsert_target_gr_m(session_, data):
+def upsert_target_gr_m(session_, data, batch_size=DB_UPSERT_BATCH_SIZE):
+    '''
+    Sync target group members with the members fetched from C4C, which always come in full because they have no date filter.
+    Only the difference to the members in DB is written, new members are inserted and missing ones are deleted in batches,
+    so that the table is not rewritten and stays readable
+    :param session_: SQL session
+    :param data: all target group members in C4C
+    :param batch_size: number of members per statement
+    :return: None
+    '''
     if data:
         # pre-process data
         for i in data:
-            i.pop("__metadata")
-        non_empty_id_data = [entry for entry in data if entry.get("ContactID", None)]
-        clean_data = list(map(dict, set(tuple(entry.items()) for entry in non_empty_id_data)))
-
-        # always truncate table before insert because target group member does not have date filter
-        if truncate_target_gr_m(session_=session_):
+            i.pop("__metadata", None)
+        fetched_members = set((entry["ContactID"], entry.get("TargetGroupID", None) or None)
+                              for entry in data if entry.get("ContactID", None))
+        existing_members = set(create_query(session_=session_, purpose="upsert", type="tgm").all())
+        members_to_insert = sorted(fetched_members - existing_members, key=str)
+        members_to_delete = sorted(existing_members - fetched_members, key=str)
+
+        for i in range(0, len(members_to_delete), batch_size):
             session_.execute(
-                TargetGroupMember.__table__.insert(),
-                [
-                    dict
-                        (
-                            C_SFDCContactID=clean_data[i]["ContactID"],
-                            TargetGroupID=clean_data[i].get("TargetGroupID", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(clean_data))
-                ]
+                TargetGroupMember.__table__.delete()
+                    .where(tuple_(TargetGroupMember.C_SFDCContactID, TargetGroupMember.TargetGroupID)
+                           .in_(members_to_delete[i:i + batch_size]))
             )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Target Group Member".format(len(clean_data)))
-        else:
-            logger.debug("Error Inbound Bulk Insert {0} records to table Target Group Member".format(len(clean_data)))
+        if members_to_insert:
+            time_inserted = datetime.utcnow()
+            upsert_rows(session_=session_, table=TargetGroupMember.__table__,
+                        index_elements=["C_SFDCContactID", "TargetGroupID"], batch_size=batch_size,
+                        rows=[dict(C_SFDCContactID=contact_id, TargetGroupID=target_gr_id, TimeInsertedUTC=time_inserted)
+                              for contact_id, target_gr_id in members_to_insert],
+                        copy="tgm" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Sync of {0} records to table Target Group Member, {1} inserted and {2} deleted".format(
+            len(fetched_members), len(members_to_insert), len(members_to_delete)))
     else:
         logger.debug("No data to insert/update table Target Group Member")
 
 
 def upsert_mark_p(session_, data):
     if data:
-        upsert_data = sort_upsert_data(session_=session_, type="mp", data=data)
-        mark_ps_to_update = upsert_data.get("entries_to_update", [])
-        mark_ps_to_insert = upsert_data.get("entries_to_insert", [])
-        unique_mark_ps_to_update = list(map(dict, set(tuple(entry.items()) for entry in mark_ps_to_update)))
-        unique_mark_ps_to_insert = list(map(dict, set(tuple(entry.items()) for entry in mark_ps_to_insert)))
-
-        if unique_mark_ps_to_update:
-            for i in range(0, len(unique_mark_ps_to_update)):
-                session_.execute(
-                    MarketingPermission.__table__.update()
-                        .values
-                            (
-                                GeneralConsent=unique_mark_ps_to_update[i].get("GeneralConsent", None) or None,
-                                TimeInsertedUTC=datetime.utcnow()
-                            )
-                        .where(MarketingPermission.ContactUUID == unique_mark_ps_to_update[i]["BusinessPartnerUUID"])
-                )
-            logger.debug("Finish Inbound Bulk Update {0} records to table Marketing Permission".format(len(unique_mark_ps_to_update)))
-        if unique_mark_ps_to_insert:
-            session_.execute(
-                MarketingPermission.__table__.insert(),
-                [
-                    dict
-                        (
-                            ContactUUID=unique_mark_ps_to_insert[i].get("BusinessPartnerUUID", None) or None,
-                            GeneralConsent=unique_mark_ps_to_insert[i].get("GeneralConsent", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(unique_mark_ps_to_insert))
-                ]
-            )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Marketing Permission".format(len(unique_mark_ps_to_insert)))
+        time_inserted = datetime.utcnow()
+        count = upsert_rows(session_=session_, table=MarketingPermission.__table__, index_elements=["ContactUUID"],
+                            rows=[mark_p_row(entry, time_inserted) for entry in data],
+                            copy="mp" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Bulk Upsert {0} records to table Marketing Permission".format(count))
     else:
         logger.debug("No data to insert/update table Marketing Permission")
 
 
 def upsert_emp(session_, data, type):
     if data:
-        upsert_data = sort_upsert_data(session_=session_, type="emp", data=data)
-        emp_to_update = upsert_data.get("entries_to_update", [])
-        emp_to_insert = upsert_data.get("entries_to_insert", [])
-        if emp_to_update:
-            for i in range(0, len(emp_to_update)):
-                session_.execute(
-                    Employee.__table__.update()
-                        .values
-                            (
-                                Name=str(emp_to_update[i]["FirstName"]) + " " + str(emp_to_update[i]["LastName"])
-                                    if emp_to_update[i].get("FirstName", None) and emp_to_update[i].get("LastName", None)
-                                    # business partner
-                                    else emp_to_update[i].get("Name", None) or None,
-                                Email=emp_to_update[i].get("Email", None) or None,
-                                Department=emp_to_update[i].get("Department", None) or None,
-                                Country=emp_to_update[i].get("CountryCode", None) or None,
-                                BusinessPartnerID=emp_to_update[i].get("BusinessPartnerID", None) or None,
-                                TimeInsertedUTC=datetime.utcnow()
-                            )
-                        .where(Employee.EmployeeID == emp_to_update[i]["UUID"])
-                )
-            logger.debug("Finish Inbound Bulk Update {0} records to table Employee type {1}".format(len(emp_to_update), type))
-        if emp_to_insert:
-            session_.execute(
-                Employee.__table__.insert(),
-                [
-                    dict
-                        (
-                            EmployeeID=emp_to_insert[i].get("UUID", None) or None,
-                            Name=str(emp_to_insert[i]["FirstName"]) + " " + str(emp_to_insert[i]["LastName"])
-                                if emp_to_insert[i].get("FirstName", None) and emp_to_insert[i].get("LastName", None)
-                                # business partner
-                                else emp_to_insert[i].get("Name", None) or None,
-                            Email=emp_to_insert[i].get("Email", None) or None,
-                            Department=emp_to_insert[i].get("Department", None) or None,
-                            Country=emp_to_insert[i].get("CountryCode", None) or None,
-                            BusinessPartnerID=emp_to_insert[i].get("BusinessPartnerID", None) or None,
-                            TimeInsertedUTC=datetime.utcnow()
-                        )
-                    for i in range(0, len(emp_to_insert))
-                ]
-            )
-            logger.debug("Finish Inbound Bulk Insert {0} records to table Employee type {1}".format(len(emp_to_insert), type))
+        time_inserted = datetime.utcnow()
+        count = upsert_rows(session_=session_, table=Employee.__table__, index_elements=["EmployeeID"],
+                            rows=[emp_row(entry, time_inserted) for entry in data],
+                            copy="emp" in DB_COPY_ENTITIES)
+        logger.debug("Finish Inbound Bulk Upsert {0} records to table Employee type {1}".format(count, type))
     else:
         logger.debug("No data to insert/update Employee type {0}".format(type))
-
-
-def truncate_target_gr_m(session_):
-    try:
-        session_.execute(delete(TargetGroupMember))
-        return True
-    except Exception as e:
-        return False
\ No newline at end of file
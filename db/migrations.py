@@ -0,0 +1,142 @@
+import argparse
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import select
+
+from db.tables_init import Base, engine, SchemaMigration
+from logging_config import setup_logging
+
+logger = setup_logging(__name__)
+
+# key of the advisory lock held while migrations are applied, so that concurrent runs apply each migration once
+migration_lock_key = 4104
+
+# (version, name, SQL statements) in order of version, a released migration is never edited, a new one is added instead.
+# Statements are idempotent, so that migrations also apply to tables that create_tables made with the latest models
+migrations = [
+    (1, "lead payload and consent hashes",
+     ['ALTER TABLE lead ADD COLUMN IF NOT EXISTS "C4C_Payload_Hash" VARCHAR(64)',
+      'ALTER TABLE lead ADD COLUMN IF NOT EXISTS "C4C_Consent_Hash" VARCHAR(64)',
+      'ALTER TABLE lead ADD COLUMN IF NOT EXISTS "C4C_Last_Payload" TEXT']),
+    (2, "indexes of hot query columns",
+     # leads to import to C4C, only the few that are not sent yet are indexed
+     ['CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lead_c4c_status_open ON lead ("C4C_Status") '
+      'WHERE "C4C_Status" IN (\'pending\', \'processing\')',
+      # leads from C4C are matched on their ID
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lead_c_sap_lead_id1 ON lead ("C_SAP_Lead_ID1")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lead_contact_uuid ON lead ("ContactUUID")',
+      # target groups without a contact list in Eloqua yet
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_target_group_contact_list_id_in_eloqua ON target_group ("ContactListIDInEloqua")',
+      # get_data_by_time
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_contact_time_inserted_utc ON contact ("TimeInsertedUTC")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_account_time_inserted_utc ON account ("TimeInsertedUTC")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_lead_time_inserted_utc ON lead ("TimeInsertedUTC")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_target_group_time_inserted_utc ON target_group ("TimeInsertedUTC")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_marketing_permission_time_inserted_utc ON marketing_permission ("TimeInsertedUTC")',
+      'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_employee_time_inserted_utc ON employee ("TimeInsertedUTC")']),
+    (3, "lead claims of import_c4c workers",
+     ['ALTER TABLE lead ADD COLUMN IF NOT EXISTS "C4C_Claimed_By" VARCHAR(100)',
+      'ALTER TABLE lead ADD COLUMN IF NOT EXISTS "C4C_Lease_Expires_UTC" TIMESTAMP WITH TIME ZONE']),
+    (4, "backfill shards with an end",
+     # open-ended shards of earlier versions do not tell how far they got, their range is backfilled again
+     ['DO $$ BEGIN IF to_regclass(\'backfill_shard\') IS NOT NULL THEN '
+      'DELETE FROM backfill_shard WHERE "DateTo" IS NULL; '
+      'ALTER TABLE backfill_shard ALTER COLUMN "DateTo" SET NOT NULL; '
+      'END IF; END $$']),
+]
+
+# migrations that can not run in a transaction, their statements are run one by one in autocommit mode.
+# CREATE INDEX CONCURRENTLY does not block writes to the table while the index is built, as a plain CREATE INDEX does
+non_transactional_versions = {2}
+
+
+def drop_invalid_index(conn, statement):
+    '''
+    Drop the index of a CREATE INDEX CONCURRENTLY statement if it was left invalid by a failed build,
+    as IF NOT EXISTS would keep it
+    :param conn: connection in autocommit mode
+    :param statement: SQL statement
+    '''
+    match = re.match(r"CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)", statement)
+    if match and conn.execute("SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+                              "WHERE pg_class.relname = %s AND NOT pg_index.indisvalid", match.group(1)).first():
+        logger.debug("Drop invalid index {0} to build it again".format(match.group(1)))
+        conn.execute("DROP INDEX CONCURRENTLY IF EXISTS {0}".format(match.group(1)))
+
+
+def get_applied_versions():
+    with engine.connect() as conn:
+        return [row[0] for row in conn.execute(select([SchemaMigration.Version]).order_by(SchemaMigration.Version))]
+
+
+def get_pending_versions():
+    '''
+    :return: versions of the migrations not applied yet, all of them if table schema_migration does not exist yet
+    '''
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, SchemaMigration.__tablename__):
+            return [version for version, name, statements in migrations]
+    applied_versions = get_applied_versions()
+    return [version for version, name, statements in migrations if version not in applied_versions]
+
+
+def check_schema():
+    '''
+    Stop a run on a database that the migrations are not applied to yet,
+    instead of failing on the first query of a column they add
+    '''
+    pending_versions = get_pending_versions()
+    if pending_versions:
+        sys.exit("Migrations {0} are not applied to the database yet, run 'python -m db.migrations' first".format(
+            pending_versions))
+
+
+def migrate():
+    '''
+    Create missing tables and apply the migrations that are not applied yet, each in its own transaction
+    along with its row in table schema_migration, or statement by statement in autocommit mode
+    for non_transactional_versions, with the row added once all statements are done.
+    Existing tables and data are kept
+    :return: list of versions applied
+    '''
+    Base.metadata.create_all(engine)
+    applied = []
+    # the session level lock is held over all migrations, non transactional ones included
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute("SELECT pg_advisory_lock({0})".format(migration_lock_key))
+        try:
+            for version, name, statements in migrations:
+                if lock_conn.execute(select([SchemaMigration.Version]).where(SchemaMigration.Version == version)).first():
+                    continue
+                if version in non_transactional_versions:
+                    for statement in statements:
+                        drop_invalid_index(conn=lock_conn, statement=statement)
+                        lock_conn.execute(statement)
+                    lock_conn.execute(SchemaMigration.__table__.insert().values(Version=version, Name=name,
+                                                                                TimeInsertedUTC=datetime.utcnow()))
+                else:
+                    with engine.begin() as conn:
+                        for statement in statements:
+                            conn.execute(statement)
+                        conn.execute(SchemaMigration.__table__.insert().values(Version=version, Name=name,
+                                                                               TimeInsertedUTC=datetime.utcnow()))
+                applied.append(version)
+                logger.debug("Migration {0} '{1}' applied".format(version, name))
+        finally:
+            lock_conn.execute("SELECT pg_advisory_unlock({0})".format(migration_lock_key))
+    logger.debug("Schema at version {0}, {1} migrations applied now".format(migrations[-1][0], len(applied)))
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status", action="store_true", help="only log applied and pending migrations")
+    if parser.parse_args().status:
+        applied_versions = get_applied_versions()
+        for version, name, statements in migrations:
+            logger.debug("Migration {0} '{1}' {2}".format(version, name,
+                                                          "applied" if version in applied_versions else "pending"))
+    else:
+        migrate()
@@ -1,4 +1,6 @@
-from sqlalchemy import create_engine, Integer, Column, String, DateTime, PrimaryKeyConstraint
+import argparse
+
+from sqlalchemy import create_engine, Integer, Column, String, DateTime, PrimaryKeyConstraint, Text
 from sqlalchemy.ext.declarative import declarative_base
 
 from logging_config import setup_logging
@@ -9,7 +11,7 @@ logger = setup_logging(__name__)
 Base = declarative_base()
 # set echo="debug" for debug messages
 # (a lot, not readable when deployed)
-engine = create_engine(url=DB_URI, echo=False)
+engine = create_engine(DB_URI, echo=False)
 
 
 # define data models
@@ -134,6 +136,13 @@ class Lead(Base):
     # outbound integration
     C4C_Task_Name = Column(String(100))
     C4C_Status = Column(String(100))
+    # hashes and payload of the last successful push to C4C, to skip or reduce the next Patch
+    C4C_Payload_Hash = Column(String(64))
+    C4C_Consent_Hash = Column(String(64))
+    C4C_Last_Payload = Column(Text)
+    # import_c4c worker that claimed the lead, and when its claim expires and the lead can be claimed again
+    C4C_Claimed_By = Column(String(100))
+    C4C_Lease_Expires_UTC = Column(DateTime(timezone=True))
 
     def __repr__(self):
         return "<Lead(C_EmailAddress='%s', C_SAP_Lead_ID1='%s')>" % (self.C_EmailAddress, self.C_SAP_Lead_ID1)
@@ -186,11 +195,64 @@ class Employee(Base):
         return "<Employee(EmployeeID='%s')>" % self.EmployeeID
 
 
+class SyncWatermark(Base):
+    __tablename__ = "sync_watermark"
+    # data type, or name of the pull when one data type is pulled for different purposes
+    Entity = Column(String(100), primary_key=True)
+    # max EntityLastChangedOn in C4C of the data ingested so far
+    LastChangedOn = Column(DateTime(timezone=True))
+    TimeInsertedUTC = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return "<SyncWatermark(Entity='%s', LastChangedOn='%s')>" % (self.Entity, self.LastChangedOn)
+
+
+class BackfillShard(Base):
+    __tablename__ = "backfill_shard"
+    # data type of the backfill
+    Entity = Column(String(100))
+    # EntityLastChangedOn range of the shard, DateTo excluded
+    DateFrom = Column(DateTime(timezone=True))
+    DateTo = Column(DateTime(timezone=True), nullable=False)
+    EntryCount = Column(Integer)
+    # time the shard was completed
+    TimeInsertedUTC = Column(DateTime(timezone=True))
+    __table_args__ = (PrimaryKeyConstraint(Entity, DateFrom), {})
+
+    def __repr__(self):
+        return "<BackfillShard(Entity='%s', DateFrom='%s', DateTo='%s')>" % (self.Entity, self.DateFrom, self.DateTo)
+
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migration"
+    # version of a migration in db/migrations.py
+    Version = Column(Integer, primary_key=True, autoincrement=False)
+    Name = Column(String(100))
+    # time the migration was applied
+    TimeInsertedUTC = Column(DateTime(timezone=True))
+
+    def __repr__(self):
+        return "<SchemaMigration(Version='%s')>" % self.Version
+
+
 def create_tables():
+    # indexes and later changes are applied on top by the migrations
+    from db.migrations import migrate
+
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
-    logger.debug("Tables Contact, Account, Lead, TargetGroup, TargetGroupMember, MarketingPermission, Employee created")
+    logger.debug("Tables Contact, Account, Lead, TargetGroup, TargetGroupMember, MarketingPermission, Employee, "
+                 "SyncWatermark, BackfillShard, SchemaMigration created")
+    migrate()
 
 
 if __name__ == "__main__":
-    create_tables()
+    # add upgrade arg
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--upgrade", type=int, help="input 1 to keep existing tables and only apply migrations, default is 0",
+                        nargs='?', default=0)
+    if parser.parse_args().upgrade:
+        from db.migrations import migrate
+        migrate()
+    else:
+        create_tables()
@@ -1,9 +1,11 @@
 import argparse
 from datetime import datetime, timedelta
 
+from backfill import backfill
 from c4c.c4c_client import C4CClient
 from elq.elq_client import ElqClient
 from db.db_crud import *
+from db.migrations import check_schema
 from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL, ELQ_USER, ELQ_PASSWORD, ELQ_BASE_URL
 
 
@@ -24,6 +26,8 @@ def prepare_data_elq_import(type, data):
 
 
 if __name__ == "__main__":
+    # lead hashes, claims and backfill shards are read and written from the first query
+    check_schema()
     # add first run arg
     parser = argparse.ArgumentParser()
     parser.add_argument("--first_run", type=int, help="input 1 for first run, default is 0", nargs='?', default=0)
@@ -49,36 +53,39 @@ if __name__ == "__main__":
     retriever = C4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL)
     elq_client = ElqClient(username=ELQ_USER, password=ELQ_PASSWORD, base_url=ELQ_BASE_URL)
 
-    with retriever.start_requests_session() as requests_session:
-        if first_run:
-            # get contacts and target groups from 2020 for first run
-            contacts = retriever.get_data(session_=requests_session, type="contact",
-                                          # max data to return
-                                          count=retriever.get_data_count(session_=requests_session, type="contact"),
-                                          date_from="2020-01-01T00:00:00Z")
-            accounts = retriever.get_data(session_=requests_session, type="account",
-                                          count=retriever.get_data_count(session_=requests_session, type="account"),
-                                          date_from=date_from)
-            target_gr_ms = retriever.get_data(session_=requests_session, type="tgm",
-                                              count=retriever.get_data_count(session_=requests_session, type="tgm"))
-            target_grs = retriever.get_data(session_=requests_session, type="tg",
-                                            count=retriever.get_data_count(session_=requests_session, type="tg"),
-                                            date_from="2020-01-01T00:00:00Z")
-        else:
-            contacts = retriever.get_data(session_=requests_session, type="contact",
-                                          count=retriever.get_data_count(session_=requests_session, type="contact"),
-                                          date_from=date_from)
-            accounts = retriever.get_data(session_=requests_session, type="account",
-                                          count=retriever.get_data_count(session_=requests_session, type="account"),
-                                          date_from=date_from)
-            target_gr_ms = retriever.get_data(session_=requests_session, type="tgm",
-                                              count=retriever.get_data_count(session_=requests_session, type="tgm"))
-            target_grs = retriever.get_data(session_=requests_session, type="tg",
-                                            count=retriever.get_data_count(session_=requests_session, type="tg"),
-                                            date_from=date_from)
+    with start_psql_session() as session:
+        # fetch from the max EntityLastChangedOn already ingested, if data was ingested before
+        contact_watermark = get_watermark(session_=session, entity="contact")
+        account_watermark = get_watermark(session_=session, entity="account")
+        target_gr_watermark = get_watermark(session_=session, entity="tg")
+
+    if first_run:
+        # get contacts and target groups from 2020 for first run,
+        # contacts and accounts are backfilled in checkpointed shards so that an interrupted first run resumes
+        backfill(retriever=retriever, entities={"contact": "2020-01-01T00:00:00Z", "account": date_from})
+        queries = dict()
+        target_gr_date_from = "2020-01-01T00:00:00Z"
+    else:
+        queries = {"contact": {"type": "contact", "date_from": contact_watermark or date_from},
+                   "account": {"type": "account", "date_from": account_watermark or date_from}}
+        target_gr_date_from = target_gr_watermark or date_from
+    # the collections do not depend on each other and are fetched at the same time,
+    # in the order they are written to DB below
+    queries["tgm"] = {"type": "tgm"}
+    queries["tg"] = {"type": "tg", "date_from": target_gr_date_from}
+    with retriever.fetch_data_pages(queries=queries) as pages:
         with start_psql_session() as session:
-            upsert_contact(session_=session, data=contacts)
-            upsert_account(session_=session, data=accounts)
+            # contacts and accounts are upserted page by page as they arrive,
+            # watermarks are advanced in the same session so that they are committed along with the data
+            for contacts in pages.get("contact", []):
+                upsert_contact(session_=session, data=contacts)
+                advance_watermark(session_=session, entity="contact", data=contacts)
+            for accounts in pages.get("account", []):
+                upsert_account(session_=session, data=accounts)
+                advance_watermark(session_=session, entity="account", data=accounts)
+            # target groups and their members are small, keep them in memory as a whole
+            target_gr_ms = [entry for page in pages["tgm"] for entry in page]
+            target_grs = [entry for page in pages["tg"] for entry in page]
             upsert_target_gr_m(session_=session, data=target_gr_ms)
 
             # upsert target groups with existing IDs in Eloqua
@@ -87,6 +94,7 @@ if __name__ == "__main__":
                                                          date_to=date_to_tg)
             contact_list_ids = elq_client.export_contact_list_ids(data=target_grs_existing_in_db, existing_id=True)
             upsert_target_gr(session_=session, data=target_grs, contact_list_ids=contact_list_ids)
+            advance_watermark(session_=session, entity="tg", data=target_grs)
             # upsert target groups without existing IDs in Eloqua
             target_grs_without_ids_in_eloqua = get_data_for_eloqua_import(session_=session, type="tg")
             duplicate_names = elq_client.import_contact_list(data=prepare_data_elq_import(type="tg", data=target_grs_without_ids_in_eloqua))
@@ -1,9 +1,11 @@
 import argparse
 from datetime import datetime, timedelta
 
+from backfill import backfill
 from c4c.c4c_client import C4CClient
 from elq.elq_client import ElqClient
 from db.db_crud import *
+from db.migrations import check_schema
 from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL, ELQ_USER, ELQ_PASSWORD, ELQ_BASE_URL
 
 
@@ -24,6 +26,8 @@ def prepare_data_elq_import(type, data):
 
 
 if __name__ == "__main__":
+    # lead hashes, claims and backfill shards are read and written from the first query
+    check_schema()
     # add first run arg
     parser = argparse.ArgumentParser()
     parser.add_argument("--first_run", type=int, help="input 1 for first run, default is 0", nargs='?', default=0)
@@ -48,38 +52,41 @@ if __name__ == "__main__":
     retriever = C4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL)
     elq_client = ElqClient(username=ELQ_USER, password=ELQ_PASSWORD, base_url=ELQ_BASE_URL)
 
-    with retriever.start_requests_session() as requests_session:
-        if first_run:
-            leads = retriever.get_data(session_=requests_session, type="lead",
-                                       count=retriever.get_data_count(session_=requests_session, type="lead"),
-                                       date_from=date_from)
-            mark_ps = retriever.get_data(session_=requests_session, type="mp",
-                                         count=retriever.get_data_count(session_=requests_session, type="mp"),
-                                         leads_to_get_mps=leads)
-            emps = retriever.get_data(session_=requests_session, type="emp",
-                                      count=retriever.get_data_count(session_=requests_session, type="emp"),
-                                      date_from="2020-01-01T00:00:00Z")
-        else:
-            leads = retriever.get_data(session_=requests_session, type="lead",
-                                       count=retriever.get_data_count(session_=requests_session, type="lead"),
-                                       date_from=date_from)
-            mark_ps = retriever.get_data(session_=requests_session, type="mp",
-                                         count=retriever.get_data_count(session_=requests_session, type="mp"),
-                                         leads_to_get_mps=leads)
-            emps = retriever.get_data(session_=requests_session, type="emp",
-                                      count=retriever.get_data_count(session_=requests_session, type="emp"),
-                                      date_from=date_from)
-        with start_psql_session() as session:
-            upsert_lead(session_=session, data=leads, inbound=True)
-            upsert_mark_p(session_=session, data=mark_ps)
+    with start_psql_session() as session:
+        # fetch from the max EntityLastChangedOn already ingested, if data was ingested before
+        lead_watermark = get_watermark(session_=session, entity="lead")
+        emp_watermark = get_watermark(session_=session, entity="emp")
 
-            # upsert employees
-            upsert_emp(session_=session, data=emps, type="Employee")
-            # upsert business partners
-            bps = retriever.get_data(session_=requests_session, type="bp", leads_to_get_bps=leads,
-                                     existing_emps=get_data_for_eloqua_import(session_=session, type="emp"))
-            upsert_emp(session_=session, data=bps, type="Business Partner")
-            # add all employees and business partners to an option list in Eloqua
-            all_emps_and_bps = get_data_for_eloqua_import(session_=session, type="emp")
-            elq_client.import_option_list(data=prepare_data_elq_import(type="emp", data=all_emps_and_bps),
-                                          name="Ruukki Employees from C4C REST API")
\ No newline at end of file
+    if first_run:
+        # leads and employees are backfilled in checkpointed shards so that an interrupted first run resumes,
+        # along with the marketing permissions and business partners of the leads
+        backfill(retriever=retriever, entities={"emp": "2020-01-01T00:00:00Z", "lead": date_from})
+    else:
+        # leads and employees do not depend on each other and are fetched at the same time,
+        # marketing permissions of the leads are fetched while employees are still coming
+        queries = {"lead": {"type": "lead", "date_from": lead_watermark or date_from},
+                   "emp": {"type": "emp", "date_from": emp_watermark or date_from}}
+        with retriever.start_requests_session() as requests_session, \
+                retriever.fetch_data_pages(queries=queries) as pages:
+            leads = [entry for page in pages["lead"] for entry in page]
+            mark_ps = retriever.get_data(session_=requests_session, type="mp", leads_to_get_mps=leads)
+            emps = [entry for page in pages["emp"] for entry in page]
+            with start_psql_session() as session:
+                # watermarks are advanced in the same session so that they are committed along with the data
+                upsert_lead(session_=session, data=leads, inbound=True)
+                advance_watermark(session_=session, entity="lead", data=leads)
+                upsert_mark_p(session_=session, data=mark_ps)
+
+                # upsert employees
+                upsert_emp(session_=session, data=emps, type="Employee")
+                advance_watermark(session_=session, entity="emp", data=emps)
+                # upsert business partners
+                bps = retriever.get_data(session_=requests_session, type="bp", leads_to_get_bps=leads,
+                                         existing_emps=get_data_for_eloqua_import(session_=session, type="emp"))
+                upsert_emp(session_=session, data=bps, type="Business Partner")
+
+    with start_psql_session() as session:
+        # add all employees and business partners to an option list in Eloqua
+        all_emps_and_bps = get_data_for_eloqua_import(session_=session, type="emp")
+        elq_client.import_option_list(data=prepare_data_elq_import(type="emp", data=all_emps_and_bps),
+                                      name="Ruukki Employees from C4C REST API")
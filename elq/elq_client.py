@@ -2,9 +2,9 @@ import json
 
 from dea.bulk.api import BulkClient
 from dea.rest.api.cdo import RestCdoClient
-from requests import Session
 from requests.auth import HTTPBasicAuth
 
+from http_session import create_session
 from logging_config import setup_logging
 
 logger = setup_logging(__name__)
@@ -17,7 +17,7 @@ class ElqClient:
         self.base_url = base_url
         self.bulk_client = BulkClient(auth=HTTPBasicAuth(username=username, password=password), base_url=base_url)
         self.rest_client = RestCdoClient(auth=HTTPBasicAuth(username=username, password=password), base_url=base_url)
-        self.eloqua_session = Session()
+        self.eloqua_session = create_session(auth=(username, password))
 
     def import_contact_list(self, data):
         '''
@@ -27,7 +27,6 @@ class ElqClient:
         '''
         duplicate_names = dict()
         if data:
-            self.eloqua_session.auth = (self.username, self.password)
             for entry in data:
                 response = self.eloqua_session.post(url=self.base_url + "/api/REST/1.0/assets/contact/list",
                                                     headers={"Content-Type": "application/json"},
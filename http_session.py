@@ -0,0 +1,80 @@
+import random
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# connections kept alive per host, enough for every request in flight
+pool_size = 10
+# seconds to connect and to wait for the response
+connect_timeout = 10
+read_timeout = 120
+# retries of idempotent requests on connection errors and the status codes below
+max_retries = 3
+retry_status_codes = (429, 502, 503, 504)
+retry_methods = ("HEAD", "GET", "OPTIONS", "PUT", "DELETE")
+# first retry at once, then waits 0.5s, 1s, 2s... plus up to backoff_jitter seconds
+backoff_factor = 0.5
+backoff_jitter = 0.5
+backoff_max = 30
+
+
+def get_backoff_time(retry_number, factor=backoff_factor, jitter=backoff_jitter, maximum=backoff_max):
+    '''
+    Exponential backoff with random jitter, so that retries of concurrent requests do not hit the server at once
+    :param retry_number: number of the retry, starting from 1
+    :return: seconds to wait
+    '''
+    if retry_number < 1:
+        return 0
+    return min(maximum, factor * (2 ** (retry_number - 1))) + random.uniform(0, jitter)
+
+
+class JitterRetry(Retry):
+    def get_backoff_time(self):
+        # consecutive errors only, like Retry
+        retry_number = len(list(self.history))
+        if retry_number <= 1:
+            return 0
+        return get_backoff_time(retry_number=retry_number - 1, factor=self.backoff_factor)
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter that applies a default timeout to requests sent without one
+    '''
+    def __init__(self, timeout=None, *args, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout", None) is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
+
+def create_session(auth=None, pool_size=pool_size, timeout=(connect_timeout, read_timeout), retries=max_retries,
+                   status_codes=retry_status_codes):
+    '''
+    Create a requests session with a sized keep-alive connection pool, default timeouts
+    and retries with backoff for idempotent requests
+    :param auth: auth of the session
+    :param pool_size: connections kept alive per host
+    :param timeout: (connect, read) timeout in seconds
+    :param retries: retries of idempotent requests, 0 to disable
+    :param status_codes: status codes retried, leave out those the caller retries itself
+    :return: requests session
+    '''
+    # urllib3 retries responses with Retry-After of these status codes even if they are not in status_forcelist
+    respect_retry_after = any(code in Retry.RETRY_AFTER_STATUS_CODES for code in status_codes)
+    # the final response is returned when retries are exhausted, callers check status codes themselves
+    retry = JitterRetry(total=retries, connect=retries, read=retries, status=retries,
+                        status_forcelist=status_codes, allowed_methods=frozenset(retry_methods),
+                        backoff_factor=backoff_factor, raise_on_status=False,
+                        respect_retry_after_header=respect_retry_after)
+    adapter = TimeoutHTTPAdapter(timeout=timeout, pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = Session()
+    session.auth = auth
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
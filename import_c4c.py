@@ -1,101 +1,145 @@
-from copy import deepcopy
+import os
+import socket
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 
 from logging_config import setup_logging
 
+from c4c import c4c_config
 from c4c.c4c_client import C4CClient
-from db.db_crud import start_psql_session, get_data_for_c4c_import, get_data_to_try_again,\
-    upsert_lead, upsert_mark_p, get_data_for_eloqua_import, upsert_emp
+from db.db_crud import start_psql_session, claim_leads, renew_leads, release_leads, get_unknown_leads,\
+    upsert_lead, upsert_mark_p, get_data_for_eloqua_import, upsert_emp, get_watermark, advance_watermark
+from db.migrations import check_schema
 from db_loader import prepare_data_elq_import
 from elq.elq_client import ElqClient
-from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL, ELQ_USER, ELQ_PASSWORD, ELQ_BASE_URL
+from settings import C4C_USER, C4C_PASSWORD, C4C_BASE_URL, C4C_MAX_IN_FLIGHT, ELQ_USER, ELQ_PASSWORD, ELQ_BASE_URL
 
 logger = setup_logging(__name__)
 
 if __name__ == "__main__":
+    # lead hashes and claims are read and written from the first query
+    check_schema()
     c4c_client = C4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL)
     elq_client = ElqClient(username=ELQ_USER, password=ELQ_PASSWORD, base_url=ELQ_BASE_URL)
+    # several runs can import at the same time, each claiming its own batches of leads
+    worker_id = "{0}-{1}".format(socket.gethostname(), os.getpid())
+    async_c4c_client = None
+    if C4C_MAX_IN_FLIGHT > 1:
+        # import lead, up to C4C_MAX_IN_FLIGHT leads at the same time
+        # (aiohttp is only required when enabled)
+        from c4c.c4c_async_client import AsyncC4CClient
+        async_c4c_client = AsyncC4CClient(username=C4C_USER, password=C4C_PASSWORD, base_url=C4C_BASE_URL,
+                                          max_in_flight=C4C_MAX_IN_FLIGHT)
+        # leads still pending after the async client are sent again by c4c_client, with the same token
+        async_c4c_client.share_token(client=c4c_client)
 
-    with start_psql_session() as session:
-        pending_data = get_data_for_c4c_import(session_=session)
-        formatted_pending_data = c4c_client.pre_process_data_for_post(data=pending_data)
+    # one session of each client for the whole run, so that connections, the CSRF token
+    # and what the rate limiter learnt are kept from one batch to the next.
+    # The CSRF token is only fetched by the first write, runs without leads to import do not fetch it
+    with c4c_client.start_requests_session() as requests_session, \
+            (async_c4c_client.start_blocking_session() if async_c4c_client else nullcontext()) as async_session:
+        # leads Posted in a failed $batch are looked up first, so that those created in C4C are Patched instead of
+        # Posted again, and written back within the session that locks them
+        with start_psql_session() as session:
+            unknown_data = c4c_client.pre_process_data_for_post(
+                data=get_unknown_leads(session_=session, batch_size=c4c_config.claim_batch_size))
+            c4c_client.resolve_unknown_leads(session_=requests_session, data=unknown_data)
+            upsert_lead(session_=session, data=unknown_data, outbound=True)
 
-    if formatted_pending_data:
-        with c4c_client.start_requests_session() as requests_session:
-            token = c4c_client.get_csrf_token(session_=requests_session)
-            if token:
-                # change lead status to "processing" so that it is no longer "pending"
-                # and not picked up by the next run (5 minute interval can be too short
-                # if there is a sudden huge amount of leads "pending" in DB due to Eloqua programs),
-                # and commit this separately from other sql session
+        claimed_count = 0
+        last_table_id = 0
+        try:
+            while True:
+                # claim leads as "processing" so that no other run picks them up, until the claim expires
+                # if this run crashes, and commit this separately from other sql session
                 with start_psql_session() as session:
-                    processing_data_to_db = deepcopy(formatted_pending_data)
-                    for entry in processing_data_to_db:
-                        entry["C4C_Status"] = "processing"
-                    upsert_lead(session_=session, data=processing_data_to_db, outbound=True)
+                    claimed_data = claim_leads(session_=session, worker_id=worker_id,
+                                               batch_size=c4c_config.claim_batch_size,
+                                               lease_seconds=c4c_config.claim_lease_seconds,
+                                               after_table_id=last_table_id)
+                if not claimed_data:
+                    break
+                claimed_count += len(claimed_data)
+                last_table_id = claimed_data[-1][0]
+                formatted_pending_data = c4c_client.pre_process_data_for_post(data=claimed_data)
+                # leads that cannot be sent are written back as "pending", for the next run to try again
+                for entry in formatted_pending_data:
+                    entry["C4C_Status"] = "pending"
+                logger.debug("Worker {0} claimed {1} leads up to TableID {2}".format(worker_id, len(claimed_data),
+                                                                                    last_table_id))
 
-                # import lead
-                first_try_output_c4c = c4c_client.post_lead_data(session_=requests_session, token=token,
-                                                                 data=formatted_pending_data)
+                # send the claimed leads chunk by chunk, each chunk within a renewed claim,
+                # and write each chunk back right after it is sent, even if sending it failed half way,
+                # so that leads created in C4C are not claimed and created again by the next run
+                for i in range(0, len(formatted_pending_data), c4c_config.lead_batch_size):
+                    chunk = formatted_pending_data[i:i + c4c_config.lead_batch_size]
+                    with start_psql_session() as session:
+                        claimed_table_ids = renew_leads(session_=session, worker_id=worker_id,
+                                                        table_ids=[entry["TableID"] for entry in chunk],
+                                                        lease_seconds=c4c_config.claim_lease_seconds)
+                    if len(claimed_table_ids) < len(chunk):
+                        logger.debug("Worker {0} lost the claim of {1} leads, skip them".format(
+                            worker_id, len(chunk) - len(claimed_table_ids)))
+                    chunk = [entry for entry in chunk if entry["TableID"] in claimed_table_ids]
+                    if not chunk:
+                        continue
+                    try:
+                        if async_c4c_client:
+                            # import lead, in one $batch request per request in flight
+                            async_c4c_client.run_post_lead_data(session_=async_session, data=chunk,
+                                                                batch_size=-(-len(chunk) // C4C_MAX_IN_FLIGHT))
+                        else:
+                            # import lead, in one $batch request
+                            c4c_client.post_lead_data(session_=requests_session, data=chunk,
+                                                      batch_size=c4c_config.lead_batch_size)
 
-                # sometimes leads are valid but still cannot be sent somehow
-                # retry once again here
-                second_try_data_c4c = [item for item in first_try_output_c4c if item["C4C_Status"] == "pending"]
-                if second_try_data_c4c:
-                    second_try_output_c4c = c4c_client.post_lead_data(session_=requests_session, token=token,
-                                                                      data=second_try_data_c4c)
+                        # sometimes leads are valid but still cannot be sent somehow
+                        # retry once again here, leads are updated in place.
+                        # "unknown" leads may have been created by a failed $batch and are not sent again
+                        second_try_data_c4c = [item for item in chunk if item["C4C_Status"] == "pending"]
+                        if second_try_data_c4c:
+                            c4c_client.post_lead_data(session_=requests_session, data=second_try_data_c4c)
+                    finally:
+                        # after sending leads (even successful or not)
+                        # continue to update leads information in DB
+                        # for the next run to pick up the right leads
+                        with start_psql_session() as session:
+                            upsert_lead(session_=session, data=chunk, outbound=True, worker_id=worker_id)
+        finally:
+            # lastly, leads claimed by this run that are still "processing", because they were not written back,
+            # are made "pending" to be processed again later
+            # and commit this separately from other sql session
+            with start_psql_session() as session:
+                released_count = release_leads(session_=session, worker_id=worker_id)
+            logger.debug("Worker {0} processed {1} leads, {2} of them released as 'pending'".format(
+                worker_id, claimed_count, released_count))
 
-                    # remove leads that are failed in first try but are successful in second try: remove and update
-                    for table_id in [item["TableID"] for item in second_try_output_c4c if item["C4C_Status"] != "pending"]:
-                        for item in first_try_output_c4c:
-                            if item["TableID"] == table_id:
-                                # remove leads that are failed in first
-                                first_try_output_c4c.remove(item)
-
-                    # update those that are successful in second try
-                    first_try_output_c4c += [item for item in second_try_output_c4c if item["C4C_Status"] != "pending"]
-
-                # after sending leads (even successful or not)
-                # continue to update leads information in DB
-                # for the next run to pick up the right leads
-                with start_psql_session() as session:
-                    upsert_lead(session_=session, data=first_try_output_c4c, outbound=True)
-                    # upsert marketing permissions, employees and business partners
-                    # resulted from new leads in past 5 minutes
-                    past_time = datetime.utcnow() - timedelta(minutes=5)
-                    date_from = str(past_time.date()) + "T" + str(past_time.time()) + "Z"
-                    # leads
-                    leads = c4c_client.get_data(session_=requests_session, type="lead",
-                                                count=c4c_client.get_data_count(session_=requests_session, type="lead"),
-                                                date_from=date_from)
-                    # marketing permissions
-                    mark_ps = c4c_client.get_data(session_=requests_session, type="mp",
-                                                  count=c4c_client.get_data_count(session_=requests_session, type="mp"),
-                                                  leads_to_get_mps=leads)
-                    upsert_mark_p(session_=session, data=mark_ps)
-                    # employees
-                    emps = c4c_client.get_data(session_=requests_session, type="emp",
-                                               count=c4c_client.get_data_count(session_=requests_session, type="emp"),
-                                               date_from=date_from)
-                    upsert_emp(session_=session, data=emps, type="Employee")
-                    # business partners
-                    bps = c4c_client.get_data(session_=requests_session, type="bp", leads_to_get_bps=leads,
-                                              existing_emps=get_data_for_eloqua_import(session_=session, type="emp"))
-                    upsert_emp(session_=session, data=bps, type="Business Partner")
-                    # update all new employees and business partners to an option list in Eloqua
-                    all_emps_and_bps = get_data_for_eloqua_import(session_=session, type="emp")
-                    elq_client.import_option_list(data=prepare_data_elq_import(type="emp", data=all_emps_and_bps),
-                                                  name="Ruukki Employees from C4C REST API")
-
-                # lastly, check if there are still leads with status as "processing" and unable to be sent
-                # they should be marked as "pending" to be processed again later
-                # and commit this separately from other sql session
-                with start_psql_session() as session:
-                    data_to_try_again = get_data_to_try_again(session_=session)
-                    if data_to_try_again:
-                        formatted_data_to_try_again = c4c_client.pre_process_data_for_post(data=data_to_try_again)
-                        upsert_lead(session_=session, data=formatted_data_to_try_again, outbound=True)
-            else:
-                logger.debug("No C4C Token to import data")
-    else:
-        logger.debug("No Lead with 'pending' status to import")
+        if claimed_count:
+            with start_psql_session() as session:
+                # upsert marketing permissions, employees and business partners
+                # resulted from new leads since their watermarks, or in past 5 minutes if there is none yet
+                past_time = datetime.utcnow() - timedelta(minutes=5)
+                date_from = str(past_time.date()) + "T" + str(past_time.time()) + "Z"
+                # leads, with their own watermark because they are not upserted here
+                # and must still be picked up by db_loader_lead
+                leads = c4c_client.get_data(session_=requests_session, type="lead",
+                                            date_from=get_watermark(session_=session, entity="import_c4c_lead") or date_from)
+                # marketing permissions
+                mark_ps = c4c_client.get_data(session_=requests_session, type="mp", leads_to_get_mps=leads)
+                upsert_mark_p(session_=session, data=mark_ps)
+                advance_watermark(session_=session, entity="import_c4c_lead", data=leads)
+                # employees
+                emps = c4c_client.get_data(session_=requests_session, type="emp",
+                                           date_from=get_watermark(session_=session, entity="emp") or date_from)
+                upsert_emp(session_=session, data=emps, type="Employee")
+                advance_watermark(session_=session, entity="emp", data=emps)
+                # business partners
+                bps = c4c_client.get_data(session_=requests_session, type="bp", leads_to_get_bps=leads,
+                                          existing_emps=get_data_for_eloqua_import(session_=session, type="emp"))
+                upsert_emp(session_=session, data=bps, type="Business Partner")
+                # update all new employees and business partners to an option list in Eloqua
+                all_emps_and_bps = get_data_for_eloqua_import(session_=session, type="emp")
+                elq_client.import_option_list(data=prepare_data_elq_import(type="emp", data=all_emps_and_bps),
+                                              name="Ruukki Employees from C4C REST API")
+        else:
+            logger.debug("No Lead with 'pending' status to import")
@@ -16,3 +16,10 @@ DB_USER = env("DB_USER")
 DB_PASSWORD = env("DB_PASSWORD")
 DB_HOST_NAME = env("DB_HOST_NAME")
 DB_URI = "postgresql+psycopg2://" + DB_USER + ":" + DB_PASSWORD + "@" + DB_HOST_NAME + "/" + DB_NAME
+# rows written per INSERT ... ON CONFLICT statement by the upserts
+DB_UPSERT_BATCH_SIZE = env.int("DB_UPSERT_BATCH_SIZE", 1000)
+# entities upserted with COPY into a staging table instead, comma-separated, of: contact, account, lead, tg, tgm, mp, emp
+DB_COPY_ENTITIES = env.list("DB_COPY_ENTITIES", [])
+
+# leads posted to C4C at the same time, 1 keeps the sequential client
+C4C_MAX_IN_FLIGHT = env.int("C4C_MAX_IN_FLIGHT", 1)
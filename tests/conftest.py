@@ -0,0 +1,15 @@
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# settings reads these at import, none of them is used to connect anywhere by the tests
+for name in ("ELQ_USER", "ELQ_PASSWORD", "ELQ_BASE_URL", "C4C_USER", "C4C_PASSWORD", "C4C_BASE_URL",
+             "DB_NAME", "DB_USER", "DB_PASSWORD", "DB_HOST_NAME"):
+    os.environ.setdefault(name, "test")
+
+# logging.json and its logs directory are looked up in the working directory, as when the scripts are run
+os.chdir(root)
+os.makedirs("logs", exist_ok=True)
+if root not in sys.path:
+    sys.path.insert(0, root)
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import uuid
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from benchmark.fake_server import FakeServer, new_guid
+from c4c.c4c_async_client import AsyncC4CClient
+from c4c.c4c_client import C4CClient
+
+
+@pytest.fixture
+def server():
+    server = FakeServer(("127.0.0.1", 0), size=50, seed=1, latency=0.01)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def update_lead(server, table_id, contact_uuid, uri=None):
+    '''
+    Add a lead to the fake server and return it as formatted by pre_process_data_for_post, to be Patched
+    '''
+    entity = server.c4c.add(collection="LeadCollection", entity={"ID": str(1000 + table_id), "Name": "lead",
+                                                                 "ContactUUID": contact_uuid, "OwnerPartyUUID": None})
+    return {"TableID": table_id, "ID": entity["ID"], "ContactUUID": contact_uuid, "C4C_Task_Name": "update_leads",
+            "URI": uri or server.c4c_base_url + "LeadCollection('{0}')".format(entity["ObjectID"]),
+            "GroupCode": "Z101", "Email": "{0}@example.com".format(table_id), "B2C_MP_Consent": "1",
+            "Name": "lead {0}".format(table_id), "C4C_Status": "pending", "OwnerPartyUUID": new_guid()}
+
+
+def post_lead_data(server, data, batch_size=None):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+
+    async def run():
+        async with client.start_requests_session() as session:
+            return await client.post_lead_data(session_=session, data=data, batch_size=batch_size)
+
+    return asyncio.run(run())
+
+
+def test_leads_of_one_contact_create_one_marketing_permission(server):
+    contact_uuid = new_guid()
+    data = [update_lead(server=server, table_id=table_id, contact_uuid=contact_uuid) for table_id in range(4)]
+    post_lead_data(server=server, data=data)
+    mark_ps = [mark_p for mark_p in server.c4c.collections["MarketingPermissionCollection"].values()
+               if mark_p.get("BusinessPartnerUUID", None) == contact_uuid]
+    assert len(mark_ps) == 1
+    assert [entry["C4C_Status"] for entry in data] == ["updated"] * 4
+    assert all(entry.get("C4C_Consent_Hash", None) for entry in data)
+
+
+def test_connection_error_leaves_lead_pending(server):
+    data = [update_lead(server=server, table_id=table_id, contact_uuid=new_guid()) for table_id in range(3)]
+    # nothing listens on port 9 of localhost
+    data.append(update_lead(server=server, table_id=3, contact_uuid=new_guid(),
+                            uri="http://127.0.0.1:9/LeadCollection('{0}')".format(uuid.uuid4().hex)))
+    result = post_lead_data(server=server, data=data)
+    assert result is data
+    assert [entry["C4C_Status"] for entry in data] == ["updated", "updated", "updated", "pending"]
+
+
+def test_leads_are_posted_in_batches(server):
+    data = [update_lead(server=server, table_id=table_id, contact_uuid=new_guid()) for table_id in range(6)]
+    server.reset_stats()
+    post_lead_data(server=server, data=data, batch_size=3)
+    assert [entry["C4C_Status"] for entry in data] == ["updated"] * 6
+    stats = server.get_stats()
+    assert stats["requests"]["C4C POST $batch"] == 2
+    assert stats["batch_operations"] == {"PATCH LeadCollection": 6}
+    assert "C4C PATCH LeadCollection" not in stats["requests"]
+
+
+def test_session_sends_basic_authorization(server):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+
+    async def get_headers():
+        async with client.start_requests_session() as session:
+            return session.headers
+
+    assert asyncio.run(get_headers())["Authorization"] == "Basic dXNlcjpwYXNzd29yZA=="
+
+
+def test_blocking_session_is_kept_over_batches(server):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+    with client.start_blocking_session() as session:
+        for batch in range(3):
+            data = [update_lead(server=server, table_id=batch * 10 + i, contact_uuid=new_guid()) for i in range(3)]
+            client.run_post_lead_data(session_=session, data=data)
+            assert [entry["C4C_Status"] for entry in data] == ["updated"] * 3
+    # one CSRF token for all batches
+    assert server.get_stats()["requests"]["C4C GET /"] == 1
+    assert server.get_stats()["max_in_flight"] <= 4
+
+
+def test_token_is_shared_with_sync_client(server):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+    sync_client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    client.share_token(client=sync_client)
+    with client.start_blocking_session() as session, sync_client.start_requests_session() as requests_session:
+        # no token before the first write
+        assert "C4C GET /" not in server.get_stats()["requests"]
+        data = [update_lead(server=server, table_id=i, contact_uuid=new_guid()) for i in range(2)]
+        client.run_post_lead_data(session_=session, data=data[:1])
+        sync_client.post_lead_data(session_=requests_session, data=data[1:])
+        assert sync_client.csrf_token == client.csrf_token
+    assert [entry["C4C_Status"] for entry in data] == ["updated"] * 2
+    assert server.get_stats()["requests"]["C4C GET /"] == 1
+
+
+def test_pages_are_the_same_as_sync_client(server):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+    sync_client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+
+    async def get_pages():
+        async with client.start_requests_session() as session:
+            return [page async for page in client.get_data_pages(session_=session, type="contact", page_size=20,
+                                                                 date_from="2000-01-01T00:00:00Z")]
+
+    pages = asyncio.run(get_pages())
+    with sync_client.start_requests_session() as requests_session:
+        sync_pages = list(sync_client.get_data_pages(session_=requests_session, type="contact", page_size=20,
+                                                     date_from="2000-01-01T00:00:00Z"))
+    # pages of the async client are the responses, less entries already received by the previous one
+    entries = [entry for page in pages for entry in page]
+    assert entries == [entry for page in sync_pages for entry in page]
+    assert len(entries) == len(set(entry["__metadata"]["uri"] for entry in entries))
+    assert len(entries) == client.expected_counts["contact"] > 20
+
+
+def test_error_page_fails_instead_of_ending_collection(server):
+    client = AsyncC4CClient(username="user", password="password", base_url=server.c4c_base_url, max_in_flight=4)
+
+    # navigation of a lead that does not exist
+    uri = server.c4c_base_url + "LeadCollection('none')/LeadNotes"
+
+    async def get_pages():
+        async with client.start_requests_session() as session:
+            return [page async for page in client.get_pages(session_=session, uri=uri, params={"$format": "json"})]
+
+    with pytest.raises(aiohttp.ClientPayloadError):
+        asyncio.run(get_pages())
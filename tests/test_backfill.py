@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import backfill
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class FakeRetriever:
+    '''
+    C4CClient that returns one page with one entry per shard and records the queries it was given
+    '''
+    def __init__(self):
+        self.queries = []
+
+    @contextmanager
+    def start_requests_session(self):
+        yield None
+
+    @contextmanager
+    def fetch_data_pages(self, queries, max_workers=None):
+        self.queries.append(dict(queries))
+        yield {name: iter([[{"ObjectID": str(name)}]]) for name in queries}
+
+
+@pytest.fixture
+def completed_shards(monkeypatch):
+    '''
+    backfill_shard table kept in a dict of entity: {DateFrom: DateTo}
+    '''
+    shards = dict()
+
+    @contextmanager
+    def start_psql_session():
+        yield None
+
+    def complete_shard(session_, entity, date_from, date_to, entry_count):
+        shards.setdefault(entity, dict())[date_from] = date_to
+
+    monkeypatch.setattr(backfill, "start_psql_session", start_psql_session)
+    monkeypatch.setattr(backfill, "get_completed_shards",
+                        lambda session_, entity: dict(shards.get(entity, dict())))
+    monkeypatch.setattr(backfill, "complete_shard", complete_shard)
+    monkeypatch.setattr(backfill, "upsert_backfill_page", lambda **kwargs: None)
+    return shards
+
+
+def test_get_shards_are_aligned_to_epoch():
+    shards = backfill.get_shards(date_from=utc(2020, 1, 15), date_to=utc(2020, 3, 10), shard_days=30)
+    assert shards == [(utc(2020, 1, 15), utc(2020, 1, 31)),
+                      (utc(2020, 1, 31), utc(2020, 3, 1)),
+                      (utc(2020, 3, 1), utc(2020, 3, 10))]
+
+
+def test_get_shards_keep_boundaries_for_later_date_from():
+    shards = backfill.get_shards(date_from=utc(2020, 1, 1), date_to=utc(2020, 3, 10), shard_days=30)
+    later_shards = backfill.get_shards(date_from=utc(2020, 2, 10), date_to=utc(2020, 3, 10), shard_days=30)
+    assert later_shards[1:] == shards[2:]
+
+
+def test_get_shards_end_at_now_if_not_given():
+    date_from = datetime.now(timezone.utc) - timedelta(days=1)
+    shards = backfill.get_shards(date_from=date_from, shard_days=30)
+    assert shards[-1][1] is not None
+    assert shards[-1][1] <= datetime.now(timezone.utc)
+
+
+def test_get_shards_empty_range():
+    assert backfill.get_shards(date_from=utc(2020, 3, 10), date_to=utc(2020, 3, 10)) == []
+
+
+def test_get_covered_until_follows_contiguous_shards():
+    completed = {utc(2020, 1, 1): utc(2020, 1, 31), utc(2020, 1, 31): utc(2020, 2, 15)}
+    assert backfill.get_covered_until(completed_shards=completed, shard_from=utc(2020, 1, 1)) == utc(2020, 2, 15)
+    assert backfill.get_covered_until(completed_shards=completed, shard_from=utc(2020, 1, 20)) == utc(2020, 2, 15)
+
+
+def test_get_covered_until_stops_at_gap():
+    completed = {utc(2020, 1, 1): utc(2020, 1, 10), utc(2020, 1, 20): utc(2020, 1, 31)}
+    assert backfill.get_covered_until(completed_shards=completed, shard_from=utc(2020, 1, 1)) == utc(2020, 1, 10)
+
+
+def test_backfill_records_end_of_last_shard(completed_shards):
+    backfill.backfill(retriever=FakeRetriever(), entities={"contact": "2020-01-01T00:00:00Z"},
+                      date_to="2020-02-10T00:00:00Z", shard_days=30)
+    assert completed_shards["contact"] == {utc(2020, 1, 1): utc(2020, 1, 31), utc(2020, 1, 31): utc(2020, 2, 10)}
+
+
+def test_backfill_resumes_after_covered_part(completed_shards):
+    completed_shards["contact"] = {utc(2020, 1, 1): utc(2020, 1, 31), utc(2020, 1, 31): utc(2020, 2, 10)}
+    retriever = FakeRetriever()
+    counts = backfill.backfill(retriever=retriever, entities={"contact": "2020-01-01T00:00:00Z"},
+                               date_to="2020-03-10T00:00:00Z", shard_days=30)
+    # the first shard is skipped, the second is only fetched after the end of the last run
+    assert list(retriever.queries[0]) == [("contact", utc(2020, 2, 10), utc(2020, 3, 1)),
+                                          ("contact", utc(2020, 3, 1), utc(2020, 3, 10))]
+    assert retriever.queries[0][("contact", utc(2020, 2, 10), utc(2020, 3, 1))] == \
+        {"type": "contact", "date_from": "2020-02-10T00:00:00Z", "date_to": "2020-03-01T00:00:00Z"}
+    assert counts == {"contact": 2}
+
+
+def test_backfill_completed_range_is_not_fetched_again(completed_shards):
+    completed_shards["contact"] = {utc(2020, 1, 1): utc(2020, 1, 31), utc(2020, 1, 31): utc(2020, 2, 10)}
+    retriever = FakeRetriever()
+    counts = backfill.backfill(retriever=retriever, entities={"contact": "2020-01-01T00:00:00Z"},
+                               date_to="2020-02-10T00:00:00Z", shard_days=30)
+    assert retriever.queries == [{}]
+    assert counts == {"contact": 0}
+
@@ -0,0 +1,49 @@
+from c4c.c4c_batch import parse_batch_response
+
+content_type = "multipart/mixed; boundary=batchresponse_1"
+
+
+def operation(status_line, body=b"", content_id=None):
+    return (b"Content-Type: application/http\r\n"
+            b"Content-Transfer-Encoding: binary\r\n" +
+            (b"Content-ID: " + content_id.encode() + b"\r\n" if content_id is not None else b"") +
+            b"\r\n" + status_line.encode() + b"\r\n"
+            b"Content-Type: application/json\r\n"
+            b"\r\n" + body + b"\r\n")
+
+
+def changeset(boundary, *operations):
+    return (b"Content-Type: multipart/mixed; boundary=" + boundary.encode() + b"\r\n\r\n" +
+            b"".join(b"--" + boundary.encode() + b"\r\n" + op for op in operations) +
+            b"--" + boundary.encode() + b"--\r\n")
+
+
+def batch(*parts):
+    return b"".join(b"--batchresponse_1\r\n" + part for part in parts) + b"--batchresponse_1--\r\n"
+
+
+def test_changesets_are_flattened():
+    content = batch(changeset("changesetresponse_1", operation("HTTP/1.1 201 Created", b'{"d": {"ID": "1"}}', "0")),
+                    changeset("changesetresponse_2", operation("HTTP/1.1 204 No Content", content_id="1")))
+    parts = parse_batch_response(content=content, content_type=content_type)
+    assert [part.status_code for part in parts] == [201, 204]
+    assert parts[0].json() == {"d": {"ID": "1"}}
+    assert parts[0].headers["Content-Type"] == "application/json"
+
+
+def test_error_part():
+    content = batch(operation("HTTP/1.1 400 Bad Request", b'{"error": {"code": "X"}}', "0"))
+    parts = parse_batch_response(content=content, content_type=content_type)
+    assert [part.status_code for part in parts] == [400]
+    assert parts[0].json()["error"]["code"] == "X"
+
+
+def test_content_id_is_kept_when_order_differs():
+    content = batch(changeset("changesetresponse_1", operation("HTTP/1.1 204 No Content", content_id="1")),
+                    changeset("changesetresponse_2", operation("HTTP/1.1 201 Created", b"{}", "0")))
+    parts = parse_batch_response(content=content, content_type=content_type)
+    assert [(part.content_id, part.status_code) for part in parts] == [("1", 204), ("0", 201)]
+
+
+def test_no_boundary():
+    assert parse_batch_response(content=b"error", content_type="text/plain") == []
@@ -0,0 +1,551 @@
+import itertools
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from benchmark.fake_server import FakeServer, new_guid, to_ms
+from c4c import c4c_config
+from c4c.c4c_batch import BatchPartResponse
+from c4c.c4c_client import C4CClient
+from tests.test_c4c_batch import batch, changeset, operation
+
+base_url = "http://localhost/sap/c4c/odata/v1/c4codataapi/"
+
+
+class NoRequestSession:
+    '''
+    requests session that fails the test on any request
+    '''
+    def request(self, method, url, **kwargs):
+        pytest.fail("Unexpected {0} {1}".format(method, url))
+
+    def get(self, url, **kwargs):
+        self.request(method="GET", url=url)
+
+
+class BatchSession:
+    '''
+    requests session that answers $batch requests with the given response and other writes with 204
+    '''
+    def __init__(self, batch_response):
+        self.batch_response = batch_response
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url[len(base_url):]))
+        if url == base_url:
+            return BatchPartResponse(status_code=200, headers=CaseInsensitiveDict({"x-csrf-token": "token"}), content=b"")
+        if url.endswith("$batch"):
+            return self.batch_response
+        return BatchPartResponse(status_code=204, headers=CaseInsensitiveDict(), content=b"")
+
+
+class FailingSession:
+    '''
+    requests session that sends the first requests through the given session and fails the others
+    '''
+    def __init__(self, session, requests_to_send):
+        self.session = session
+        self.requests_to_send = requests_to_send
+
+    def request(self, method, url, **kwargs):
+        if self.requests_to_send <= 0:
+            raise requests.ConnectionError("Connection reset")
+        self.requests_to_send -= 1
+        return self.session.request(method=method, url=url, **kwargs)
+
+
+class RejectingSession:
+    '''
+    requests session that issues a new CSRF token on every fetch and rejects the token of every write
+    '''
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url[len(base_url):]))
+        if method == "GET":
+            return BatchPartResponse(status_code=200, content=b"",
+                                     headers=CaseInsensitiveDict({"x-csrf-token": "token {0}".format(len(self.requests))}))
+        return BatchPartResponse(status_code=403, headers=CaseInsensitiveDict({"x-csrf-token": "Required"}),
+                                 content=b"CSRF token validation failed")
+
+
+class NoLocationSession:
+    '''
+    requests session that sends requests through the given session, and answers Posts of leads with 201
+    without body nor Location, and lookups of leads with no results if hide_leads
+    '''
+    def __init__(self, session, hide_leads=False):
+        self.session = session
+        self.hide_leads = hide_leads
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method=method, url=url, **kwargs)
+        if url.endswith("LeadCollection") and method == "POST" and response.status_code == 201:
+            return BatchPartResponse(status_code=201, headers=CaseInsensitiveDict(), content=b"")
+        if url.endswith("LeadCollection") and method == "GET" and self.hide_leads:
+            return BatchPartResponse(status_code=200, headers=CaseInsensitiveDict({"Content-Type": "application/json"}),
+                                     content=json.dumps({"d": {"results": []}}).encode())
+        return response
+
+
+@pytest.fixture
+def client():
+    return C4CClient(username="user", password="password", base_url=base_url)
+
+
+def update_lead(**fields):
+    entry = {"TableID": 1, "ID": "1001", "ContactUUID": "00163E00-0000-0000-0000-000000000001",
+             "URI": base_url + "LeadCollection('1')", "C4C_Task_Name": "update_leads", "GroupCode": "Z101",
+             "Email": "lead@example.com", "B2C_MP_Consent": "1", "Name": "lead", "C4C_Status": "pending",
+             "OwnerPartyUUID": None}
+    entry.update(fields)
+    return entry
+
+
+def pushed(client, entry):
+    # the lead as read back from DB after a successful push
+    lead = client.prepare_lead_for_post(entry=entry)
+    return dict(entry, C4C_Payload_Hash=lead["payload_hash"], C4C_Consent_Hash=lead["consent_hash"],
+                C4C_Last_Payload=lead["payload"])
+
+
+def test_payload_hash_leaves_out_server_assigned_fields(client):
+    lead = client.prepare_lead_for_post(entry=update_lead())
+    assigned_lead = client.prepare_lead_for_post(entry=update_lead(OwnerPartyUUID="00163E00-0000-0000-0000-0000000000AA"))
+    assert lead["payload_hash"] == assigned_lead["payload_hash"]
+    assert "OwnerPartyUUID" not in json.loads(lead["payload"])
+
+
+def test_payload_hash_changes_with_lead(client):
+    lead = client.prepare_lead_for_post(entry=update_lead())
+    changed_lead = client.prepare_lead_for_post(entry=update_lead(Name="renamed lead"))
+    assert lead["payload_hash"] != changed_lead["payload_hash"]
+
+
+def test_unchanged_lead_after_owner_assigned_is_not_sent(client):
+    entry = pushed(client=client, entry=update_lead())
+    entry["OwnerPartyUUID"] = "00163E00-0000-0000-0000-0000000000AA"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert not lead["payload_changed"]
+    assert not lead["consent_changed"]
+
+
+def test_unchanged_lead_without_owner_makes_no_request(client):
+    entry = pushed(client=client, entry=update_lead())
+    client.post_lead_data(session_=NoRequestSession(), data=[entry])
+    assert entry["C4C_Status"] == "updated"
+    assert entry["OwnerPartyUUID"] is None
+
+
+def test_changed_lead_patches_changed_fields_only(client):
+    entry = pushed(client=client, entry=update_lead())
+    entry["Name"] = "renamed lead"
+    entry["OwnerPartyUUID"] = "00163E00-0000-0000-0000-0000000000AA"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert lead["payload_changed"]
+    assert json.loads(lead["body"]) == {"Name": "renamed lead"}
+
+
+def test_shortened_company_clears_company_second_name(client):
+    entry = pushed(client=client, entry=update_lead(Company="C" * 50))
+    assert "CompanySecondName" in json.loads(entry["C4C_Last_Payload"])
+    entry["Company"] = "Short"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert json.loads(lead["body"]) == {"Company": "Short", "CompanySecondName": None}
+
+
+def test_group_code_switch_clears_email_field_of_other_group(client):
+    entry = pushed(client=client, entry=update_lead(B2B_MP_Consent="0"))
+    entry["GroupCode"] = "Z103"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert json.loads(lead["body"]) == {"GroupCode": "Z103", "ContactEMail": "lead@example.com",
+                                        "ZConsumerEMail_KUT": None}
+    assert lead["consent_changed"]
+    entry["GroupCode"] = "Z999"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert json.loads(lead["body"]) == {"GroupCode": "Z999", "ZConsumerEMail_KUT": None}
+
+
+def test_payload_same_as_last_push_is_not_sent(client):
+    entry = pushed(client=client, entry=update_lead())
+    entry["C4C_Payload_Hash"] = "outdated"
+    lead = client.prepare_lead_for_post(entry=entry)
+    assert not lead["payload_changed"]
+
+
+def changed_leads(client, count):
+    # leads with owner and consent unchanged, so that only the Patch is sent for each
+    data = []
+    for i in range(count):
+        entry = pushed(client=client, entry=update_lead(TableID=i, URI=base_url + "LeadCollection('{0}')".format(i),
+                                                        OwnerPartyUUID="00163E00-0000-0000-0000-0000000000AA"))
+        entry["Name"] = "renamed lead {0}".format(i)
+        data.append(entry)
+    return data
+
+
+def test_batch_sends_again_only_failed_parts(client):
+    # parts in another order than the leads, the part of the last lead is missing
+    content = batch(changeset("changesetresponse_1", operation("HTTP/1.1 204 No Content", content_id="1")),
+                    changeset("changesetresponse_2", operation("HTTP/1.1 400 Bad Request", b"{}", "0")))
+    session = BatchSession(batch_response=BatchPartResponse(
+        status_code=202, headers=CaseInsensitiveDict({"Content-Type": "multipart/mixed; boundary=batchresponse_1"}),
+        content=content))
+    data = changed_leads(client=client, count=3)
+    client.post_lead_data(session_=session, data=data, batch_size=3)
+    assert session.requests == [("GET", ""), ("POST", "$batch"), ("PATCH", "LeadCollection('0')")]
+    # not known whether the last lead was applied, it is left for the next try
+    assert [entry["C4C_Status"] for entry in data] == ["updated", "updated", "pending"]
+
+
+def test_rejected_batch_sends_each_lead_alone(client):
+    session = BatchSession(batch_response=BatchPartResponse(
+        status_code=400, headers=CaseInsensitiveDict({"Content-Type": "text/plain"}), content=b"Malformed"))
+    data = changed_leads(client=client, count=2)
+    client.post_lead_data(session_=session, data=data, batch_size=2)
+    assert session.requests[2:] == [("PATCH", "LeadCollection('0')"), ("PATCH", "LeadCollection('1')")]
+    assert [entry["C4C_Status"] for entry in data] == ["updated", "updated"]
+
+
+def new_leads(count):
+    return [update_lead(TableID=i, ID=None, ContactUUID=None, URI=None, C4C_Task_Name="create_leads",
+                        Name="lead {0}".format(i), Company="company {0}".format(i)) for i in range(count)]
+
+
+def test_failed_batch_leaves_new_leads_unknown(client):
+    session = BatchSession(batch_response=BatchPartResponse(
+        status_code=500, headers=CaseInsensitiveDict({"Content-Type": "text/plain"}), content=b"Internal error"))
+    data = new_leads(count=2)
+    client.post_lead_data(session_=session, data=data, batch_size=2)
+    assert session.requests == [("GET", ""), ("POST", "$batch")]
+    assert [entry["C4C_Status"] for entry in data] == ["unknown", "unknown"]
+    # the second try of import_c4c only sends pending leads
+    assert [entry for entry in data if entry["C4C_Status"] == "pending"] == []
+
+
+def test_unknown_leads_are_looked_up_instead_of_posted_again(server):
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    data = new_leads(count=2)
+    for entry in data:
+        entry["C4C_Status"] = "unknown"
+    created = server.c4c.add(collection="LeadCollection", entity={"ID": "2001", "Name": "lead 0", "Company": "company 0",
+                                                                  "ZConsumerEMail_KUT": "lead@example.com",
+                                                                  "ContactUUID": new_guid(), "OwnerPartyUUID": None})
+    with client.start_requests_session() as session:
+        client.resolve_unknown_leads(session_=session, data=data)
+    assert server.get_stats()["requests"] == {"C4C GET LeadCollection": 2}
+    # the created lead is Patched by the next run, the other one is Posted again
+    assert (data[0]["ID"], data[0]["ContactUUID"], data[0]["C4C_Task_Name"], data[0]["C4C_Status"]) == \
+           ("2001", created["ContactUUID"], "update_leads", "pending")
+    assert data[0]["URI"].endswith("LeadCollection('{0}')".format(created["ObjectID"]))
+    assert client.prepare_lead_for_post(entry=data[0])["method"] == "PATCH"
+    assert (data[1]["ID"], data[1]["C4C_Task_Name"], data[1]["C4C_Status"]) == (None, "create_leads", "pending")
+
+
+def post_without_location(server, hide_leads=False):
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    problems = []
+    client.log_post_lead_data = lambda counts, tableid_to_inspect_more: problems.append(tableid_to_inspect_more)
+    # TableID 1
+    data = new_leads(count=2)[1:]
+    with client.start_requests_session() as session:
+        client.post_lead_data(session_=NoLocationSession(session=session, hide_leads=hide_leads), data=data)
+    assert problems[0]["no_body_nor_location_for_new_lead"] == [1]
+    return data[0]
+
+
+def test_created_lead_without_body_nor_location_is_looked_up(server):
+    entry = post_without_location(server=server)
+    created = [lead for lead in server.c4c.collections["LeadCollection"].values() if lead.get("Name", None) == "lead 1"]
+    assert len(created) == 1
+    assert entry["C4C_Status"] == "created"
+    assert entry["ID"] == created[0]["ID"]
+    assert entry["URI"] == "{0}LeadCollection('{1}')".format(server.c4c_base_url, created[0]["ObjectID"])
+    assert entry["ContactUUID"] == created[0]["ContactUUID"]
+
+
+def test_created_lead_not_found_is_left_unknown(server):
+    entry = post_without_location(server=server, hide_leads=True)
+    # looked up again by the next run instead of being Posted again
+    assert entry["C4C_Status"] == "unknown"
+    assert entry["ID"] is None and entry["URI"] is None
+    assert not entry.get("C4C_Payload_Hash", None)
+
+
+def test_failed_batch_does_not_send_leads_again(client):
+    session = BatchSession(batch_response=BatchPartResponse(
+        status_code=500, headers=CaseInsensitiveDict({"Content-Type": "text/plain"}), content=b"Internal error"))
+    data = changed_leads(client=client, count=2)
+    client.post_lead_data(session_=session, data=data, batch_size=2)
+    assert session.requests == [("GET", ""), ("POST", "$batch")]
+    assert [entry["C4C_Status"] for entry in data] == ["pending", "pending"]
+
+
+@pytest.fixture
+def server():
+    server = FakeServer(("127.0.0.1", 0), size=50, seed=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def throttling_server():
+    # throttles every request, with a Retry-After that does not pause the test
+    server = FakeServer(("127.0.0.1", 0), size=1, throttle_rate=1.0, retry_after=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_throttled_read_is_retried_by_limiter_only(throttling_server):
+    client = C4CClient(username="user", password="password", base_url=throttling_server.c4c_base_url)
+    with client.start_requests_session() as session:
+        response = client.send_limited(session_=session, method="GET", url=client.contact_uri)
+    assert response.status_code == 429
+    # not retried by the session before the limiter sees the response
+    assert throttling_server.get_stats()["throttled"] == c4c_config.max_throttle_retries + 1
+    assert client.limiter.metrics()["throttled"] == c4c_config.max_throttle_retries + 1
+    assert client.limiter.current_limit < c4c_config.max_in_flight
+    assert client.limiter.in_flight == 0
+
+
+def test_collections_not_started_are_not_fetched_after_caller_leaves(server):
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    queries = {"contact": {"type": "contact", "date_from": "2000-01-01T00:00:00Z", "page_size": 10},
+               "account": {"type": "account", "date_from": "2000-01-01T00:00:00Z", "page_size": 10}}
+    with pytest.raises(RuntimeError):
+        with client.fetch_data_pages(queries=queries, max_workers=1, queue_pages=1) as pages:
+            next(pages["contact"])
+            raise RuntimeError("DB error")
+    requests = server.get_stats()["requests"]
+    assert requests.get("C4C GET ContactCollection", 0) >= 1
+    assert "C4C GET CorporateAccountCollection" not in requests
+
+
+def post_after_token_expired(server, batch_size=None):
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    data = new_leads(count=2)
+    with client.start_requests_session() as session:
+        client.post_lead_data(session_=session, data=data[:1], batch_size=batch_size)
+        # C4C no longer accepts the token of the session
+        server.c4c.csrf_tokens.clear()
+        server.reset_stats()
+        client.post_lead_data(session_=session, data=data[1:], batch_size=batch_size)
+    assert [entry["C4C_Status"] for entry in data] == ["created", "created"]
+    return server.get_stats()
+
+
+def test_rejected_csrf_token_is_fetched_again(server):
+    requests = post_after_token_expired(server=server)["requests"]
+    # the rejected Post is sent again with the new token
+    assert requests["C4C GET /"] == 1
+    assert requests["C4C POST LeadCollection"] == 2
+
+
+def test_rejected_csrf_token_of_batch_is_fetched_again(server):
+    stats = post_after_token_expired(server=server, batch_size=1)
+    assert stats["requests"]["C4C GET /"] == 1
+    assert stats["requests"]["C4C POST $batch"] == 2
+    # the operations of the rejected $batch were not applied
+    assert stats["batch_operations"] == {"POST LeadCollection": 1}
+
+
+def test_csrf_token_rejected_again_is_not_retried(client):
+    session = RejectingSession()
+    data = new_leads(count=1)
+    client.post_lead_data(session_=session, data=data)
+    assert session.requests == [("GET", ""), ("POST", "LeadCollection"), ("GET", ""), ("POST", "LeadCollection")]
+    assert data[0]["C4C_Status"] == "pending"
+
+
+def test_failed_mark_p_lookup_is_looked_up_again(server):
+    contact_uuids = [new_guid(), new_guid()]
+    for contact_uuid in contact_uuids:
+        server.c4c.add(collection="MarketingPermissionCollection", entity={"BusinessPartnerUUID": contact_uuid})
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    with client.start_requests_session() as session:
+        # the chunk of the first contact is received, the one of the second fails
+        with pytest.raises(requests.ConnectionError):
+            client.get_mark_ps(session_=FailingSession(session=session, requests_to_send=1),
+                               contact_uuids=contact_uuids, chunk_size=1)
+        assert client.get_cached(entity="mp", key=contact_uuids[0])[1]
+        assert not client.get_cached(entity="mp", key=contact_uuids[1])[0]
+        server.reset_stats()
+        mark_ps = client.get_mark_ps(session_=session, contact_uuids=contact_uuids, chunk_size=1)
+    assert sorted(mark_ps) == sorted(contact_uuids)
+    assert server.get_stats()["requests"] == {"C4C GET MarketingPermissionCollection": 1}
+
+
+def add_mark_p(server, contact_uuid, consent=None):
+    mark_p = server.c4c.add(collection="MarketingPermissionCollection",
+                            entity={"BusinessPartnerUUID": contact_uuid, "BusinessPartner_ID": "4000001"})
+    if consent:
+        server.c4c.add(collection="MarketingPermissionChannelPermissionCollection",
+                       entity={"Channel": "Z03", "Consent": consent}, parent=mark_p["ObjectID"])
+    return mark_p
+
+
+def get_mark_ps_of_new_contacts(server, contact_count):
+    contact_uuids = [new_guid() for _ in range(contact_count)]
+    for contact_uuid in contact_uuids:
+        add_mark_p(server=server, contact_uuid=contact_uuid)
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    server.reset_stats()
+    with client.start_requests_session() as session:
+        mark_ps = client.get_mark_ps(session_=session, contact_uuids=contact_uuids)
+    assert sorted(mark_ps) == sorted(contact_uuids)
+    return server.get_stats()["requests"]
+
+
+def test_mark_ps_of_a_full_chunk_are_got_in_one_request(server):
+    requests = get_mark_ps_of_new_contacts(server=server, contact_count=c4c_config.filter_chunk_size)
+    assert requests == {"C4C GET MarketingPermissionCollection": 1}
+
+
+def test_mark_ps_of_one_more_contact_than_a_chunk_are_got_in_two_requests(server):
+    requests = get_mark_ps_of_new_contacts(server=server, contact_count=c4c_config.filter_chunk_size + 1)
+    assert requests == {"C4C GET MarketingPermissionCollection": 2}
+
+
+def test_mark_ps_are_read_with_their_z03_channel_permission(server):
+    with_z03 = add_mark_p(server=server, contact_uuid=new_guid(), consent="1")
+    without_z03 = add_mark_p(server=server, contact_uuid=new_guid())
+    z03_object_id = server.c4c.children[("MarketingPermissionChannelPermissionCollection", with_z03["ObjectID"])][0]
+    # ContactUUIDs as given by leads, in lower case, one twice, and one without Marketing Permission
+    contact_uuids = [with_z03["BusinessPartnerUUID"].lower(), without_z03["BusinessPartnerUUID"], new_guid(),
+                     with_z03["BusinessPartnerUUID"].lower()]
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    server.reset_stats()
+    with client.start_requests_session() as session:
+        mark_ps = client.get_mark_ps(session_=session, contact_uuids=contact_uuids)
+    # by ContactUUID as given, only for those that have a Marketing Permission
+    assert mark_ps == {
+        contact_uuids[0]: {"BusinessPartnerUUID": with_z03["BusinessPartnerUUID"], "ObjectID": with_z03["ObjectID"],
+                           "BusinessPartner_ID": "4000001",
+                           "ChannelPermissionURI": server.c4c_base_url + "MarketingPermissionCollection('{0}')"
+                                                                         "/ChannelPermission".format(with_z03["ObjectID"]),
+                           "Z03URI": server.c4c_base_url + "MarketingPermissionChannelPermissionCollection('{0}')".format(
+                               z03_object_id),
+                           "Z03Consent": "1"},
+        contact_uuids[1]: {"BusinessPartnerUUID": without_z03["BusinessPartnerUUID"], "ObjectID": without_z03["ObjectID"],
+                           "BusinessPartner_ID": "4000001",
+                           "ChannelPermissionURI": server.c4c_base_url + "MarketingPermissionCollection('{0}')"
+                                                                         "/ChannelPermission".format(without_z03["ObjectID"]),
+                           "Z03URI": None,
+                           "Z03Consent": None}}
+    # Channel Permissions come expanded along with their Marketing Permissions
+    assert server.get_stats()["requests"] == {"C4C GET MarketingPermissionCollection": 1}
+
+
+def add_emp(server, org_unit_ids):
+    emp = server.c4c.add(collection="EmployeeCollection", entity={"UUID": new_guid(), "FirstName": "First", "LastName": "Last",
+                                                                  "Email": "emp@example.com", "CountryCode": "FI",
+                                                                  "BusinessPartnerID": "8000001"},
+                         changed_on=to_ms(datetime.now(timezone.utc)))
+    for org_unit_id in org_unit_ids:
+        server.c4c.add(collection="EmployeeOrganisationalUnitAssignmentCollection", entity={"OrgUnitID": org_unit_id},
+                       parent=emp["ObjectID"])
+    return emp
+
+
+def test_department_of_employees_comes_with_them(server):
+    emps = [add_emp(server=server, org_unit_ids=org_unit_ids) for org_unit_ids in ([], ["ORG1"], ["ORG1", "ORG2", "ORG3"])]
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    server.reset_stats()
+    date_from = (datetime.now(timezone.utc) - timedelta(minutes=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    with client.start_requests_session() as session:
+        data = {entry["UUID"]: entry for entry in client.get_data(session_=session, type="emp", date_from=date_from)}
+    # the last assignment is the Department, none without assignment
+    assert [data[emp["UUID"]].get("Department", None) for emp in emps] == [None, "ORG1", "ORG3"]
+    assert not any("EmployeeOrganisationalUnitAssignment" in entry for entry in data.values())
+    # assignments are expanded along with their employees
+    assert server.get_stats()["requests"] == {"C4C GET EmployeeCollection": 1}
+
+
+def test_deferred_department_is_followed(server):
+    emp = add_emp(server=server, org_unit_ids=["ORG1", "ORG2"])
+    uri = "{0}EmployeeCollection('{1}')/EmployeeOrganisationalUnitAssignment".format(server.c4c_base_url, emp["ObjectID"])
+    data = [{"UUID": emp["UUID"], "EmployeeOrganisationalUnitAssignment": {"__deferred": {"uri": uri}}},
+            {"UUID": new_guid(), "EmployeeOrganisationalUnitAssignment": {"results": []}}]
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    with client.start_requests_session() as session:
+        client.add_departments(session_=session, data=data)
+    assert data == [{"UUID": emp["UUID"], "Department": "ORG2"}, {"UUID": data[1]["UUID"]}]
+
+
+def add_bus_p(server, name, thing_type="COD_PARTNERCONTACT_TT"):
+    return server.c4c.add(collection="BusinessPartnerCollection", entity={"BusinessPartnerUUID": new_guid(), "Name": name,
+                                                                         "ThingType": thing_type})["BusinessPartnerUUID"]
+
+
+def test_lead_owners_are_resolved_to_new_partner_contacts(server):
+    partner_uuid = add_bus_p(server=server, name="Partner A")
+    known_name_uuid = add_bus_p(server=server, name="Known Name")
+    employee_uuid = add_bus_p(server=server, name="Employee B", thing_type="COD_EMPLOYEE_TT")
+    known_uuid = add_bus_p(server=server, name="Partner C")
+    missing_uuid = new_guid()
+    # owners as given by leads, in lower case, the first one twice
+    owner_uuids = [uuid_.lower() for uuid_ in (partner_uuid, partner_uuid, known_name_uuid, employee_uuid, known_uuid,
+                                               missing_uuid)]
+    leads = [{"OwnerPartyUUID": owner_uuid} for owner_uuid in owner_uuids] + [{"OwnerPartyUUID": None}]
+    existing_emps = [("Known Name", new_guid()), ("Partner C", owner_uuids[4])]
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    server.reset_stats()
+    with client.start_requests_session() as session:
+        bus_ps = client.get_data(session_=session, type="bp", leads_to_get_bps=leads, existing_emps=existing_emps)
+        # owners resolved or not found are not looked up again in the run
+        assert client.get_data(session_=session, type="bp", leads_to_get_bps=leads, existing_emps=existing_emps) == bus_ps
+        # the owner known as an employee is not looked up
+        assert not client.get_cached(entity="bp", key=known_uuid)[0]
+        assert client.get_cached(entity="bp", key=missing_uuid) == (True, None)
+    # one entry per owner, with the UUID of the lead and the Name of its partner contact
+    assert bus_ps == [{"UUID": owner_uuids[0], "Name": "Partner A"}]
+    # the other owners in one chunk
+    assert server.get_stats()["requests"] == {"C4C GET BusinessPartnerCollection": 1}
+
+
+def get_contacts(client, session, page_size):
+    uri, params = client.get_collection_query(type="contact", date_from="2000-01-01T00:00:00Z")
+    return client.get_entries(session_=session, uri=uri, params=params, page_size=page_size, type="contact")
+
+
+def contact_uris(server):
+    return set("{0}ContactCollection('{1}')".format(server.c4c_base_url, object_id)
+               for object_id in server.c4c.collections["ContactCollection"])
+
+
+def test_entry_changed_while_paging_does_not_hide_others(server):
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    with client.start_requests_session() as session:
+        entries = get_contacts(client=client, session=session, page_size=10)
+        received = list(itertools.islice(entries, 10))
+        # the changed contact moves to the end of the collection ordered by EntityLastChangedOn
+        changed_object_id = received[2]["__metadata"]["uri"].split("'")[1]
+        server.c4c.collections["ContactCollection"][changed_object_id]["_changed_on"] = to_ms(datetime.now(timezone.utc))
+        server.c4c.version += 1
+        received += list(entries)
+    uris = [entry["__metadata"]["uri"] for entry in received]
+    assert set(uris) == contact_uris(server=server)
+    # only the changed contact is received twice
+    assert len(uris) == len(set(uris)) + 1
+
+
+def test_entries_changed_at_the_same_time_are_received_once(server):
+    changed_on = to_ms(datetime.now(timezone.utc) - timedelta(days=1))
+    for entity in itertools.islice(server.c4c.collections["ContactCollection"].values(), 25):
+        entity["_changed_on"] = changed_on
+    server.c4c.version += 1
+    client = C4CClient(username="user", password="password", base_url=server.c4c_base_url)
+    with client.start_requests_session() as session:
+        uris = [entry["__metadata"]["uri"] for entry in get_contacts(client=client, session=session, page_size=10)]
+    assert len(uris) == len(set(uris))
+    assert set(uris) == contact_uris(server=server)
@@ -0,0 +1,260 @@
+import csv
+import io
+import os
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from db import db_crud
+from db.db_crud import CopyRows, upsert_rows, upsert_target_gr_m
+from db.tables_init import Contact, Lead, TargetGroupMember
+
+columns = ["C_SFDCContactID", "C_Company", "C_City"]
+
+# values that CSV must quote or escape, and that COPY would otherwise read differently
+tricky_values = ["", "plain", 'say "hi"', "two\nlines", "crlf\r\nline", "back\\slash", "\\N", "comma, inside", "ääkköset"]
+
+
+def copy_csv(rows, size=-1):
+    copy_rows = CopyRows(rows=rows, columns=columns)
+    if size < 0:
+        return copy_rows.read()
+    chunks = []
+    chunk = copy_rows.read(size)
+    while chunk:
+        chunks.append(chunk)
+        chunk = copy_rows.read(size)
+    return "".join(chunks)
+
+
+def test_null_is_unquoted_and_empty_string_is_quoted():
+    assert copy_csv([{"C_SFDCContactID": "1", "C_Company": None, "C_City": ""}]) == '"1",,""\n'
+
+
+def test_quotes_are_doubled():
+    assert CopyRows.format_value('say "hi"') == '"say ""hi"""'
+
+
+def test_newlines_and_backslashes_are_kept_as_is():
+    # CSV format has no backslash escapes, unlike the text format of COPY
+    assert CopyRows.format_value("two\nlines") == '"two\nlines"'
+    assert CopyRows.format_value("back\\slash") == '"back\\slash"'
+    assert CopyRows.format_value("\\N") == '"\\N"'
+
+
+def test_values_read_back_as_csv():
+    rows = [{"C_SFDCContactID": str(i), "C_Company": value, "C_City": None} for i, value in enumerate(tricky_values)]
+    read_rows = list(csv.reader(io.StringIO(copy_csv(rows), newline="")))
+    assert [row[1] for row in read_rows] == tricky_values
+
+
+def test_read_by_size_gives_the_same_csv():
+    rows = [{"C_SFDCContactID": str(i), "C_Company": value, "C_City": None} for i, value in enumerate(tricky_values)]
+    assert copy_csv(rows, size=7) == copy_csv(rows)
+
+
+@pytest.fixture
+def db_session():
+    '''
+    Session on the Postgres database of TEST_DB_URI, rolled back after the test
+    '''
+    if not os.environ.get("TEST_DB_URI", None):
+        pytest.skip("TEST_DB_URI not set")
+    engine = create_engine(os.environ["TEST_DB_URI"])
+    Contact.__table__.create(engine, checkfirst=True)
+    session = Session(bind=engine)
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+        engine.dispose()
+
+
+def upsert_and_read(session_, rows, copy):
+    existing = {"C_SFDCContactID": "existing", "C_Company": "old", "C_City": "old", "TimeInsertedUTC": None}
+    session_.execute(Contact.__table__.delete().where(Contact.C_SFDCContactID.in_([row["C_SFDCContactID"]
+                                                                                   for row in rows])))
+    upsert_rows(session_=session_, table=Contact.__table__, rows=[existing], index_elements=["C_SFDCContactID"])
+    upsert_rows(session_=session_, table=Contact.__table__, rows=rows, index_elements=["C_SFDCContactID"], copy=copy)
+    result = session_.execute(select([Contact.C_SFDCContactID, Contact.C_Company, Contact.C_City,
+                                      Contact.TimeInsertedUTC])
+                              .where(Contact.C_SFDCContactID.in_([row["C_SFDCContactID"] for row in rows]))
+                              .order_by(Contact.C_SFDCContactID)).fetchall()
+    session_.rollback()
+    return [tuple(row) for row in result]
+
+
+def test_copy_upserts_the_same_rows_as_on_conflict(db_session):
+    time_inserted = datetime(2020, 1, 1, 12, 30, tzinfo=timezone.utc)
+    rows = [{"C_SFDCContactID": "copy_test_{0}".format(i), "C_Company": value, "C_City": None,
+             "TimeInsertedUTC": time_inserted} for i, value in enumerate(tricky_values)]
+    # conflicts with the existing row, and is updated
+    rows.append({"C_SFDCContactID": "existing", "C_Company": "new", "C_City": None, "TimeInsertedUTC": time_inserted})
+    copied = upsert_and_read(session_=db_session, rows=rows, copy=True)
+    inserted = upsert_and_read(session_=db_session, rows=rows, copy=False)
+    assert copied == inserted
+    assert [row[1] for row in copied] == tricky_values + ["new"]
+    assert all(row[2] is None for row in copied)
+
+
+class MemberSession:
+    '''
+    SQL session over target group members kept in a set of (C_SFDCContactID, TargetGroupID),
+    that records the statements it is given
+    '''
+    def __init__(self, members):
+        self.members = set(members)
+        self.statements = []
+
+    def all(self):
+        return list(self.members)
+
+    def execute(self, statement):
+        self.statements.append(statement)
+        compiled = statement.compile(dialect=postgresql.dialect())
+        assert str(compiled).startswith("DELETE FROM target_group_member")
+        values = list(compiled.params.values())
+        # SQLAlchemy 1.4 binds the tuples of an expanding IN as one list, 1.3 binds each value
+        pairs = values[0] if len(values) == 1 and isinstance(values[0], list) else zip(values[::2], values[1::2])
+        self.members -= set(tuple(pair) for pair in pairs)
+
+
+@pytest.fixture
+def member_session(monkeypatch):
+    def upsert_rows(session_, table, rows, index_elements, batch_size, copy):
+        assert table is TargetGroupMember.__table__
+        session_.statements.append(rows)
+        session_.members |= set((row["C_SFDCContactID"], row["TargetGroupID"]) for row in rows)
+
+    monkeypatch.setattr(db_crud, "create_query", lambda session_, purpose, type: session_)
+    monkeypatch.setattr(db_crud, "upsert_rows", upsert_rows)
+    return MemberSession(members=[("c1", "g1"), ("c2", "g1"), ("c3", "g2")])
+
+
+def members(*pairs):
+    return [{"__metadata": {}, "ContactID": contact_id, "TargetGroupID": target_gr_id} for contact_id, target_gr_id in pairs]
+
+
+def test_target_gr_m_sync_adds_new_members(member_session):
+    upsert_target_gr_m(session_=member_session, data=members(("c1", "g1"), ("c2", "g1"), ("c3", "g2"), ("c1", "g2")))
+    assert member_session.members == {("c1", "g1"), ("c2", "g1"), ("c3", "g2"), ("c1", "g2")}
+    # only the new member is written
+    assert len(member_session.statements) == 1
+    assert [(row["C_SFDCContactID"], row["TargetGroupID"]) for row in member_session.statements[0]] == [("c1", "g2")]
+
+
+def test_target_gr_m_sync_removes_missing_members(member_session):
+    upsert_target_gr_m(session_=member_session, data=members(("c1", "g1"), ("c3", "g2"), ("c4", "g2")), batch_size=1)
+    assert member_session.members == {("c1", "g1"), ("c3", "g2"), ("c4", "g2")}
+    assert len(member_session.statements) == 2
+
+
+def test_target_gr_m_sync_in_batches(member_session):
+    upsert_target_gr_m(session_=member_session, data=members(("c9", "g9")), batch_size=2)
+    assert member_session.members == {("c9", "g9")}
+    # 3 members deleted in 2 statements, 1 inserted
+    assert len(member_session.statements) == 3
+
+
+def test_target_gr_m_sync_unchanged_members_writes_nothing(member_session):
+    upsert_target_gr_m(session_=member_session, data=members(("c3", "g2"), ("c1", "g1"), ("c2", "g1"), ("", "g1")))
+    assert member_session.members == {("c1", "g1"), ("c2", "g1"), ("c3", "g2")}
+    assert member_session.statements == []
+
+
+def test_target_gr_m_sync_in_db(db_session):
+    TargetGroupMember.__table__.create(db_session.get_bind(), checkfirst=True)
+    db_session.execute(TargetGroupMember.__table__.delete())
+    upsert_target_gr_m(session_=db_session, data=members(("c1", "g1"), ("c2", "g1")))
+    upsert_target_gr_m(session_=db_session, data=members(("c1", "g1"), ("c3", "g2")), batch_size=1)
+    result = db_session.execute(select([TargetGroupMember.C_SFDCContactID, TargetGroupMember.TargetGroupID])).fetchall()
+    assert set(tuple(row) for row in result) == {("c1", "g1"), ("c3", "g2")}
+
+
+# leads of the claim tests, above the TableIDs of other leads in the test database
+first_table_id = 900000001
+
+
+@pytest.fixture
+def worker_sessions():
+    '''
+    Sessions of two import_c4c workers on the Postgres database of TEST_DB_URI, with four pending leads
+    committed for them to claim, which are deleted after the test
+    '''
+    if not os.environ.get("TEST_DB_URI", None):
+        pytest.skip("TEST_DB_URI not set")
+    engine = create_engine(os.environ["TEST_DB_URI"])
+    Lead.__table__.create(engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(Lead.__table__.delete().where(Lead.TableID >= first_table_id))
+        conn.execute(Lead.__table__.insert(), [dict(TableID=first_table_id + i, C4C_Status="pending") for i in range(4)])
+    sessions = [Session(bind=engine), Session(bind=engine)]
+    try:
+        yield sessions
+    finally:
+        for session in sessions:
+            session.rollback()
+            session.close()
+        with engine.begin() as conn:
+            conn.execute(Lead.__table__.delete().where(Lead.TableID >= first_table_id))
+        engine.dispose()
+
+
+def claim(session_, worker_id, batch_size=4, lease_seconds=60):
+    claimed = db_crud.claim_leads(session_=session_, worker_id=worker_id, batch_size=batch_size,
+                                  lease_seconds=lease_seconds, after_table_id=first_table_id - 1)
+    return [entry[0] for entry in claimed]
+
+
+def read_claims(session_):
+    return [tuple(row) for row in session_.execute(
+        select([Lead.TableID, Lead.C4C_Status, Lead.C4C_Claimed_By])
+        .where(Lead.TableID >= first_table_id).order_by(Lead.TableID)).fetchall()]
+
+
+def test_concurrent_claims_do_not_overlap(worker_sessions):
+    session_a, session_b = worker_sessions
+    # the claim of worker a is not committed yet, so its leads are still locked when worker b claims
+    assert claim(session_=session_a, worker_id="a", batch_size=2) == [first_table_id, first_table_id + 1]
+    assert claim(session_=session_b, worker_id="b", batch_size=2) == [first_table_id + 2, first_table_id + 3]
+    session_a.commit()
+    session_b.commit()
+    # claimed leads are not claimed again while their claims last
+    assert claim(session_=session_a, worker_id="a") == []
+    assert [row[2] for row in read_claims(session_=session_a)] == ["a", "a", "b", "b"]
+
+
+def test_expired_claim_is_claimed_again(worker_sessions):
+    session_a, session_b = worker_sessions
+    table_ids = claim(session_=session_a, worker_id="a")
+    session_a.commit()
+    assert claim(session_=session_b, worker_id="b") == []
+    session_b.commit()
+    # worker a stops renewing its claim, which expires
+    db_crud.renew_leads(session_=session_a, worker_id="a", table_ids=table_ids, lease_seconds=-1)
+    session_a.commit()
+    assert claim(session_=session_b, worker_id="b") == table_ids
+    session_b.commit()
+    assert read_claims(session_=session_b) == [(table_id, "processing", "b") for table_id in table_ids]
+
+
+def test_write_back_after_claim_lost_is_rejected(worker_sessions):
+    session_a, session_b = worker_sessions
+    # the claim of worker a expires right away, and worker b claims the leads after it
+    table_ids = claim(session_=session_a, worker_id="a", lease_seconds=-1)
+    session_a.commit()
+    assert claim(session_=session_b, worker_id="b") == table_ids
+    session_b.commit()
+    assert db_crud.renew_leads(session_=session_a, worker_id="a", table_ids=table_ids, lease_seconds=60) == set()
+    db_crud.upsert_lead(session_=session_a, data=[{"TableID": table_id, "C4C_Status": "created"} for table_id in table_ids],
+                        outbound=True, worker_id="a")
+    session_a.commit()
+    assert read_claims(session_=session_a) == [(table_id, "processing", "b") for table_id in table_ids]
+    db_crud.upsert_lead(session_=session_b, data=[{"TableID": table_id, "C4C_Status": "updated"} for table_id in table_ids],
+                        outbound=True, worker_id="b")
+    session_b.commit()
+    assert read_claims(session_=session_b) == [(table_id, "updated", None) for table_id in table_ids]
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+from c4c.c4c_rate_limiter import AdaptiveLimiter, parse_retry_after
+
+
+def send(limiter, count):
+    for _ in range(count):
+        assert limiter.can_send()
+        limiter.on_send()
+
+
+def test_limit_bounds_requests_in_flight():
+    limiter = AdaptiveLimiter(limit=4)
+    send(limiter=limiter, count=4)
+    assert not limiter.can_send()
+    limiter.on_response(status_code=200)
+    assert limiter.can_send()
+
+
+def test_throttled_response_halves_limit_down_to_min():
+    limiter = AdaptiveLimiter(limit=8, min_limit=1)
+    limiter.on_response(status_code=429)
+    assert limiter.current_limit == 4
+    for _ in range(5):
+        limiter.on_response(status_code=503)
+    assert limiter.current_limit == 1
+    assert limiter.metrics()["throttled"] == 6
+
+
+def test_burst_of_throttled_responses_decreases_limit_once():
+    limiter = AdaptiveLimiter(limit=8, min_limit=1)
+    send_numbers = [limiter.on_send() for _ in range(8)]
+    # all requests in flight are throttled together
+    for send_number in send_numbers:
+        limiter.on_response(status_code=429, send_number=send_number)
+    assert limiter.current_limit == 4
+    assert limiter.metrics()["throttled"] == 8
+    # a request sent after the decrease is congestion at the new limit
+    limiter.on_response(status_code=429, send_number=limiter.on_send())
+    assert limiter.current_limit == 2
+
+
+def test_failed_request_counts_as_congestion():
+    limiter = AdaptiveLimiter(limit=8)
+    limiter.on_send()
+    limiter.on_response(status_code=None)
+    assert limiter.current_limit == 4
+    assert limiter.in_flight == 0
+    assert limiter.metrics()["failed"] == 1
+    assert limiter.metrics()["throttled"] == 0
+
+
+def test_limit_recovers_up_to_configured_limit():
+    limiter = AdaptiveLimiter(limit=4)
+    limiter.on_response(status_code=429)
+    assert limiter.current_limit == 2
+    # about one more per limit's worth of successful responses
+    for _ in range(3):
+        limiter.on_response(status_code=200)
+    assert limiter.current_limit == 3
+    for _ in range(100):
+        limiter.on_response(status_code=201)
+    assert limiter.current_limit == 4
+
+
+def test_error_responses_other_than_throttling_do_not_lower_limit():
+    limiter = AdaptiveLimiter(limit=4)
+    limiter.on_response(status_code=500)
+    limiter.on_response(status_code=400)
+    assert limiter.current_limit == 4
+
+
+def test_retry_after_pauses_requests():
+    limiter = AdaptiveLimiter(limit=4)
+    assert limiter.wait_time() == 0
+    limiter.on_response(status_code=429, retry_after="2")
+    assert 1 < limiter.wait_time() <= 2
+    # a shorter Retry-After does not shorten the pause
+    limiter.on_response(status_code=429, retry_after="1")
+    assert limiter.wait_time() > 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after("soon") is None
+    retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < parse_retry_after(retry_at) <= 30